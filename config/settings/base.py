@@ -88,6 +88,16 @@ DATABASES['default']['ATOMIC_REQUESTS'] = True
 
 # custom crate engine where we use a customized postgres backend engine
 DATABASES['crate']['ENGINE'] = 'cratedb.connector'
+# pool the crate connections in each process (web server or celery worker), 0 to disable
+# the connections are given back to the pool at the end of each request
+CRATE_POOL_MAX_SIZE = env.int('CRATE_POOL_MAX_SIZE', default=0)
+if CRATE_POOL_MAX_SIZE:
+    DATABASES['crate']['POOL'] = {
+        'MIN_SIZE': env.int('CRATE_POOL_MIN_SIZE', default=1),
+        'MAX_SIZE': CRATE_POOL_MAX_SIZE,
+        # in seconds, connections older than this are closed instead of being reused
+        'MAX_LIFETIME': env.int('CRATE_POOL_MAX_LIFETIME', default=600),
+    }
 
 DATABASE_ROUTERS = ['config.db_routers.CrateRouter']
 
@@ -296,6 +306,57 @@ CELERY_ACCEPT_CONTENT = ['pickle', 'json']
 CELERY_TASK_SERIALIZER = 'pickle'
 CELERY_RESULT_SERIALIZER = 'pickle'
 CELERY_TIMEZONE = TIME_ZONE
+CELERY_BEAT_SCHEDULE = {}
+
+# Cache of the latest value of each topic, in seconds, 0 to disable
+CURRENT_VALUE_CACHE_TTL = env.int('CURRENT_VALUE_CACHE_TTL', default=30)
+# How far back the latest values of the topics are looked up together, in seconds, 0 to read their whole history
+# the topics without data in that window are looked up one by one
+CURRENT_VALUE_LOOKBACK = env.int('CURRENT_VALUE_LOOKBACK', default=86400)
+# Maximum number of independent Crate queries run concurrently by a request, 1 to run them in sequence
+# each of those uses its own Crate connection
+CRATE_QUERY_CONCURRENCY = env.int('CRATE_QUERY_CONCURRENCY', default=4)
+# Periodically refresh the cached latest values of all the data points, in seconds, 0 to disable
+# this requires running celery beat
+CURRENT_VALUE_CACHE_REFRESH = env.int('CURRENT_VALUE_CACHE_REFRESH', default=0)
+if CURRENT_VALUE_CACHE_REFRESH:
+    CELERY_BEAT_SCHEDULE['refresh_current_values'] = {
+        'task': 'opentaps_seas.core.tasks.refresh_current_values_task',
+        'schedule': CURRENT_VALUE_CACHE_REFRESH,
+    }
+
+# Cache of the point data series polled by the charts, in seconds, 0 to disable
+# while cached only the buckets after the last cached one are queried, the whole range once expired
+POINT_VALUES_CACHE_TTL = env.int('POINT_VALUES_CACHE_TTL', default=600)
+
+# Cache of the tag columns of the Crate topic table used by the topic filters, in seconds, 0 to disable
+# a tag synced to Crate for the first time clears it
+CRATE_TAG_COLUMNS_TTL = env.int('CRATE_TAG_COLUMNS_TTL', default=300)
+
+# Serve the hour and coarser resolutions of Number points from the Crate rollup tables
+CRATE_ROLLUPS = env.bool('CRATE_ROLLUPS', default=False)
+# Periodically update the Crate rollup tables, in seconds, 0 to disable
+# this requires running celery beat
+CRATE_ROLLUPS_REFRESH = env.int('CRATE_ROLLUPS_REFRESH', default=0)
+if CRATE_ROLLUPS_REFRESH:
+    CELERY_BEAT_SCHEDULE['update_rollups'] = {
+        'task': 'opentaps_seas.core.tasks.update_rollups_task',
+        'schedule': CRATE_ROLLUPS_REFRESH,
+    }
+
+# Periodically apply the topic tag rule sets to the topics new since their last run, in seconds, 0 to disable
+# this requires running celery beat
+TOPIC_TAG_RULESETS_REFRESH = env.int('TOPIC_TAG_RULESETS_REFRESH', default=0)
+if TOPIC_TAG_RULESETS_REFRESH:
+    CELERY_BEAT_SCHEDULE['run_new_topics_tag_rulesets'] = {
+        'task': 'opentaps_seas.core.tasks.run_new_topics_tag_rulesets_task',
+        'schedule': TOPIC_TAG_RULESETS_REFRESH,
+    }
+
+# Default and maximum lease of the Haystack watches, in seconds
+# a watch is dropped from the cache when it is not polled within its lease
+HAYSTACK_WATCH_LEASE = env.int('HAYSTACK_WATCH_LEASE', default=300)
+HAYSTACK_WATCH_MAX_LEASE = env.int('HAYSTACK_WATCH_MAX_LEASE', default=3600)
 
 # FIXTURES
 # ------------------------------------------------------------------------------
@@ -73,3 +73,12 @@ EMAIL_PORT = 1025
 # ------------------------------------------------------------------------------
 DATABASES['crate']['TEST'] = {'NAME': 'test'}
 DATABASES['crate']['BYPASS_CREATION'] = True
+# do not cache the latest values nor the point series since tests write data in Crate directly
+CURRENT_VALUE_CACHE_TTL = 0
+POINT_VALUES_CACHE_TTL = 0
+# the tag columns are added to the persistent Crate test database by the tests, read them on each filter
+CRATE_TAG_COLUMNS_TTL = 0
+# run the celery tasks in the test process
+CELERY_TASK_ALWAYS_EAGER = True
+CELERY_TASK_EAGER_PROPAGATES = True
+CELERY_RESULT_BACKEND = 'cache+memory://'
@@ -58,6 +58,7 @@ from .creation import DatabaseCreation                      # NOQA isort:skip
 from .features import DatabaseFeatures                      # NOQA isort:skip
 from .introspection import DatabaseIntrospection            # NOQA isort:skip
 from .operations import DatabaseOperations                  # NOQA isort:skip
+from .pool import get_pool                                  # NOQA isort:skip
 from .schema import DatabaseSchemaEditor                    # NOQA isort:skip
 from .utils import utc_tzinfo_factory                       # NOQA isort:skip
 
@@ -181,8 +182,22 @@ class DatabaseWrapper(BaseDatabaseWrapper):
             conn_params['port'] = settings_dict['PORT']
         return conn_params
 
+    @property
+    def pool(self):
+        # when the POOL settings are given, connections are taken from a per process pool
+        # and given back to it on close instead of being closed
+        pool_settings = self.settings_dict.get('POOL')
+        if not pool_settings:
+            return None
+        return get_pool(self.alias, lambda: Database.connect(**self.get_connection_params()),
+                        self._is_connection_usable, pool_settings)
+
     def get_new_connection(self, conn_params):
-        connection = Database.connect(**conn_params)
+        pool = self.pool
+        if pool:
+            connection = pool.getconn()
+        else:
+            connection = Database.connect(**conn_params)
 
         # self.isolation_level must be set:
         # - after connecting to the database in order to obtain the database's
@@ -252,15 +267,33 @@ class DatabaseWrapper(BaseDatabaseWrapper):
         self.cursor().execute('SET CONSTRAINTS ALL IMMEDIATE')
         self.cursor().execute('SET CONSTRAINTS ALL DEFERRED')
 
-    def is_usable(self):
+    @staticmethod
+    def _is_connection_usable(connection):
         try:
             # Use a psycopg cursor directly, bypassing Django's utilities.
-            self.connection.cursor().execute("SELECT 1")
+            connection.cursor().execute("SELECT 1")
         except Database.Error:
             return False
         else:
             return True
 
+    def is_usable(self):
+        return self._is_connection_usable(self.connection)
+
+    def _close(self):
+        pool = self.pool
+        if pool and self.connection is not None:
+            # give the connection back, unless it failed and cannot be used anymore
+            discard = self.errors_occurred and not self.is_usable()
+            if not discard and not self.connection.autocommit:
+                try:
+                    self.connection.rollback()
+                except Database.Error:
+                    discard = True
+            pool.putconn(self.connection, discard=discard)
+            return
+        return super()._close()
+
     @property
     def _nodb_connection(self):
         nodb_connection = super()._nodb_connection
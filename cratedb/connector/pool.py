@@ -0,0 +1,184 @@
+# This file is part of opentaps Smart Energy Applications Suite (SEAS).
+
+# opentaps Smart Energy Applications Suite (SEAS) is free software:
+# you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# opentaps Smart Energy Applications Suite (SEAS) is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public License
+# along with opentaps Smart Energy Applications Suite (SEAS).
+# If not, see <https://www.gnu.org/licenses/>.
+
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+# pools by (alias, pid): a forked process never reuses the connections of its parent,
+# and the parent's pool stays referenced so the child does not close the shared sockets
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class ConnectionPool(object):
+    """A thread safe pool of DB-API connections.
+
+    Connections older than max_lifetime are closed instead of being reused, and
+    connections idle for more than check_interval are checked with is_usable
+    before being handed out again.
+    """
+
+    def __init__(self, connect, is_usable=None, min_size=1, max_size=10, max_lifetime=None,
+                 check_interval=30, timeout=30):
+        self._connect = connect
+        self._is_usable = is_usable
+        self.min_size = min_size
+        self.max_size = max(max_size, 1)
+        self.max_lifetime = max_lifetime
+        self.check_interval = check_interval
+        self.timeout = timeout
+        self.pid = os.getpid()
+        # idle connections as (connection, created, returned) tuples, last returned at the end
+        self._idle = deque()
+        self._created = {}
+        self._size = 0
+        self._cond = threading.Condition()
+        self._filled = False
+
+    @property
+    def size(self):
+        return self._size
+
+    @property
+    def idle(self):
+        return len(self._idle)
+
+    def _expired(self, created, now):
+        return self.max_lifetime and now - created > self.max_lifetime
+
+    def _new_connection(self):
+        try:
+            conn = self._connect()
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+        self._created[id(conn)] = time.monotonic()
+        return conn
+
+    def _close(self, conn):
+        # returns True if the connection was one of this pool, then it no longer counts in its size
+        owned = self._created.pop(id(conn), None) is not None
+        try:
+            conn.close()
+        except Exception:
+            pass
+        return owned
+
+    def _fill(self):
+        # open the min_size connections the first time the pool is used
+        with self._cond:
+            if self._filled:
+                return
+            self._filled = True
+        for i in range(self.min_size):
+            with self._cond:
+                if self._size >= self.min_size:
+                    break
+                self._size += 1
+            self.putconn(self._new_connection())
+
+    def getconn(self):
+        if not self._filled:
+            self._fill()
+        deadline = time.monotonic() + self.timeout
+        while True:
+            with self._cond:
+                while not self._idle and self._size >= self.max_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0 or not self._cond.wait(remaining):
+                        raise PoolTimeout('No connection available in the pool after {}s'.format(self.timeout))
+                if not self._idle:
+                    self._size += 1
+                    break
+                conn, created, returned = self._idle.pop()
+            now = time.monotonic()
+            if self._expired(created, now) or conn.closed or (
+                    self._is_usable and now - returned > self.check_interval and not self._is_usable(conn)):
+                self._discard(conn)
+                continue
+            return conn
+        return self._new_connection()
+
+    def putconn(self, conn, discard=False):
+        created = self._created.get(id(conn))
+        if created is None:
+            # not a connection of this pool: one inherited from the parent process still belongs to
+            # the parent pool and its socket must stay open, others were already discarded
+            if not _owned_by_other_pool(self, conn):
+                self._close(conn)
+            return
+        if discard or conn.closed or self._expired(created, time.monotonic()):
+            self._discard(conn)
+            return
+        with self._cond:
+            # giving back a connection twice must not hand it out twice
+            if any(c is conn for c, _, _ in self._idle):
+                return
+            self._idle.append((conn, created, time.monotonic()))
+            self._cond.notify()
+
+    def owns(self, conn):
+        return id(conn) in self._created
+
+    def _discard(self, conn):
+        if self._close(conn):
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+
+    def closeall(self):
+        with self._cond:
+            idle = list(self._idle)
+            self._idle.clear()
+        for conn, created, returned in idle:
+            self._discard(conn)
+
+
+def _owned_by_other_pool(pool, conn):
+    return any(p is not pool and p.owns(conn) for p in list(_pools.values()))
+
+
+def get_pool(alias, connect, is_usable, pool_settings):
+    # returns the pool of the given database alias for the current process
+    key = (alias, os.getpid())
+    pool = _pools.get(key)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.get(key)
+            if pool is None:
+                logger.info('Creating the %s connection pool for process %s: %s', alias, key[1], pool_settings)
+                pool = ConnectionPool(
+                    connect,
+                    is_usable=is_usable,
+                    min_size=pool_settings.get('MIN_SIZE', 1),
+                    max_size=pool_settings.get('MAX_SIZE', 10),
+                    max_lifetime=pool_settings.get('MAX_LIFETIME'),
+                    check_interval=pool_settings.get('CHECK_INTERVAL', 30),
+                    timeout=pool_settings.get('TIMEOUT', 30))
+                _pools[key] = pool
+    return pool
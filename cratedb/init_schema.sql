@@ -101,3 +101,34 @@ WITH (
    "warmer.enabled" = true,
    "write.wait_for_active_shards" = 'ALL'
 );
+
+-- Hourly and daily pre-aggregated data, maintained by the update_rollups script
+-- or the opentaps_seas.core.tasks.update_rollups_task celery task
+
+CREATE TABLE IF NOT EXISTS "volttron"."data_rollup_hour" (
+   "topic" STRING,
+   "ts" TIMESTAMP,
+   "min_value" DOUBLE,
+   "max_value" DOUBLE,
+   "avg_value" DOUBLE,
+   "sum_value" DOUBLE,
+   "value_count" LONG,
+   "last_value" DOUBLE,
+   "last_ts" TIMESTAMP,
+   PRIMARY KEY ("topic", "ts")
+)
+CLUSTERED BY ("topic");
+
+CREATE TABLE IF NOT EXISTS "volttron"."data_rollup_day" (
+   "topic" STRING,
+   "ts" TIMESTAMP,
+   "min_value" DOUBLE,
+   "max_value" DOUBLE,
+   "avg_value" DOUBLE,
+   "sum_value" DOUBLE,
+   "value_count" LONG,
+   "last_value" DOUBLE,
+   "last_ts" TIMESTAMP,
+   PRIMARY KEY ("topic", "ts")
+)
+CLUSTERED BY ("topic");
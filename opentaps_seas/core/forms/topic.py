@@ -19,6 +19,7 @@ import logging
 import json
 import csv
 from io import TextIOWrapper
+from .. import tasks
 from .. import utils
 from ..models import Entity
 from ..models import SiteView
@@ -57,6 +58,9 @@ class TopicTagRuleSetRunForm(forms.Form):
     topic_filter = ModelField(label='Topic Filter', max_length=255, required=False)
     preview_type = forms.CharField(required=False)
     diff_format = forms.BooleanField(label="Preview in a diff format", required=False, initial=False)
+    new_topics_only = forms.BooleanField(label="Only for the topics new since the last run", required=False,
+                                         initial=False)
+    use_async = forms.BooleanField(label='Run Async', required=False)
 
     def is_valid(self):
         if not super().is_valid():
@@ -70,75 +74,10 @@ class TopicTagRuleSetRunForm(forms.Form):
 
     def save(self, commit=True):
         # run the topic tag ruleset
-        topic_filter = self.cleaned_data['topic_filter']
-        ruleset_id = self.cleaned_data['ruleset_id']
-        preview_type = self.cleaned_data['preview_type']
-        diff_format = self.cleaned_data['diff_format']
-        pretend = False
-        if preview_type:
-            pretend = True
-
-        logger.info('TopicTagRuleSetRunForm: for set %s and additional filter: %s, pretend: %s',
-                    ruleset_id, topic_filter, pretend)
-        rule_set = TopicTagRuleSet.objects.get(id=ruleset_id)
-        # collect count of topics we ran for
-        updated_set = set()
-        updated_entities = {}
-        updated_tags = {}
-        removed_tags = {}
-        new_equipments = []
-        for rule in rule_set.topictagrule_set.all():
-            rule_filters = rule.filters
-            # Add the topic_filter to the rule filters if given
-            if topic_filter:
-                tf = {'type': 'c', 'value': topic_filter}
-                if rule_filters:
-                    rule_filters.append(tf)
-                else:
-                    rule_filters = [tf]
-            if rule.tags:
-                updated, updated_curr_entities, updated_curr_tags, removed_curr_tags = utils.tag_topics(
-                    rule_filters, rule.tags, select_all=True, pretend=pretend)
-                for x in updated:
-                    updated_set.add(x.get('topic'))
-
-                for key in updated_curr_entities.keys():
-                    updated_curr_entity = updated_curr_entities.get(key, {})
-                    topic = updated_curr_entity.topic
-                    kv_tags = updated_curr_entity.kv_tags
-                    m_tags = updated_curr_entity.m_tags
-                    updated_entity = updated_entities.get(key, {})
-                    updated_entity['topic'] = topic
-                    updated_kv_tags = updated_entity.get('kv_tags', {})
-                    updated_m_tags = updated_entity.get('m_tags', [])
-                    for tag, value in kv_tags.items():
-                        updated_kv_tags[tag] = value
-                    for tag in m_tags:
-                        if tag not in updated_m_tags:
-                            updated_m_tags.append(tag)
-
-                    updated_entity['kv_tags'] = updated_kv_tags
-                    updated_entity['m_tags'] = updated_m_tags
-
-                    updated_entities[key] = updated_entity
-
-                for key, updated_curr_tag in updated_curr_tags.items():
-                    updated_tag = updated_tags.get(key, {})
-                    for tag, value in updated_curr_tag.items():
-                        updated_tag[tag] = value
-                    updated_tags[key] = updated_tag
-
-                for key, removed_curr_tag in removed_curr_tags.items():
-                    removed_tag = removed_tags.get(key, {})
-                    for tag, value in removed_curr_tag.items():
-                        removed_tag[tag] = value
-                    removed_tags[key] = removed_tag
-
-            if rule.action and rule.action_fields and not pretend:
-                if rule.action == 'create equipment':
-                    new_equipments = utils.create_equipment_action(rule_filters, rule.action_fields)
+        return tasks.run_topic_tag_ruleset(self.cleaned_data.copy())
 
-        return updated_set, updated_entities, preview_type, updated_tags, removed_tags, diff_format, new_equipments
+    def run_async(self):
+        return tasks.run_topic_tag_ruleset_task.delay(self.cleaned_data.copy())
 
 
 class TopicTagRuleCreateForm(forms.ModelForm):
@@ -212,7 +151,7 @@ class TopicTagRuleRunForm(forms.Form):
                 rule_filters = [tf]
         if rule.tags:
             updated, updated_curr_entities, updated_curr_tags, removed_curr_tags = utils.tag_topics(
-                rule_filters, rule.tags, select_all=True, pretend=pretend)
+                rule_filters, rule.tags, select_all=True, pretend=pretend, bulk=True)
             for x in updated:
                 updated_set.add(x.get('topic'))
 
@@ -0,0 +1,165 @@
+# This file is part of opentaps Smart Energy Applications Suite (SEAS).
+
+# opentaps Smart Energy Applications Suite (SEAS) is free software:
+# you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# opentaps Smart Energy Applications Suite (SEAS) is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public License
+# along with opentaps Smart Energy Applications Suite (SEAS).
+# If not, see <https://www.gnu.org/licenses/>.
+
+import logging
+import threading
+import uuid
+
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Q
+from .models import Entity
+
+logger = logging.getLogger(__name__)
+
+# shared by the processes so that an Entity saved in one invalidates the index of the others,
+# the version is a random token so an evicted key never matches the version of an existing index
+HIERARCHY_VERSION_CACHE_KEY = 'entity_hierarchy_version'
+
+_lock = threading.Lock()
+_hierarchy = None
+
+
+class HierarchyNode(object):
+    # the site, equipment or point identified by its id tag (or entity_id when missing)
+    # site_id and equipment_id are its siteRef and equipRef
+    __slots__ = ['entity_id', 'object_id', 'description', 'site_id', 'equipment_id', 'm_tags']
+
+    def __init__(self, entity_id, object_id, description, site_id, equipment_id, m_tags):
+        self.entity_id = entity_id
+        self.object_id = object_id
+        self.description = description
+        self.site_id = site_id
+        self.equipment_id = equipment_id
+        self.m_tags = m_tags or []
+
+    def __str__(self):
+        return self.entity_id
+
+    @property
+    def is_site(self):
+        return 'site' in self.m_tags
+
+    @property
+    def is_equipment(self):
+        return 'equip' in self.m_tags and 'point' not in self.m_tags
+
+    @property
+    def is_point(self):
+        return 'point' in self.m_tags
+
+
+class EntityHierarchy(object):
+    # adjacency maps of the site -> equipment -> point entities, keyed by object_id
+
+    def __init__(self, nodes, version=None):
+        self.version = version
+        self.nodes = {}
+        self.by_entity_id = {}
+        self.site_children = {}
+        self.equipment_children = {}
+        self.site_equipment_nodes = {}
+        self.sites = []
+        for n in sorted(nodes, key=lambda n: n.entity_id):
+            self.nodes[n.object_id] = n
+            self.by_entity_id[n.entity_id] = n
+            if n.is_site:
+                self.sites.append(n)
+            if n.is_equipment and n.site_id:
+                self.site_equipment_nodes.setdefault(n.site_id, []).append(n)
+            if n.equipment_id:
+                self.equipment_children.setdefault(n.equipment_id, []).append(n)
+            elif n.site_id:
+                self.site_children.setdefault(n.site_id, []).append(n)
+
+    @classmethod
+    def build(cls, version=None):
+        entities = Entity.objects.filter(
+            Q(m_tags__overlap=['site', 'equip']) | Q(kv_tags__has_key='siteRef') | Q(kv_tags__has_key='equipRef'))
+        nodes = []
+        for entity_id, object_id, description, site_id, equipment_id, m_tags in entities.values_list(
+                'entity_id', 'kv_tags__id', 'kv_tags__dis', 'kv_tags__siteRef', 'kv_tags__equipRef', 'm_tags'
+                ).iterator():
+            nodes.append(HierarchyNode(entity_id, object_id or entity_id, description, site_id, equipment_id, m_tags))
+        logger.info('Built the entity hierarchy of %s entities', len(nodes))
+        return cls(nodes, version=version)
+
+    def get(self, object_id):
+        return self.nodes.get(object_id)
+
+    def get_by_entity_id(self, entity_id):
+        return self.by_entity_id.get(entity_id)
+
+    def get_site(self, object_id):
+        n = self.nodes.get(object_id)
+        if n and n.is_site:
+            return n
+        return None
+
+    def get_equipment(self, object_id):
+        n = self.nodes.get(object_id)
+        if n and n.is_equipment:
+            return n
+        return None
+
+    def children(self, node):
+        # the nav children: for a site the entities referencing it without an equipment, for an equipment its points
+        if node.is_site:
+            return self.site_children.get(node.object_id, [])
+        if 'equip' in node.m_tags:
+            return self.equipment_children.get(node.object_id, [])
+        return []
+
+    def site_equipments(self, site_id):
+        return self.site_equipment_nodes.get(site_id, [])
+
+    def equipment_points(self, equipment_id):
+        return [n for n in self.equipment_children.get(equipment_id, []) if n.is_point]
+
+
+def _get_entity_hierarchy_version():
+    version = cache.get(HIERARCHY_VERSION_CACHE_KEY)
+    if version is None:
+        # only one process seeds the new version, the others then read it
+        cache.add(HIERARCHY_VERSION_CACHE_KEY, uuid.uuid4().hex, None)
+        version = cache.get(HIERARCHY_VERSION_CACHE_KEY)
+    return version
+
+
+def get_entity_hierarchy():
+    # returns the index, built lazily and rebuilt when an Entity was saved or deleted
+    global _hierarchy
+    version = _get_entity_hierarchy_version()
+    h = _hierarchy
+    if h is not None and version is not None and h.version == version:
+        return h
+    with _lock:
+        if _hierarchy is None or version is None or _hierarchy.version != version:
+            _hierarchy = EntityHierarchy.build(version=version)
+        return _hierarchy
+
+
+def _new_entity_hierarchy_version():
+    cache.set(HIERARCHY_VERSION_CACHE_KEY, uuid.uuid4().hex, None)
+
+
+def invalidate_entity_hierarchy():
+    # called from the Entity signals and after the bulk updates: the index of this process is dropped now,
+    # the other processes only rebuild theirs once the transaction is committed so they see the changes
+    global _hierarchy
+    _hierarchy = None
+    transaction.on_commit(_new_entity_hierarchy_version)
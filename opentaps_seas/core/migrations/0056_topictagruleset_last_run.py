@@ -0,0 +1,46 @@
+# This file is part of opentaps Smart Energy Applications Suite (SEAS).
+
+# opentaps Smart Energy Applications Suite (SEAS) is free software:
+# you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# opentaps Smart Energy Applications Suite (SEAS) is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public License
+# along with opentaps Smart Energy Applications Suite (SEAS).
+# If not, see <https://www.gnu.org/licenses/>.
+
+from django.db import connections
+from django.db import migrations
+from django.db import models
+
+
+def check_schema(apps, schema_editor):
+    with connections['crate'].cursor() as c:
+        try:
+            c.execute("""ALTER TABLE "volttron"."topic" ADD COLUMN "first_seen" TIMESTAMP;""")
+        except Exception as e:
+            print(e)
+
+        c.close()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0055_add_transactions_note_file'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='topictagruleset',
+            name='last_run',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='Last Run'),
+        ),
+        migrations.RunPython(check_schema, migrations.RunPython.noop),
+    ]
@@ -56,6 +56,7 @@ from filer.models import Image as FilerFile
 from cratedb.fields import HStoreField as CrateHStoreField
 from cratedb.fields import ArrayField as CrateArrayField
 from ..party.models import Party
+from .tag_columns import add_crate_tag_columns
 
 logger = logging.getLogger(__name__)
 
@@ -470,6 +471,8 @@ def entity_deleted(sender, instance, using, **kwargs):
     EntityFile.objects.filter(entity_id=instance.entity_id).delete()
     if settings.CRATE_TAG_AUTOSYNC:
         delete_tags_from_crate_entity(instance)
+    from .hierarchy import invalidate_entity_hierarchy
+    invalidate_entity_hierarchy()
 
 
 @receiver(post_save, sender=Entity, dispatch_uid='entity_post_save_signal')
@@ -478,6 +481,8 @@ def entity_saved(sender, instance, using, **kwargs):
     logger.info('entity_saved: %s', instance.entity_id)
     if settings.CRATE_TAG_AUTOSYNC:
         sync_tags_to_crate_entity(instance)
+    from .hierarchy import invalidate_entity_hierarchy
+    invalidate_entity_hierarchy()
 
 
 class Topic(models.Model):
@@ -610,6 +615,8 @@ class Geo(models.Model):
 
 class TopicTagRuleSet(models.Model):
     name = CharField(_("Name"), max_length=255)
+    # the start of the last run over all the topics, see tasks.run_topic_tag_ruleset
+    last_run = DateTimeField(_("Last Run"), blank=True, null=True)
 
     def __str__(self):
         return self.name
@@ -643,11 +650,38 @@ def ensure_crate_entity_table():
               "id" STRING,
               "dis" STRING
            ),
+           "first_seen" TIMESTAMP,
            PRIMARY KEY ("topic")
         );"""
         c.execute(sql)
 
 
+def ensure_crate_topic_first_seen():
+    # the time a topic was first seen by a rule set run, missing from the topic tables created by VOLTTRON
+    with connections['crate'].cursor() as c:
+        c.execute("""ALTER TABLE "topic" ADD COLUMN "first_seen" TIMESTAMP;""")
+
+
+def ensure_crate_rollup_tables():
+    # the hourly and daily pre-aggregated data, see utils.update_rollups
+    with connections['crate'].cursor() as c:
+        for table in ['data_rollup_hour', 'data_rollup_day']:
+            sql = """
+            CREATE TABLE IF NOT EXISTS "{}" (
+               "topic" STRING,
+               "ts" TIMESTAMP,
+               "min_value" DOUBLE,
+               "max_value" DOUBLE,
+               "avg_value" DOUBLE,
+               "sum_value" DOUBLE,
+               "value_count" LONG,
+               "last_value" DOUBLE,
+               "last_ts" TIMESTAMP,
+               PRIMARY KEY ("topic", "ts")
+            ) CLUSTERED BY ("topic");""".format(table)
+            c.execute(sql)
+
+
 def kv_tags_update_crate_entity_string(kv_tags, params_list):
     res = '{'
     first = True
@@ -679,13 +713,18 @@ def delete_tags_from_crate_entity(row):
         logging.warning('Crate database unavailable')
 
 
-def sync_tags_to_crate_entity(row, retried=False):
+def crate_entity_topic(row):
     # we sync points, sites and equipment
     topic = row.topic
     if not topic:
         if row.m_tags and ('site' in row.m_tags or 'equip' in row.m_tags):
             if row.kv_tags:
                 topic = row.kv_tags['id']
+    return topic
+
+
+def sync_tags_to_crate_entity(row, retried=False):
+    topic = crate_entity_topic(row)
     if not topic:
         logger.info('sync_tags_to_crate_entity topic or id is empty: %s', row)
         return
@@ -723,8 +762,59 @@ def sync_tags_to_crate_entity(row, retried=False):
                 logger.info('sync_tags_to_crate_entity SQL: %s', sql)
                 logger.info('sync_tags_to_crate_entity Params: %s', params_list)
                 c.execute(sql, params_list)
+                if row.kv_tags:
+                    add_crate_tag_columns(row.kv_tags.keys())
+    except OperationalError:
+        logging.warning('Crate database unavailable')
+
+
+# number of rows given to each executemany when syncing the tags in bulk
+CRATE_SYNC_BATCH_SIZE = 1000
+
+
+def sync_tags_to_crate_entities(rows, retried=False):
+    # bulk version of sync_tags_to_crate_entity, used when the entities were updated without
+    # saving them one by one: the rows having the same tag names are upserted with one statement
+    groups = {}
+    for row in rows:
+        topic = crate_entity_topic(row)
+        if not topic:
+            continue
+        kv_keys = tuple(sorted(row.kv_tags.keys())) if row.kv_tags else ()
+        groups.setdefault((kv_keys, bool(row.m_tags)), []).append((topic, row))
+
+    try:
+        with connections['crate'].cursor() as c:
+            for (kv_keys, with_m_tags), group in groups.items():
+                columns = ['topic']
+                values = ['%s']
+                if kv_keys:
+                    columns.append('kv_tags')
+                    values.append('{' + ', '.join(['"{}" = CAST(%s AS STRING)'.format(k) for k in kv_keys]) + '}')
+                if with_m_tags:
+                    columns.append('m_tags')
+                    values.append('%s')
+                # like sync_tags_to_crate_entity, empty tags are left as they are
+                updates = ['{0} = excluded.{0}'.format(col) for col in columns[1:]]
+                sql = """INSERT INTO "topic" ({}) VALUES ({}) ON CONFLICT (topic) DO {};""".format(
+                    ', '.join(columns), ', '.join(values), 'UPDATE SET ' + ', '.join(updates) if updates else 'NOTHING')
+                params = []
+                for topic, row in group:
+                    p = [topic] + [row.kv_tags[k] for k in kv_keys]
+                    if with_m_tags:
+                        p.append(row.m_tags)
+                    params.append(p)
+                for i in range(0, len(params), CRATE_SYNC_BATCH_SIZE):
+                    c.executemany(sql, params[i:i + CRATE_SYNC_BATCH_SIZE])
+                add_crate_tag_columns(kv_keys)
     except OperationalError:
         logging.warning('Crate database unavailable')
+    except DatabaseError as e:
+        # could be the table is missing
+        if 'RelationUnknown' in str(e) and not retried:
+            ensure_crate_entity_table()
+            return sync_tags_to_crate_entities(rows, retried=True)
+        raise
 
 
 class Status(models.Model):
@@ -0,0 +1,78 @@
+# This file is part of opentaps Smart Energy Applications Suite (SEAS).
+
+# opentaps Smart Energy Applications Suite (SEAS) is free software:
+# you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# opentaps Smart Energy Applications Suite (SEAS) is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public License
+# along with opentaps Smart Energy Applications Suite (SEAS).
+# If not, see <https://www.gnu.org/licenses/>.
+
+import logging
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections
+
+logger = logging.getLogger(__name__)
+
+# the registry of the kv_tags sub columns of the Crate topic table, since filtering
+# on a tag that was never synced to Crate fails
+TAG_COLUMNS_CACHE_KEY = 'crate_tag_columns'
+
+# (expiry, set of tag names) in this process
+_tag_columns = None
+
+
+def _query_tag_columns():
+    tags = set()
+    with connections['crate'].cursor() as c:
+        sql = """SELECT column_name from information_schema.columns
+                 WHERE table_name = 'topic' and column_name like 'kv_tags[%';"""
+        c.execute(sql)
+        for (cn, ) in c:
+            # extract the tag name from "kv_tags['tag_name']"
+            tags.add(cn[9:-2])
+    logger.info('Found %s tag columns in Crate', len(tags))
+    return tags
+
+
+def get_crate_tag_columns():
+    # returns the set of tag names, cached in process and in the Django cache for CRATE_TAG_COLUMNS_TTL seconds
+    global _tag_columns
+    ttl = settings.CRATE_TAG_COLUMNS_TTL
+    now = time.monotonic()
+    local = _tag_columns
+    if ttl and local and local[0] > now:
+        return local[1]
+
+    tags = cache.get(TAG_COLUMNS_CACHE_KEY) if ttl else None
+    if tags is None:
+        tags = _query_tag_columns()
+        if ttl:
+            cache.set(TAG_COLUMNS_CACHE_KEY, tags, ttl)
+    _tag_columns = (now + ttl, tags)
+    return tags
+
+
+def add_crate_tag_columns(tags):
+    # called after syncing the given tags to Crate: when one of them is new the registry is
+    # cleared so it is read again on the next filter, other processes get it when their copy expires
+    global _tag_columns
+    tags = set(tags)
+    local = _tag_columns
+    if local and tags.issubset(local[1]):
+        return
+    cached = cache.get(TAG_COLUMNS_CACHE_KEY)
+    if cached is not None and tags.issubset(cached):
+        return
+    _tag_columns = None
+    cache.delete(TAG_COLUMNS_CACHE_KEY)
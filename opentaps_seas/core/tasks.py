@@ -0,0 +1,191 @@
+# This file is part of opentaps Smart Energy Applications Suite (SEAS).
+
+# opentaps Smart Energy Applications Suite (SEAS) is free software:
+# you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# opentaps Smart Energy Applications Suite (SEAS) is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public License
+# along with opentaps Smart Energy Applications Suite (SEAS).
+# If not, see <https://www.gnu.org/licenses/>.
+
+import logging
+from io import StringIO
+from urllib.parse import urlencode
+from celery import shared_task
+from django.conf import settings
+from django.urls import reverse
+from django.utils import timezone
+from .celery import ProgressRecorder
+from .models import PointView
+from .models import TopicTagRuleSet
+from . import utils
+
+logger = logging.getLogger(__name__)
+
+
+@shared_task
+def refresh_current_values_task():
+    topics = PointView.objects.exclude(topic__isnull=True).exclude(topic='').values_list('topic', flat=True)
+    values = utils.refresh_current_values_cache(topics)
+    logger.info('refresh_current_values_task: refreshed %s topics', len(values))
+    return len(values)
+
+
+@shared_task
+def update_rollups_task():
+    hours, days = utils.update_rollups()
+    logger.info('update_rollups_task: updated %s hourly and %s daily rollups', hours, days)
+    return hours, days
+
+
+@shared_task
+def run_new_topics_tag_rulesets_task():
+    # apply the rule sets to the topics first seen since their last run,
+    # only those already run once so the draft rule sets are not applied to all the topics
+    count = 0
+    for ruleset_id in TopicTagRuleSet.objects.filter(last_run__isnull=False).values_list('id', flat=True):
+        try:
+            updated_set = run_topic_tag_ruleset({'ruleset_id': ruleset_id, 'new_topics_only': True})[0]
+        except Exception:
+            logger.exception('run_new_topics_tag_rulesets_task: could not run rule set %s', ruleset_id)
+            continue
+        count += len(updated_set)
+    logger.info('run_new_topics_tag_rulesets_task: updated %s topics', count)
+    return count
+
+
+@shared_task(bind=True)
+def run_topic_tag_ruleset_task(self, kwargs):
+    ruleset_id = kwargs.get('ruleset_id')
+    preview_type = kwargs.get('preview_type')
+    obs = ProgressRecorder(
+        self,
+        name="Previewing Topic Tag Rule Set" if preview_type else "Running Topic Tag Rule Set",
+        skip_url=reverse("core:topictagruleset_detail", kwargs={'id': ruleset_id}),
+        skip_label='View Rule Set',
+        back_url=reverse("core:topictagruleset_run", kwargs={'id': ruleset_id}))
+    kwargs['progress_observer'] = obs
+    updated_set, updated_entities, preview_type, updated_tags, removed_tags, diff_format, new_equipments = \
+        run_topic_tag_ruleset(kwargs)
+
+    if not preview_type:
+        obs.extra.update({'name': 'Updated {} Topics and created {} Equipments'.format(
+            len(updated_set), len(new_equipments))})
+        return {
+            'result': {'updated': len(updated_set), 'new_equipments': len(new_equipments)},
+            'extra': obs.extra
+            }
+
+    # store the report until it is viewed or downloaded
+    obs.set_progress(1, 1, description='Writing the report ...')
+    name = 'Tag Rulesets Preview Diff Report' if diff_format else 'Tag Rulesets Preview Report'
+    f = StringIO()
+    has_rows = utils.write_tag_rulesets_report(f, updated_entities, updated_tags, removed_tags,
+                                               diff_format=diff_format,
+                                               mark_changes=preview_type != 'preview_csv')
+    if not has_rows:
+        obs.extra.update({'name': 'Preview diff is empty'})
+        return {
+            'result': None,
+            'extra': obs.extra
+            }
+    token = utils.store_report(f.getvalue(), token=self.request.id)
+    params = '?' + urlencode({'report': token, 'name': name})
+    if preview_type == 'preview_csv':
+        obs.extra.update({'success_url': reverse("core:report_download_csv") + params,
+                          'success_label': 'Download Report'})
+    else:
+        obs.extra.update({'success_url': reverse("core:report_preview_csv") + params,
+                          'success_label': 'View Report'})
+    return {
+        'result': token,
+        'extra': obs.extra
+        }
+
+
+def _rule_filters(rule, topic_filter=None):
+    # the rule filters with the topic_filter if given
+    rule_filters = list(rule.filters or [])
+    if topic_filter:
+        rule_filters.append({'type': 'c', 'value': topic_filter})
+    return rule_filters
+
+
+def run_topic_tag_ruleset(kwargs):
+    # run or preview the rules of the rule set, optionally restricted to the topics matching topic_filter
+    # and / or to the topics first seen since the last run with new_topics_only
+    topic_filter = kwargs.get('topic_filter')
+    new_topics_only = kwargs.get('new_topics_only')
+    ruleset_id = kwargs.get('ruleset_id')
+    preview_type = kwargs.get('preview_type')
+    diff_format = kwargs.get('diff_format')
+    progress_observer = kwargs.get('progress_observer')
+    pretend = False
+    if preview_type:
+        pretend = True
+
+    logger.info('run_topic_tag_ruleset: for set %s and additional filter: %s, pretend: %s, new topics only: %s',
+                ruleset_id, topic_filter, pretend, new_topics_only)
+    rule_set = TopicTagRuleSet.objects.get(id=ruleset_id)
+    rules = list(rule_set.topictagrule_set.all())
+    # the topics added after this are for the next run
+    run_time = timezone.now()
+    utils.stamp_new_topics(run_time)
+    # the first run sees all the topics
+    since = rule_set.last_run if new_topics_only else None
+    new_topics = None
+    # the rules are evaluated together in a single pass over the topics, up to each rule creating
+    # equipment since its action changes the tags seen by the next rules
+    segments = [[]]
+    for rule in rules:
+        segments[-1].append(rule)
+        if rule.action and rule.action_fields and not pretend:
+            segments.append([])
+    # when running, each rule sees the tags set by the previous ones once synced to Crate
+    evolving = not pretend and settings.CRATE_TAG_AUTOSYNC
+
+    # collect count of topics we ran for
+    updated_set = set()
+    updated_entities = {}
+    updated_tags = {}
+    removed_tags = {}
+    new_equipments = []
+    done = 0
+    for segment in segments:
+        if not segment:
+            continue
+        if progress_observer:
+            progress_observer.set_progress(done, len(rules), description='Rules {} to {} ...'.format(
+                segment[0].name, segment[-1].name))
+        tag_rules = [(_rule_filters(rule, topic_filter), rule.tags) for rule in segment if rule.tags]
+        if tag_rules:
+            new_ids = {}
+            matches = utils.evaluate_topic_rules(tag_rules, evolving=evolving, since=since, new_ids=new_ids)
+            if pretend:
+                updated_set.update(utils.preview_topic_rules(tag_rules, matches, updated_entities,
+                                                             updated_tags, removed_tags))
+            else:
+                for x in utils.apply_topic_rules(tag_rules, matches, new_ids=new_ids):
+                    updated_set.add(x.get('topic'))
+
+        rule = segment[-1]
+        if rule.action and rule.action_fields and not pretend:
+            if rule.action == 'create equipment':
+                if since and new_topics is None:
+                    new_topics = set(str(t) for t, _, _ in utils.iter_topic_rows(since=since))
+                new_equipments = utils.create_equipment_action(_rule_filters(rule, topic_filter), rule.action_fields,
+                                                               topics=new_topics)
+        done += len(segment)
+
+    # a run restricted by topic_filter did not see all the new topics
+    if not pretend and not topic_filter:
+        TopicTagRuleSet.objects.filter(id=rule_set.id).update(last_run=run_time)
+
+    return updated_set, updated_entities, preview_type, updated_tags, removed_tags, diff_format, new_equipments
@@ -122,6 +122,8 @@ urlpatterns = [
     path("equipment_dashboard/<path:equip>", view=equipment.equipment_dashboard, name="equipment_dashboard"),
     path("equipment_points_table/<path:equip>",
          view=equipment.equipment_data_points_table, name="equipment_data_points_table"),
+    path("equipment_points_matrix/<path:equip>",
+         view=equipment.equipment_points_matrix_json, name="equipment_points_matrix_json"),
     path("site/<str:site>/newequipment/", view=equipment.equipment_create_view, name="equipment_create"),
     path("", view=site.site_list_view, name="site_list_default"),
     path("site/", view=site.site_list_view, name="site_list"),
@@ -146,6 +148,7 @@ urlpatterns = [
     path("timezone.json/<str:geo_id>", view=common.timezone_list_json_view, name="timezone_list_json"),
     path("bacnet_prefix.json/<str:site>", view=point.bacnet_prefix_list_json_view, name="bacnet_prefix_list_json"),
     path("report/preview/csv", view=topic.report_preview_csv_view, name="report_preview_csv"),
+    path("report/download/csv", view=topic.report_download_csv, name="report_download_csv"),
     path("meter/production/json/<path:meter>",
          view=meter.meter_production_data_json, name="meter_production_data_json"),
     path("meter/financial_value/json/<path:meter>",
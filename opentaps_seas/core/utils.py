@@ -15,16 +15,20 @@
 # along with opentaps Smart Energy Applications Suite (SEAS).
 # If not, see <https://www.gnu.org/licenses/>.
 
+import csv
 import logging
 import eeweather
 import geocoder
 import hashlib
 import json
 import numpy
+import operator
 import pytz
 import requests
 import re
+import uuid
 from math import isnan
+from .hierarchy import invalidate_entity_hierarchy
 from .models import Entity
 from .models import EquipmentView
 from .models import PointView
@@ -38,6 +42,10 @@ from .models import MeterRatePlan
 from .models import ModelView
 from .models import WeatherHistory
 from .models import WeatherStation
+from .models import ensure_crate_topic_first_seen
+from .models import sync_tags_to_crate_entities
+from .tag_columns import get_crate_tag_columns
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from datetime import timedelta
 from datetime import timezone
@@ -45,7 +53,11 @@ from pytz import all_timezones
 from pytz import UnknownTimeZoneError
 from pytz import timezone as pytz_timezone
 from dateutil.parser import parse as parse_datetime
+from django.core.cache import cache
+from django.db import connection
 from django.db import connections
+from django.db import transaction
+from django.db import DatabaseError
 from django.db import OperationalError
 from django.db.models import Q
 from django.urls import reverse
@@ -90,24 +102,17 @@ def format_epoch(ts):
     return {'epoch': ts, 'fmttime': fmttime, 'time': time}
 
 
-def get_current_value_dict(point):
-    result = None
-    with connections['crate'].cursor() as c:
-        sql = """SELECT ts, string_value FROM "data" WHERE topic = %s ORDER BY ts DESC LIMIT 1;"""
-        c.execute(sql, [point.topic])
-        for record in c:
-            result = record
+# maximum number of topics in a single latest values query
+CURRENT_VALUES_BATCH_SIZE = 500
 
-    if not result:
-        return None
-    ts = result[0]
-    string_value = result[1]
+
+def format_current_value_dict(point, ts, string_value, fetched_epoch=None):
     epoch = int(ts.timestamp() * 1000)
     t = format_epoch(epoch)
     time = t['time']
     fmttime = t['fmttime']
     if point.kind == 'Bool':
-        return {'value': string_value == 't' or string_value != '0', 'fmttime': fmttime, 'time': time, 'epoch': epoch}
+        d = {'value': string_value == 't' or string_value != '0', 'fmttime': fmttime, 'time': time, 'epoch': epoch}
     else:
         if point.kind == 'Number' and (point.unit == '°F' or point.unit == '°C'):
             try:
@@ -117,27 +122,154 @@ def get_current_value_dict(point):
             except Exception:
                 pass
         if point.unit:
-            return {'value': string_value, 'epoch': epoch, 'fmttime': fmttime, 'time': time, 'unit': point.unit}
+            d = {'value': string_value, 'epoch': epoch, 'fmttime': fmttime, 'time': time, 'unit': point.unit}
         else:
-            if point.kind == 'Number' and (point.unit == '°F' or point.unit == '°C'):
-                try:
-                    v = float(string_value)
-                    # use 1 after the dot for temperatures
-                    string_value = format(v, '.1f')
-                except Exception:
-                    pass
-            if point.unit:
-                return {'value': string_value, 'epoch': epoch, 'fmttime': fmttime, 'time': time, 'unit': point.unit}
-            else:
-                return {'value': string_value, 'epoch': epoch, 'fmttime': fmttime, 'time': time}
+            d = {'value': string_value, 'epoch': epoch, 'fmttime': fmttime, 'time': time}
+    if fetched_epoch:
+        # when the value was read from Crate, it can be older than the time of the request if it was cached
+        d['fetched_epoch'] = fetched_epoch
+    return d
 
 
-def get_current_value(point, raw=False):
-    d = get_current_value_dict(point)
+def _current_value_cache_key(topic):
+    return 'current_value:' + hashlib.md5(topic.encode('utf-8')).hexdigest()
+
+
+def map_concurrently(func, items, max_workers=None):
+    # returns [func(item) for item in items] running the calls in a bounded pool of threads,
+    # meant for independent Crate queries: each thread uses its own pooled connection, given back once done
+    # note: the threads do not see the request's uncommitted transaction on the default database
+    items = list(items)
+    if max_workers is None:
+        max_workers = settings.CRATE_QUERY_CONCURRENCY
+    if max_workers <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+
+    def run(item):
+        try:
+            return func(item)
+        finally:
+            connections.close_all()
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(items))) as executor:
+        return list(executor.map(run, items))
+
+
+def _query_latest_batch_values(topics, since=None):
+    # returns a dict of topic -> (ts, string_value) for the latest data of the given batch of topics
+    # this first finds the latest ts of each topic in a single grouped query, then fetch the matching values
+    results = {}
+    with connections['crate'].cursor() as c:
+        if since:
+            sql = """SELECT topic, MAX(ts) FROM "data" WHERE topic = ANY(%s) AND ts > %s GROUP BY topic;"""
+            c.execute(sql, [topics, since])
+        else:
+            sql = """SELECT topic, MAX(ts) FROM "data" WHERE topic = ANY(%s) GROUP BY topic;"""
+            c.execute(sql, [topics])
+        latest = {}
+        for topic, ts in c.fetchall():
+            if ts is not None:
+                latest[topic] = ts
+        if not latest:
+            return results
+        # several topics can share the same ts, so only keep the exact (topic, ts) matches
+        sql = """SELECT topic, ts, string_value FROM "data" WHERE topic = ANY(%s) AND ts = ANY(%s);"""
+        c.execute(sql, [list(latest.keys()), list(set(latest.values()))])
+        for topic, ts, string_value in c.fetchall():
+            if latest.get(topic) == ts:
+                results[topic] = (ts, string_value)
+    return results
+
+
+def _query_latest_topic_value(topic):
+    # returns the (ts, string_value) of the latest data of the topic, or None
+    with connections['crate'].cursor() as c:
+        sql = """SELECT ts, string_value FROM "data" WHERE topic = %s ORDER BY ts DESC LIMIT 1;"""
+        c.execute(sql, [topic])
+        result = c.fetchone()
+    if result:
+        return (result[0], result[1])
+    return None
+
+
+def _query_latest_topics_values(topics):
+    # returns a dict of topic -> (ts, string_value) for the latest data of each topic
+    # the topics are batched by CURRENT_VALUES_BATCH_SIZE and the batches queried concurrently
+    # the grouped query only reads the last CURRENT_VALUE_LOOKBACK seconds of data, the topics
+    # without data in that window are then queried one by one for their last value, also concurrently
+    results = {}
+    lookback = settings.CURRENT_VALUE_LOOKBACK
+    since = datetime.utcnow() - timedelta(seconds=lookback) if lookback else None
+    batches = [topics[i:i + CURRENT_VALUES_BATCH_SIZE] for i in range(0, len(topics), CURRENT_VALUES_BATCH_SIZE)]
+    for batch_results in map_concurrently(lambda batch: _query_latest_batch_values(batch, since=since), batches):
+        results.update(batch_results)
+    if since:
+        missing = [t for t in topics if t not in results]
+        for topic, result in zip(missing, map_concurrently(_query_latest_topic_value, missing)):
+            if result:
+                results[topic] = result
+    return results
+
+
+def refresh_current_values_cache(topics):
+    # query the latest values of the given topics and write them in the cache
+    # returns a dict of topic -> (ts, string_value, fetched_epoch), where ts and string_value
+    # are None if the topic has no data
+    topics = list(set([t for t in topics if t]))
+    if not topics:
+        return {}
+    latest = _query_latest_topics_values(topics)
+    fetched_epoch = int(datetime.now(timezone.utc).timestamp() * 1000)
+    values = {}
+    for topic in topics:
+        ts, string_value = latest.get(topic, (None, None))
+        values[topic] = (ts, string_value, fetched_epoch)
+    ttl = settings.CURRENT_VALUE_CACHE_TTL
+    if ttl:
+        cache.set_many({_current_value_cache_key(t): v for t, v in values.items()}, ttl)
+    return values
+
+
+def get_latest_topics_values(topics):
+    # returns a dict of topic -> (ts, string_value, fetched_epoch) for the latest data of each topic
+    # reading from the cache first and only querying Crate for the topics not cached
+    topics = list(set([t for t in topics if t]))
+    if not topics:
+        return {}
+    results = {}
+    if settings.CURRENT_VALUE_CACHE_TTL:
+        keys = {_current_value_cache_key(t): t for t in topics}
+        for k, v in cache.get_many(list(keys.keys())).items():
+            results[keys[k]] = v
+    missing = [t for t in topics if t not in results]
+    if missing:
+        results.update(refresh_current_values_cache(missing))
+    return {t: v for t, v in results.items() if v[0] is not None}
+
+
+def get_current_values(points):
+    # returns the list of current value dicts (or None) matching the given list of points
+    points = list(points)
+    latest = get_latest_topics_values([p.topic for p in points])
+    results = []
+    for point in points:
+        v = latest.get(point.topic)
+        if v:
+            results.append(format_current_value_dict(point, v[0], v[1], fetched_epoch=v[2]))
+        else:
+            results.append(None)
+    return results
+
+
+def get_current_value_dict(point):
+    return get_current_values([point])[0]
+
+
+def format_current_value(point, d, raw=False):
     if not d:
         return None
 
-    logger.info("get_current_value %s -- %s", point, d)
+    logger.info("format_current_value %s -- %s", point, d)
     value = d['value']
     if raw:
         return d
@@ -155,14 +287,19 @@ def get_current_value(point, raw=False):
                                (value, d['time'], d['fmttime']), )
 
 
+def get_current_value(point, raw=False):
+    return format_current_value(point, get_current_value_dict(point), raw=raw)
+
+
 def add_current_values(data, raw=False):
     d2 = list(data)
-    for d in d2:
-        cv = None
-        try:
-            cv = get_current_value(d, raw=raw)
-        except OperationalError:
-            logging.warning('Crate database unavailable')
+    current_values = [None] * len(d2)
+    try:
+        current_values = get_current_values(d2)
+    except OperationalError:
+        logging.warning('Crate database unavailable')
+    for d, v in zip(d2, current_values):
+        cv = format_current_value(d, v, raw=raw)
         if not cv:
             if raw:
                 cv = {}
@@ -173,14 +310,21 @@ def add_current_values(data, raw=False):
 
 
 def get_ahu_current_values(equipment_id):
-    # this find the data points and current values for:
+    results = get_ahu_points(equipment_id)
+    # fetch all the current values at once
+    add_current_values(results.values(), raw=True)
+    return results
+
+
+def get_ahu_points(equipment_id):
+    # this find the data points for:
     # Space Air Temp:  {air,his,point,zone,sensor,temp}
     # Return Air Temp: {air,his,point,return,sensor,temp}
     # Supply Fan Speed - {air,discharge,fan,his,point,sensor,speed}
     # Cooling -  {cooling,his,point,sensor}
     # Heating - {heat,his,point,sensor}
     # CO2 - {co2,his,point,sensor,zone}
-    # -> those are returned in a dictionary 'Point Name': {<current_data>}
+    # -> those are returned in a dictionary 'Point Name': <point>
     q = {
         'Space Air Temp': {
             'has': ['air', 'his', 'point', 'zone', 'sensor', 'temp'],
@@ -215,7 +359,7 @@ def get_ahu_current_values(equipment_id):
                 p = pl
             p = p[0]
             logger.warning('get_ahu_current_values using point: %s', p)
-            results[n] = add_current_values([p], raw=True)[0]
+            results[n] = p
     return results
 
 
@@ -260,52 +404,592 @@ def get_start_date_from_range(trange, from_datetime=None):
     return start, end
 
 
-def get_point_values(d, date_trunc=DEFAULT_RES, value_func='avg', trange=DEFAULT_RANGE, ts_as_datetime=False):
-    # validate the date_trunc
-    if date_trunc not in ['day', 'hour', 'minute', 'second']:
-        date_trunc = DEFAULT_RES
-    # use different queries for Number type sensors
-    is_number = 'Number' == d.kind
-    is_bool = 'Bool' == d.kind
+# approximate duration in seconds of each DATE_TRUNC bucket, from finest to coarsest
+RESOLUTIONS = [
+    ('second', 1),
+    ('minute', 60),
+    ('hour', 3600),
+    ('day', 86400),
+    ('week', 604800),
+    ('month', 2592000),
+    ('year', 31536000),
+]
+RESOLUTION_SECONDS = dict(RESOLUTIONS)
+DOWNSAMPLE_METHODS = ['minmax', 'lttb']
+POINT_VALUES_CHUNK_SIZE = 10000
+# the pre-aggregated Crate tables, see models.ensure_crate_rollup_tables
+ROLLUP_TABLES = {'hour': 'data_rollup_hour', 'day': 'data_rollup_day'}
+# how to aggregate the rollup columns for each supported value_func
+ROLLUP_VALUE_FUNCS = {
+    'avg': 'SUM(sum_value) / SUM(value_count)',
+    'min': 'MIN(min_value)',
+    'max': 'MAX(max_value)',
+    'sum': 'SUM(sum_value)',
+    'count': 'SUM(value_count)',
+}
+# size of the raw data time windows aggregated at once when updating the rollups
+ROLLUP_WINDOW = timedelta(days=1)
+
+
+def get_resolution_for_max_points(start, end, max_points, date_trunc=DEFAULT_RES):
+    # returns the finest resolution, not finer than the given date_trunc,
+    # where the number of buckets in the range fits in max_points
+    if not max_points or max_points < 1:
+        return date_trunc
+    duration = max((end - start).total_seconds(), 0)
+    min_seconds = RESOLUTION_SECONDS.get(date_trunc, 0)
+    for res, seconds in RESOLUTIONS:
+        if seconds < min_seconds:
+            continue
+        # count one extra bucket for the partial bucket at the start of the range
+        if duration // seconds + 1 <= max_points:
+            return res
+    return RESOLUTIONS[-1][0]
 
-    start, end = get_start_date_from_range(trange)
 
-    logger.info("Getting data points for range %s -- %s", start, end)
+def parse_max_points(max_points):
+    if not max_points:
+        return None
+    try:
+        max_points = int(max_points)
+    except ValueError:
+        logger.warning('Invalid max_points %s', max_points)
+        return None
+    if max_points < 1:
+        return None
+    return max_points
+
+
+def downsample_stride(data, max_points):
+    # keeps every n-th value, always keeping the last one
+    if len(data) <= max_points:
+        return data
+    return [data[i] for i in _downsample_stride_indexes(len(data), max_points)]
+
+
+def downsample_minmax(data, max_points):
+    # split the series into max_points // 2 buckets and keep the min and max
+    # value of each bucket, in their original order
+    if len(data) <= max_points or max_points // 2 < 1:
+        return data
+    values = numpy.array([x[1] for x in data], dtype=numpy.float64)
+    return [data[i] for i in _downsample_minmax_indexes(values, max_points)]
+
+
+def downsample_lttb(data, max_points):
+    # Largest-Triangle-Three-Buckets: keeps the first and last values and
+    # in each bucket selects the value forming the largest triangle with
+    # the previously selected value and the average of the next bucket
+    if len(data) <= max_points or max_points < 3:
+        return data
+    ts = numpy.array([x[0] for x in data], dtype=numpy.float64)
+    values = numpy.array([x[1] for x in data], dtype=numpy.float64)
+    return [data[i] for i in _downsample_lttb_indexes(ts, values, max_points)]
+
+
+def _downsample_stride_indexes(n, max_points):
+    indexes = (numpy.arange(max_points - 1) * (n / max_points)).astype(numpy.int64)
+    return numpy.append(indexes, n - 1)
+
 
-    if is_number:
+def _downsample_minmax_indexes(values, max_points):
+    n_buckets = max_points // 2
+    size = len(values) / n_buckets
+    indexes = []
+    for i in range(n_buckets):
+        start = int(i * size)
+        end = int((i + 1) * size)
+        if start >= end:
+            continue
+        bucket = values[start:end]
+        lo = start + int(numpy.argmin(bucket))
+        hi = start + int(numpy.argmax(bucket))
+        indexes.extend(sorted(set([lo, hi])))
+    return numpy.array(indexes, dtype=numpy.int64)
+
+
+def _downsample_lttb_indexes(ts, values, max_points):
+    n = len(ts)
+    size = (n - 2) / (max_points - 2)
+    indexes = numpy.empty(max_points, dtype=numpy.int64)
+    indexes[0] = 0
+    indexes[-1] = n - 1
+    a = 0
+    for i in range(max_points - 2):
+        start = int(i * size) + 1
+        end = int((i + 1) * size) + 1
+        next_end = min(int((i + 2) * size) + 1, n)
+        if end < next_end:
+            avg_x = ts[end:next_end].mean()
+            avg_y = values[end:next_end].mean()
+        else:
+            avg_x = ts[-1]
+            avg_y = values[-1]
+        ax = ts[a]
+        ay = values[a]
+        areas = numpy.abs((ax - avg_x) * (values[start:end] - ay) - (ax - ts[start:end]) * (avg_y - ay))
+        a = start + int(numpy.argmax(areas))
+        indexes[i + 1] = a
+    return indexes
+
+
+def downsample_values(data, max_points, method=None):
+    if not max_points or len(data) <= max_points:
+        return data
+    if method in DOWNSAMPLE_METHODS:
+        # those only work on numeric values
+        if all(isinstance(x[1], (int, float)) for x in data):
+            if method == 'lttb':
+                return downsample_lttb(data, max_points)
+            return downsample_minmax(data, max_points)
+    return downsample_stride(data, max_points)
+
+
+def downsample_arrays(ts, values, max_points, method=None):
+    # same as downsample_values for the arrays of point_rows_to_arrays,
+    # the series with missing values are downsampled by stride
+    n = len(ts)
+    if not max_points or n <= max_points:
+        return ts, values
+    if method in DOWNSAMPLE_METHODS and not numpy.isnan(values).any():
+        if method == 'lttb':
+            if max_points < 3:
+                return ts, values
+            indexes = _downsample_lttb_indexes(ts.astype(numpy.float64), values, max_points)
+        else:
+            if max_points // 2 < 1:
+                return ts, values
+            indexes = _downsample_minmax_indexes(values, max_points)
+    else:
+        indexes = _downsample_stride_indexes(n, max_points)
+    return ts[indexes], values[indexes]
+
+
+def _point_values_sql(d, date_trunc, value_func, order='DESC', limit=False, raw_column='string_value',
+                      window=False, since=False):
+    # use different queries for Number type sensors,
+    # with window the queries take two more parameters restricting ts to [window start, window end)
+    # and with since one more parameter for the lowest ts, the raw values are then also ordered by source
+    where = "topic = %s AND ts > %s AND ts <= %s"
+    if window:
+        where += " AND ts >= %s AND ts < %s"
+    if since:
+        where += " AND ts >= %s"
+    if 'Number' == d.kind:
         sql = """SELECT DATE_TRUNC('{}', ts) as timest, {}(double_value) FROM "data"
-                 WHERE topic = %s AND ts > %s AND ts <= %s
-                 GROUP BY timest ORDER BY timest DESC;""".format(date_trunc, value_func)
-    elif is_bool:
+                 WHERE {}
+                 GROUP BY timest ORDER BY timest {}""".format(date_trunc, value_func, where, order)
+    elif 'Bool' == d.kind:
         # use MIN as function since we query string_value
         sql = """SELECT DATE_TRUNC('{}', ts) as timest, MIN(string_value), {}(double_value) FROM "data"
-                 WHERE topic = %s AND ts > %s AND ts <= %s
-                 GROUP BY timest ORDER BY timest DESC;""".format(date_trunc, value_func)
+                 WHERE {}
+                 GROUP BY timest ORDER BY timest {}""".format(date_trunc, value_func, where, order)
     else:
-        sql = """SELECT ts, string_value FROM "data"
-                 WHERE topic = %s AND ts > %s AND ts <= %s ORDER BY ts DESC;"""
+        sql = """SELECT ts, {} FROM "data"
+                 WHERE {} ORDER BY ts {}""".format(raw_column, where, order)
+        if since:
+            sql += ", source {}".format(order)
+    if limit:
+        sql += " LIMIT %s"
+    return sql + ";"
+
+
+def _point_value_from_row(result, is_bool):
+    value = result[1]
+    if is_bool:
+        if value and (value == 't' or value != '0'):
+            value = 1
+        else:
+            value = round(result[2])
+    return value
 
-    data = []
-    with connections['crate'].cursor() as cursor:
-        cursor.execute(sql, [d.topic, start, end])
+
+def to_epoch_ms(ts):
+    if hasattr(ts, 'timestamp'):
+        if not ts.tzinfo:
+            ts = ts.replace(tzinfo=timezone.utc)
+        return int(ts.timestamp() * 1000)
+    return int(ts)
+
+
+def iter_point_values(d, date_trunc=DEFAULT_RES, value_func='avg', trange=DEFAULT_RANGE,
+                      chunk_size=POINT_VALUES_CHUNK_SIZE):
+    # yield the [ts, value] of the point in ascending time order without loading the whole series:
+    # Crate is queried page by page so memory stays bounded by chunk_size
+    if date_trunc not in ['day', 'hour', 'minute', 'second']:
+        date_trunc = DEFAULT_RES
+    start, end = get_start_date_from_range(trange)
+    logger.info("Streaming data points for range %s -- %s at %s", start, end, date_trunc)
+
+    if d.kind not in ['Number', 'Bool']:
+        # raw values: keyset on ts, several sources can write the same ts so the next page starts at the
+        # last returned ts and skips the rows at that ts already returned
+        sql = _point_values_sql(d, date_trunc, value_func, order='ASC', limit=True, since=True)
+        since = start
+        skip = 0
         while True:
+            with connections['crate'].cursor() as cursor:
+                cursor.execute(sql, [d.topic, start, end, since, chunk_size + skip])
+                rows = cursor.fetchmany(chunk_size + skip)
+            for result in rows[skip:]:
+                yield [result[0], _point_value_from_row(result, False)]
+            if len(rows) < chunk_size + skip:
+                break
+            last_ts = rows[-1][0]
+            skip = sum(1 for result in rows if result[0] == last_ts)
+            since = datetime(1970, 1, 1) + timedelta(milliseconds=to_epoch_ms(last_ts))
+        return
+
+    # aggregated values: each page only aggregates a window of chunk_size buckets, aligned on the buckets
+    # so none is split across pages, and starting at the bucket of the next sample to skip the gaps
+    is_bool = 'Bool' == d.kind
+    bucket_ms = RESOLUTION_SECONDS[date_trunc] * 1000
+    sql = _point_values_sql(d, date_trunc, value_func, order='ASC', window=True)
+    next_sql = """SELECT MIN(ts) FROM "data" WHERE topic = %s AND ts > %s AND ts >= %s AND ts <= %s;"""
+    since = start
+    while True:
+        with connections['crate'].cursor() as cursor:
+            cursor.execute(next_sql, [d.topic, start, since, end])
             result = cursor.fetchone()
-            if result is None:
+            if not result or result[0] is None:
                 break
-            ts = result[0]
-            value = result[1]
-            if is_bool:
-                if value and (value == 't' or value != '0'):
-                    value = 1
+            window_start_ms = to_epoch_ms(result[0]) // bucket_ms * bucket_ms
+            window_start = datetime.utcfromtimestamp(window_start_ms / 1000)
+            since = datetime.utcfromtimestamp((window_start_ms + chunk_size * bucket_ms) / 1000)
+            cursor.execute(sql, [d.topic, start, end, window_start, since])
+            rows = cursor.fetchall()
+        for result in rows:
+            yield [result[0], _point_value_from_row(result, is_bool)]
+
+
+def get_rollup_for_resolution(d, date_trunc, value_func):
+    # returns the rollup ('hour' or 'day') that can serve the given query or None
+    # when the raw data must be used
+    if not settings.CRATE_ROLLUPS or 'Number' != d.kind or value_func.lower() not in ROLLUP_VALUE_FUNCS:
+        return None
+    seconds = RESOLUTION_SECONDS.get(date_trunc, 0)
+    if seconds >= RESOLUTION_SECONDS['day']:
+        return 'day'
+    if seconds >= RESOLUTION_SECONDS['hour']:
+        return 'hour'
+    return None
+
+
+def _truncate_datetime(dt, rollup):
+    dt = dt.replace(minute=0, second=0, microsecond=0)
+    if 'day' == rollup:
+        dt = dt.replace(hour=0)
+    return dt
+
+
+def _get_rollup_point_values(d, rollup, date_trunc, value_func, start, end):
+    # returns the [ts, value] in ascending order: completed buckets come from the rollup table
+    # and the buckets after its last (possibly partial) one from the raw data
+    table = ROLLUP_TABLES[rollup]
+    data = []
+    with connections['crate'].cursor() as c:
+        sql = """SELECT DATE_TRUNC('{}', MAX(ts)) FROM "{}" WHERE topic = %s AND ts <= %s;""".format(date_trunc, table)
+        c.execute(sql, [d.topic, end])
+        result = c.fetchone()
+        split = result[0] if result else None
+        if split is not None:
+            sql = """SELECT DATE_TRUNC('{}', ts) as timest, {} FROM "{}"
+                     WHERE topic = %s AND ts >= %s AND ts < %s AND value_count > 0
+                     GROUP BY timest ORDER BY timest ASC;""".format(
+                date_trunc, ROLLUP_VALUE_FUNCS[value_func.lower()], table)
+            c.execute(sql, [d.topic, _truncate_datetime(start, rollup), split])
+            data = [[r[0], r[1]] for r in c.fetchall()]
+            sql = """SELECT DATE_TRUNC('{}', ts) as timest, {}(double_value) FROM "data"
+                     WHERE topic = %s AND ts >= %s AND ts > %s AND ts <= %s
+                     GROUP BY timest ORDER BY timest ASC;""".format(date_trunc, value_func)
+            c.execute(sql, [d.topic, split, start, end])
+        else:
+            c.execute(_point_values_sql(d, date_trunc, value_func, order='ASC'), [d.topic, start, end])
+        data += [[r[0], r[1]] for r in c.fetchall()]
+    logger.info("Got %s data points for %s from the %s rollup", len(data), d.entity_id, rollup)
+    return data
+
+
+def _query_last_values(c, table, column, last_values):
+    # fill the last_values dict of (topic, ts) -> value with the value of each (topic, ts) from the table
+    keys = list(last_values.keys())
+    for i in range(0, len(keys), CURRENT_VALUES_BATCH_SIZE):
+        batch = keys[i:i + CURRENT_VALUES_BATCH_SIZE]
+        sql = """SELECT topic, {0}, {1} FROM "{2}" WHERE topic = ANY(%s) AND {0} = ANY(%s);""".format(
+            'ts' if 'data' == table else 'last_ts', column, table)
+        c.execute(sql, [list(set([k[0] for k in batch])), list(set([k[1] for k in batch]))])
+        for topic, ts, value in c.fetchall():
+            if (topic, ts) in last_values:
+                last_values[(topic, ts)] = value
+
+
+def _upsert_rollups(c, rollup, rows):
+    # rows are (topic, ts, min, max, sum, count, last_ts), the last values are looked up from
+    # the raw data for the hourly rollup or from the hourly rollup for the daily one
+    if not rows:
+        return 0
+    last_values = {(r[0], r[6]): None for r in rows if r[6] is not None}
+    if 'hour' == rollup:
+        _query_last_values(c, 'data', 'double_value', last_values)
+    else:
+        _query_last_values(c, ROLLUP_TABLES['hour'], 'last_value', last_values)
+    sql = """INSERT INTO "{}" (topic, ts, min_value, max_value, avg_value, sum_value, value_count, last_value, last_ts)
+             VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+             ON CONFLICT (topic, ts) DO UPDATE SET
+             min_value = excluded.min_value, max_value = excluded.max_value, avg_value = excluded.avg_value,
+             sum_value = excluded.sum_value, value_count = excluded.value_count,
+             last_value = excluded.last_value, last_ts = excluded.last_ts;""".format(ROLLUP_TABLES[rollup])
+    params = []
+    for topic, ts, min_value, max_value, sum_value, value_count, last_ts in rows:
+        avg_value = sum_value / value_count if value_count else None
+        params.append([topic, ts, min_value, max_value, avg_value, sum_value, value_count,
+                       last_values.get((topic, last_ts)), last_ts])
+    c.executemany(sql, params)
+    return len(params)
+
+
+def get_rollups_watermark():
+    # returns the start of the last hourly bucket rolled up, or None if the rollups are empty
+    with connections['crate'].cursor() as c:
+        c.execute("""SELECT MAX(ts) FROM "{}";""".format(ROLLUP_TABLES['hour']))
+        result = c.fetchone()
+    return result[0] if result else None
+
+
+def update_rollups(since=None, until=None):
+    # incrementally (re)compute the hourly then daily rollups of the raw data between since and until
+    # by default start again from the last hourly bucket, which may have been partial,
+    # or from the first raw data if the rollups are empty
+    # returns the number of hourly and daily rows written
+    if not until:
+        until = datetime.utcnow()
+    with connections['crate'].cursor() as c:
+        if since is None:
+            since = get_rollups_watermark()
+            if since is None:
+                c.execute("""SELECT MIN(ts) FROM "data";""")
+                result = c.fetchone()
+                since = result[0] if result else None
+            if since is None:
+                return 0, 0
+        if not isinstance(since, datetime):
+            since = datetime.utcfromtimestamp(to_epoch_ms(since) / 1000)
+        since = _truncate_datetime(since, 'hour')
+        logger.info("Updating rollups from %s to %s", since, until)
+
+        hours = 0
+        window_start = since
+        while window_start < until:
+            window_end = min(window_start + ROLLUP_WINDOW, until)
+            sql = """SELECT topic, DATE_TRUNC('hour', ts) as timest, MIN(double_value), MAX(double_value),
+                     SUM(double_value), COUNT(double_value), MAX(ts) FROM "data"
+                     WHERE ts >= %s AND ts < %s GROUP BY topic, timest;"""
+            c.execute(sql, [window_start, window_end])
+            hours += _upsert_rollups(c, 'hour', c.fetchall())
+            window_start = window_end
+        # make the new hourly rows visible before aggregating them
+        c.execute("""REFRESH TABLE "{}";""".format(ROLLUP_TABLES['hour']))
+
+        sql = """SELECT topic, DATE_TRUNC('day', ts) as timest, MIN(min_value), MAX(max_value),
+                 SUM(sum_value), SUM(value_count), MAX(last_ts) FROM "{}"
+                 WHERE ts >= %s AND ts < %s GROUP BY topic, timest;""".format(ROLLUP_TABLES['hour'])
+        c.execute(sql, [_truncate_datetime(since, 'day'), until])
+        days = _upsert_rollups(c, 'day', c.fetchall())
+        c.execute("""REFRESH TABLE "{}";""".format(ROLLUP_TABLES['day']))
+    logger.info("Updated %s hourly and %s daily rollups", hours, days)
+    return hours, days
+
+
+def _get_point_rows(d, date_trunc, value_func, start, end, raw_column='string_value'):
+    # returns the query result rows of the point in ascending order, fetched in bulk
+    rollup = get_rollup_for_resolution(d, date_trunc, value_func)
+    if rollup:
+        return _get_rollup_point_values(d, rollup, date_trunc, value_func, start, end)
+    sql = _point_values_sql(d, date_trunc, value_func, order='ASC', raw_column=raw_column)
+    with connections['crate'].cursor() as cursor:
+        cursor.execute(sql, [d.topic, start, end])
+        rows = cursor.fetchall()
+    logger.info("Got %s data points for %s", len(rows), d.entity_id)
+    return rows
+
+
+def _point_values_cache_key(d, date_trunc, value_func, trange):
+    key = '|'.join([d.topic, d.kind or '', date_trunc, value_func, trange or DEFAULT_RANGE])
+    return 'point_values:' + hashlib.md5(key.encode('utf-8')).hexdigest()
+
+
+def _get_point_rows_cached(d, date_trunc, value_func, trange, start, end):
+    # same as _get_point_rows but the rows are cached per topic, resolution, function and range
+    # so that repeated calls only query the data from the last cached bucket, which may have been partial,
+    # then drop the buckets that are now before the start of the range
+    ttl = settings.POINT_VALUES_CACHE_TTL
+    if not ttl:
+        return _get_point_rows(d, date_trunc, value_func, start, end)
+    key = _point_values_cache_key(d, date_trunc, value_func, trange)
+    # the entry is (created, rows) and the polls do not renew it, so once expired the whole range
+    # is queried again in case older buckets got late data
+    cached = cache.get(key)
+    now = datetime.now(timezone.utc).timestamp()
+    if cached is None or now - cached[0] >= ttl:
+        created = now
+        rows = list(_get_point_rows(d, date_trunc, value_func, start, end))
+    else:
+        created, rows = cached
+        if rows:
+            tail = to_epoch_ms(rows[-1][0])
+            new_rows = _get_point_rows(d, date_trunc, value_func, datetime.utcfromtimestamp((tail - 1) / 1000), end)
+        else:
+            new_rows = _get_point_rows(d, date_trunc, value_func, start, end)
+        if new_rows:
+            cut = to_epoch_ms(new_rows[0][0])
+            rows = [r for r in rows if to_epoch_ms(r[0]) < cut] + list(new_rows)
+        # a bucket is still in the range as long as it ends after the start
+        step = RESOLUTION_SECONDS[date_trunc] * 1000 if d.kind in ['Number', 'Bool'] else 0
+        first = to_epoch_ms(start) - step
+        rows = [r for r in rows if to_epoch_ms(r[0]) > first]
+    cache.set(key, (created, rows), max(int(created + ttl - now), 1))
+    return rows
+
+
+def _get_point_values_range(date_trunc, trange, max_points):
+    # validate the date_trunc
+    if date_trunc not in ['day', 'hour', 'minute', 'second']:
+        date_trunc = DEFAULT_RES
+
+    start, end = get_start_date_from_range(trange)
+
+    if max_points:
+        # use the coarsest resolution needed to fit the points budget
+        date_trunc = get_resolution_for_max_points(start, end, max_points, date_trunc=date_trunc)
+
+    logger.info("Getting data points for range %s -- %s at %s", start, end, date_trunc)
+    return date_trunc, start, end
+
+
+def get_point_values(d, date_trunc=DEFAULT_RES, value_func='avg', trange=DEFAULT_RANGE, ts_as_datetime=False,
+                     max_points=None, downsample=None, use_cache=False):
+    date_trunc, start, end = _get_point_values_range(date_trunc, trange, max_points)
+    is_bool = 'Bool' == d.kind
+    if use_cache:
+        rows = _get_point_rows_cached(d, date_trunc, value_func, trange, start, end)
+    else:
+        rows = _get_point_rows(d, date_trunc, value_func, start, end)
+    if d.kind in ['Number', 'Bool']:
+        # numeric series are converted and downsampled as arrays
+        ts, values = point_rows_to_arrays(rows, is_bool=is_bool)
+        if max_points:
+            ts, values = downsample_arrays(ts, values, max_points, method=downsample)
+        data = point_arrays_to_values(ts, values, is_bool=is_bool)
+    else:
+        data = [[result[0], _point_value_from_row(result, is_bool)] for result in rows]
+        if max_points:
+            data = downsample_values(data, max_points, method=downsample)
+    if ts_as_datetime:
+        # convert from epoch to datetime directly
+        for v in data:
+            v[0] = datetime.utcfromtimestamp(v[0] // 1000).replace(microsecond=0).replace(tzinfo=timezone.utc)
+    return data
+
+
+def point_rows_to_arrays(rows, is_bool=False):
+    # convert the (ts, value) query rows, or (ts, string_value, double_value) for Bool points,
+    # into an int64 array of epoch ms and a float64 array of values where missing values are NaN
+    if not rows:
+        return numpy.empty(0, dtype=numpy.int64), numpy.empty(0, dtype=numpy.float64)
+    columns = list(zip(*rows))
+    if isinstance(columns[0][0], int):
+        ts = numpy.array(columns[0], dtype=numpy.int64)
+    else:
+        ts = numpy.fromiter((to_epoch_ms(t) for t in columns[0]), dtype=numpy.int64, count=len(rows))
+    if is_bool:
+        # same as _point_value_from_row: any string_value other than '' or '0' is true
+        strings = numpy.array(columns[1], dtype=object)
+        is_true = strings.astype(bool) & (strings != '0')
+        values = numpy.where(is_true, 1.0, numpy.round(numpy.array(columns[2], dtype=numpy.float64)))
+    else:
+        values = numpy.array(columns[1], dtype=numpy.float64)
+    return ts, values
+
+
+def point_arrays_to_values(ts, values, is_bool=False):
+    # convert the arrays back into the [[ts, value], ...] list, NaN values are None
+    data = []
+    for t, v in zip(ts.tolist(), values.tolist()):
+        if v != v:
+            v = None
+        elif is_bool:
+            v = int(v)
+        data.append([t, v])
+    return data
+
+
+def get_point_values_arrays(d, date_trunc=DEFAULT_RES, value_func='avg', trange=DEFAULT_RANGE, max_points=None,
+                            downsample=None):
+    # same as get_point_values but returns the series as numpy arrays: int64 epoch ms and float64 values,
+    # non numeric values of raw points are NaN
+    date_trunc, start, end = _get_point_values_range(date_trunc, trange, max_points)
+    rows = _get_point_rows(d, date_trunc, value_func, start, end, raw_column='double_value')
+    ts, values = point_rows_to_arrays(rows, is_bool='Bool' == d.kind)
+    if max_points:
+        ts, values = downsample_arrays(ts, values, max_points, method=downsample)
+    return ts, values
+
+
+def get_points_matrix(points, trange=DEFAULT_RANGE, date_trunc=DEFAULT_RES, value_func='avg'):
+    # returns the values of the given points aligned on the same buckets with a single query:
+    # {'columns': [point info], 'rows': [[ts, value of each column or None], ...]} in ascending ts order
+    # non Number / Bool points use the MIN(string_value) of each bucket
+    if date_trunc not in RESOLUTION_SECONDS:
+        date_trunc = DEFAULT_RES
+    points = [p for p in points if p.topic]
+    columns = []
+    topic_columns = {}
+    for i, p in enumerate(points):
+        columns.append({'entity_id': p.entity_id, 'description': p.description, 'topic': p.topic,
+                        'kind': p.kind, 'unit': p.unit})
+        topic_columns.setdefault(p.topic, []).append(i)
+    if not points:
+        return {'columns': columns, 'rows': []}
+
+    start, end = get_start_date_from_range(trange)
+    logger.info("Getting data points matrix of %s points for range %s -- %s at %s", len(points), start, end, date_trunc)
+    sql = """SELECT topic, DATE_TRUNC('{}', ts) as timest, {}(double_value), MIN(string_value) FROM "data"
+             WHERE topic = ANY(%s) AND ts > %s AND ts <= %s
+             GROUP BY topic, timest ORDER BY timest ASC;""".format(date_trunc, value_func)
+    rows = {}
+    with connections['crate'].cursor() as c:
+        c.execute(sql, [list(topic_columns.keys()), start, end])
+        for topic, ts, value, string_value in c.fetchall():
+            row = rows.get(ts)
+            if not row:
+                row = [ts] + [None] * len(points)
+                rows[ts] = row
+            for i in topic_columns.get(topic, []):
+                kind = points[i].kind
+                if 'Bool' == kind:
+                    row[i + 1] = _point_value_from_row([ts, string_value, value], True)
+                elif 'Number' == kind:
+                    row[i + 1] = value
                 else:
-                    value = round(result[2])
-            if ts_as_datetime:
-                # convert from epoch to datetime directly
-                ts = datetime.utcfromtimestamp(ts // 1000).replace(microsecond=0).replace(tzinfo=timezone.utc)
-            data.append([ts, value])
-        logger.info("Got %s data points for %s", len(data), d.entity_id)
-        cursor.close()
-    return list(reversed(data))
+                    row[i + 1] = string_value
+    # rows were inserted in ascending ts order
+    return {'columns': columns, 'rows': list(rows.values())}
+
+
+def downsample_points_matrix(matrix, max_points, method=None):
+    # downsample each column of a points matrix like downsample_values does for a single point,
+    # only the rows where at least one column kept its value remain
+    rows = matrix['rows']
+    if not max_points or len(rows) <= max_points:
+        return matrix
+    n = len(matrix['columns'])
+    kept = {}
+    for i in range(1, n + 1):
+        series = [[row[0], row[i]] for row in rows if row[i] is not None]
+        for ts, value in downsample_values(series, max_points, method=method):
+            kept.setdefault(ts, {})[i] = value
+    matrix['rows'] = [[row[0]] + [kept[row[0]].get(i) for i in range(1, n + 1)] for row in rows if row[0] in kept]
+    return matrix
 
 
 def get_topics_tags_report():
@@ -467,11 +1151,70 @@ def tag_rulesets_run_report_diff(entities, updated_tags, removed_tags):
     return report_rows, report_header_diff
 
 
+def _mark_report_row(row, report_header, updated_tag, removed_tag):
+    # mark the updated and removed values for the report preview page
+    row_new = []
+    for i, value in enumerate(row):
+        header = report_header[i]
+        if updated_tag and updated_tag.get(header):
+            value += "::$$updated$$"
+        elif removed_tag and removed_tag.get(header):
+            value = removed_tag.get(header) + "::$$removed$$"
+        row_new.append(value)
+    return row_new
+
+
+def write_tag_rulesets_report(f, updated_entities, updated_tags, removed_tags, diff_format=False, mark_changes=False):
+    # write the CSV preview report of a rule set run to the file f,
+    # returns False when there is nothing to report in the diff format
+    if diff_format:
+        report_rows, report_header = tag_rulesets_run_report_diff(updated_entities, updated_tags, removed_tags)
+        if not report_rows:
+            return False
+    else:
+        report_rows, report_header = tag_rulesets_run_report(updated_entities)
+
+    writer = csv.writer(f)
+    if not report_header:
+        writer.writerow([''])
+        return True
+    writer.writerow(report_header)
+    for row in report_rows or []:
+        if mark_changes and not diff_format:
+            row = _mark_report_row(row, report_header, updated_tags.get(row[0]), removed_tags.get(row[0]))
+        writer.writerow(row)
+    return True
+
+
+# the CSV reports of the previews are kept in the cache, shared by the web and celery processes,
+# until viewed or downloaded
+REPORT_CACHE_KEY_PREFIX = 'report:'
+REPORT_CACHE_TTL = 3600
+
+
+def store_report(content, token=None):
+    # returns the token of the report, by default a random one
+    token = token or uuid.uuid4().hex
+    cache.set(REPORT_CACHE_KEY_PREFIX + token, content, REPORT_CACHE_TTL)
+    return token
+
+
+def pop_report(token):
+    # returns the content of the report and removes it, or None if not found
+    if not token:
+        return None
+    key = REPORT_CACHE_KEY_PREFIX + token
+    content = cache.get(key)
+    if content is not None:
+        cache.delete(key)
+    return content
+
+
 def charts_for_points(points):
     charts = []
     i = 0
-    for point in points:
-        data = get_current_value_dict(point)
+    points = list(points)
+    for point, data in zip(points, get_current_values(points)):
         # skip empty charts
         if data:
             i += 1
@@ -896,16 +1639,8 @@ def apply_filter_to_queryset(qs, filter_field, filter_type, filter_value, valid_
 
 
 def apply_filters_to_queryset(qs, filters):
-    # first we do a schema check since trying to fetch unused tags will cause a DB error
-    valid_tags = []
-
-    with connections['crate'].cursor() as c:
-        sql = """SELECT column_name from information_schema.columns
-                 WHERE table_name = 'topic' and column_name like 'kv_tags[%';"""
-        c.execute(sql)
-        for (cn, ) in c:
-            # extract the tag name from "kv_tags['tag_name']"
-            valid_tags.append(cn[9:-2])
+    # only filter on the tags known in the Crate schema since trying to fetch unused tags will cause a DB error
+    valid_tags = get_crate_tag_columns()
 
     # ordering or AND and OR filters
     # A or B and C -> (A(qs) | B(qs)) & C(qs)
@@ -942,7 +1677,162 @@ def apply_filters_to_queryset(qs, filters):
     return qs
 
 
-def tag_topics(filters, tags, select_all=False, topics=[], select_not_mapped_topics=None, pretend=False):
+# number of topics tagged by each statement in the bulk mode of tag_topics
+TAG_TOPICS_BATCH_SIZE = 1000
+
+
+def _tags_changes(tags):
+    # reduce the tags to add or remove to their net changes, as if applied in order by tag_topics,
+    # returns the kv_tags to set, the kv_tags to delete, the m_tags to add and the m_tags to delete
+    kv_set = {}
+    kv_del = set()
+    m_add = []
+    m_del = set()
+    for tag in tags:
+        name = tag.get('tag')
+        if tag.get('remove') is True or tag.get('remove') == 'True':
+            kv_set.pop(name, None)
+            kv_del.add(name)
+            if name in m_add:
+                m_add.remove(name)
+            m_del.add(name)
+        elif tag.get('value'):
+            kv_set[name] = str(tag.get('value'))
+            kv_del.discard(name)
+        elif name not in m_add:
+            m_add.append(name)
+            m_del.discard(name)
+    return kv_set, list(kv_del), m_add, list(m_del)
+
+
+def _bulk_tag_topics(topics, tags, new_ids=None):
+    # set based version of tag_topics: for each batch of topics the missing data points are created
+    # with bulk_create, then the tags are applied by a few UPDATE statements and synced to Crate at once
+    # new_ids optionally gives the ids of the created data points by topic
+    kv_set, kv_del, m_add, m_del = _tags_changes(tags)
+    equip_ref = kv_set.get('equipRef')
+    if equip_ref:
+        # let it fail if the equipment does not exist
+        EquipmentView.objects.get(object_id=equip_ref)
+
+    updated = []
+    for i in range(0, len(topics), TAG_TOPICS_BATCH_SIZE):
+        batch = topics[i:i + TAG_TOPICS_BATCH_SIZE]
+        with transaction.atomic(), connection.cursor() as c:
+            existing = set(Entity.objects.filter(topic__in=batch).values_list('topic', flat=True))
+            new_entities = []
+            for topic in batch:
+                if topic not in existing:
+                    entity_id = (new_ids or {}).get(topic) or make_random_id(topic)
+                    new_entities.append(Entity(entity_id=entity_id, topic=topic, m_tags=[], kv_tags={'id': entity_id}))
+            Entity.objects.bulk_create(new_entities)
+
+            c.execute("""UPDATE core_entity SET kv_tags = coalesce(kv_tags, ''::hstore) || hstore('dis', topic)
+                         WHERE topic = ANY(%s) AND coalesce(kv_tags->'dis', '') = '';""", [batch])
+            # m_tags keep their order, the new ones are appended
+            c.execute("""UPDATE core_entity SET
+                         kv_tags = (coalesce(kv_tags, ''::hstore) - %s::text[]) || hstore(%s::text[], %s::text[]),
+                         m_tags = ARRAY(SELECT t FROM unnest(coalesce(m_tags, '{}')) WITH ORDINALITY AS u(t, i)
+                                        WHERE array_position(%s::varchar[], t) IS NULL ORDER BY i)
+                               || ARRAY(SELECT t FROM unnest(%s::varchar[]) WITH ORDINALITY AS a(t, i)
+                                        WHERE array_position(coalesce(m_tags, '{}'), t) IS NULL ORDER BY i)
+                         WHERE topic = ANY(%s);""",
+                      [kv_del, list(kv_set.keys()), list(kv_set.values()), m_del, m_add, batch])
+            # if tagged with an equipRef make sure the siteRef also matches
+            c.execute("""UPDATE core_entity e SET kv_tags = e.kv_tags || hstore('siteRef', eq.site_id)
+                         FROM core_equipment_view eq
+                         WHERE e.topic = ANY(%s) AND eq.object_id = e.kv_tags->'equipRef'
+                         AND coalesce(eq.site_id, '') <> '';""", [batch])
+            entities = list(Entity.objects.filter(topic__in=batch))
+
+        if settings.CRATE_TAG_AUTOSYNC:
+            sync_tags_to_crate_entities(entities)
+        for e in entities:
+            updated.append({'topic': e.topic, 'point': e.entity_id, 'name': e.kv_tags.get('dis')})
+
+    # the entities were not saved so their signals were not sent
+    invalidate_entity_hierarchy()
+    return updated
+
+
+def _topic_filters(filters):
+    # the (field, type, value, op) of the given filters, as used by apply_filters_to_queryset
+    q_filters = []
+    for qfilter in filters:
+        filter_op = qfilter.get('o') or qfilter.get('op') or 'AND'
+        filter_type = qfilter.get('t') or qfilter.get('type')
+        filter_field = qfilter.get('n') or qfilter.get('field')
+        if filter_type:
+            filter_value = qfilter.get('f') or qfilter.get('value')
+            q_filters.append((filter_field, filter_type, filter_value, filter_op))
+    return q_filters
+
+
+def _tag_entity(e, topic, tags, pretend, updated_tags, removed_tags):
+    # apply the tags to add or remove to the Data Point of the topic without saving it,
+    # when pretending the changes are recorded in updated_tags and removed_tags
+    if not e.kv_tags or not e.kv_tags.get('dis'):
+        e.add_tag('dis', topic, commit=False)
+    for tag in tags:
+        # never tag with 'site' or 'equip'!
+        if tag != 'site' and tag != 'equip':
+            if tag.get('remove') is True or tag.get('remove') == 'True':
+                logging.info('*** remove tag %s', tag)
+                if pretend:
+                    current_tag = None
+                    current_value = None
+                    tag_tag = tag.get('tag')
+                    if tag_tag in e.m_tags:
+                        current_tag = tag_tag
+                        current_value = 'type:MARKER'
+                    else:
+                        value = e.kv_tags.get(tag_tag)
+                        if value:
+                            current_tag = tag_tag
+                            current_value = value
+
+                    if current_tag:
+                        tt = removed_tags.get(topic)
+                        if not tt:
+                            tt = {}
+                        tt[current_tag] = current_value
+
+                        removed_tags[topic] = tt
+
+                e.remove_tag(tag.get('tag'), commit=False)
+            else:
+                logging.info('*** add tag %s', tag)
+                if pretend:
+                    current_value = None
+                    tag_tag = tag.get('tag')
+                    if tag_tag in e.m_tags:
+                        current_value = 'type:MARKER'
+                    else:
+                        value = e.kv_tags.get(tag_tag)
+                        if value:
+                            current_value = value
+
+                    tt = updated_tags.get(topic)
+                    if not tt:
+                        tt = {}
+                    if tag.get('value'):
+                        tt[tag.get('tag')] = {'new': tag.get('value'), 'previous': current_value}
+                    else:
+                        tt[tag.get('tag')] = {'new': 'type:MARKER', 'previous': current_value}
+
+                    updated_tags[topic] = tt
+                e.add_tag(tag.get('tag'), value=tag.get('value'), commit=False)
+    # if tagged with an equipRef make sure the siteRef also matches
+    equip_ref = e.kv_tags.get('equipRef')
+    if equip_ref:
+        # let it fail if the equipment does not exist
+        equip = EquipmentView.objects.get(object_id=equip_ref)
+        if equip and equip.site_id:
+            e.add_tag('siteRef', equip.site_id, commit=False)
+
+
+def tag_topics(filters, tags, select_all=False, topics=[], select_not_mapped_topics=None, pretend=False,
+               bulk=False):
     qs = Topic.objects.all()
 
     if select_not_mapped_topics:
@@ -954,15 +1844,18 @@ def tag_topics(filters, tags, select_all=False, topics=[], select_not_mapped_top
 
     logging.info('tag_topics: using filters %s', filters)
     if filters:
-        q_filters = []
-        for qfilter in filters:
-            filter_op = qfilter.get('o') or qfilter.get('op') or 'AND'
-            filter_type = qfilter.get('t') or qfilter.get('type')
-            filter_field = qfilter.get('n') or qfilter.get('field')
-            if filter_type:
-                filter_value = qfilter.get('f') or qfilter.get('value')
-                q_filters.append((filter_field, filter_type, filter_value, filter_op))
-        qs = apply_filters_to_queryset(qs, q_filters)
+        qs = apply_filters_to_queryset(qs, _topic_filters(filters))
+
+    if bulk and not pretend:
+        # the previews still need to check each entity
+        topics = set(topics or [])
+        topic_list = []
+        for topic in qs.values_list('topic', flat=True).iterator():
+            topic = str(topic)
+            if select_all or topic in topics:
+                topic_list.append(topic)
+        logging.info('tag_topics: apply to %s topics in bulk', len(topic_list))
+        return _bulk_tag_topics(topic_list, tags), {}, {}, {}
 
     # store a dict of topic -> data_point.entity_id
     updated = []
@@ -980,64 +1873,7 @@ def tag_topics(filters, tags, select_all=False, topics=[], select_not_mapped_top
                 entity_id = make_random_id(topic)
                 e = Entity(entity_id=entity_id, topic=topic, m_tags=[])
                 e.add_tag('id', entity_id, commit=False)
-            if not e.kv_tags or not e.kv_tags.get('dis'):
-                e.add_tag('dis', topic, commit=False)
-            for tag in tags:
-                # never tag with 'site' or 'equip'!
-                if tag != 'site' and tag != 'equip':
-                    if tag.get('remove') is True or tag.get('remove') == 'True':
-                        logging.info('*** remove tag %s', tag)
-                        if pretend:
-                            current_tag = None
-                            current_value = None
-                            tag_tag = tag.get('tag')
-                            if tag_tag in e.m_tags:
-                                current_tag = tag_tag
-                                current_value = 'type:MARKER'
-                            else:
-                                value = e.kv_tags.get(tag_tag)
-                                if value:
-                                    current_tag = tag_tag
-                                    current_value = value
-
-                            if current_tag:
-                                tt = removed_tags.get(topic)
-                                if not tt:
-                                    tt = {}
-                                tt[current_tag] = current_value
-
-                                removed_tags[topic] = tt
-
-                        e.remove_tag(tag.get('tag'), commit=False)
-                    else:
-                        logging.info('*** add tag %s', tag)
-                        if pretend:
-                            current_value = None
-                            tag_tag = tag.get('tag')
-                            if tag_tag in e.m_tags:
-                                current_value = 'type:MARKER'
-                            else:
-                                value = e.kv_tags.get(tag_tag)
-                                if value:
-                                    current_value = value
-
-                            tt = updated_tags.get(topic)
-                            if not tt:
-                                tt = {}
-                            if tag.get('value'):
-                                tt[tag.get('tag')] = {'new': tag.get('value'), 'previous': current_value}
-                            else:
-                                tt[tag.get('tag')] = {'new': 'type:MARKER', 'previous': current_value}
-
-                            updated_tags[topic] = tt
-                        e.add_tag(tag.get('tag'), value=tag.get('value'), commit=False)
-            # if tagged with an equipRef make sure the siteRef also matches
-            equip_ref = e.kv_tags.get('equipRef')
-            if equip_ref:
-                # let it fail if the equipment does not exist
-                equip = EquipmentView.objects.get(object_id=equip_ref)
-                if equip and equip.site_id:
-                    e.add_tag('siteRef', equip.site_id, commit=False)
+            _tag_entity(e, topic, tags, pretend, updated_tags, removed_tags)
             if pretend:
                 updated_entities[topic] = e
                 logging.info('tag_topics: pretend changed %s %s %s', e, e.m_tags, e.kv_tags)
@@ -1048,6 +1884,271 @@ def tag_topics(filters, tags, select_all=False, topics=[], select_not_mapped_top
     return updated, updated_entities, updated_tags, removed_tags
 
 
+# number of rows of the Crate topic table fetched at once by iter_topic_rows
+TOPIC_ROWS_CHUNK_SIZE = 5000
+
+TOPIC_FILTER_COMPARISONS = {'gt': operator.gt, 'gte': operator.ge, 'lt': operator.lt, 'lte': operator.le}
+
+
+def _crate_datetime(dt):
+    # the naive UTC datetime stored in the Crate TIMESTAMP columns
+    if dt.tzinfo:
+        dt = dt.astimezone(timezone.utc).replace(tzinfo=None)
+    return dt
+
+
+def stamp_new_topics(now, retried=False):
+    # set the first_seen time of the topics added since the last call, eg: by VOLTTRON
+    try:
+        with connections['crate'].cursor() as c:
+            c.execute("""UPDATE "topic" SET first_seen = %s WHERE first_seen IS NULL;""", [_crate_datetime(now)])
+            # make them visible to the next queries
+            c.execute("""REFRESH TABLE "topic";""")
+    except DatabaseError as e:
+        if 'ColumnUnknown' in str(e) and not retried:
+            ensure_crate_topic_first_seen()
+            return stamp_new_topics(now, retried=True)
+        raise
+
+
+def iter_topic_rows(chunk_size=TOPIC_ROWS_CHUNK_SIZE, since=None):
+    # yield the (topic, m_tags, kv_tags) rows of the Crate topic table in topic order,
+    # page by page (keyset on topic) so memory stays bounded by chunk_size
+    # when since is given only the topics first seen after it, see stamp_new_topics
+    sql = """SELECT topic, m_tags, kv_tags FROM topic WHERE topic > %s {} ORDER BY topic LIMIT %s;"""
+    params = []
+    if since:
+        sql = sql.format('AND first_seen > %s')
+        params.append(_crate_datetime(since))
+    else:
+        sql = sql.format('')
+    last = ''
+    while True:
+        with connections['crate'].cursor() as c:
+            c.execute(sql, [last] + params + [chunk_size])
+            rows = c.fetchmany(chunk_size)
+        for row in rows:
+            yield row
+        if len(rows) < chunk_size:
+            break
+        last = rows[-1][0]
+
+
+def _match_all_topics(topic, m_tags, kv_tags):
+    return True
+
+
+def _match_no_topics(topic, m_tags, kv_tags):
+    return False
+
+
+def _compile_topic_filter(filter_field, filter_type, filter_value, valid_tags):
+    # in memory version of apply_filter_to_queryset: returns a predicate of the (topic, m_tags, kv_tags)
+    # of a topic row, or None when the filter does not restrict the topics
+    # valid_tags are the tags with a Crate column, as given to apply_filter_to_queryset
+    if not filter_field or filter_field == 'undefined' or filter_field == 'Topic':
+        name = 'topic'
+    else:
+        name = filter_field
+    # the other tags are never queried from the kv_tags
+    is_column = name == 'topic' or name in valid_tags
+
+    def get_value(topic, m_tags, kv_tags):
+        if name == 'topic':
+            return topic
+        return kv_tags.get(name) if kv_tags and is_column else None
+
+    def present(topic, m_tags, kv_tags):
+        return get_value(topic, m_tags, kv_tags) is not None or bool(m_tags and name in m_tags)
+
+    if not filter_type:
+        return None
+    if filter_type == 'present':
+        return present
+    if filter_type == 'absent':
+        return lambda *row: not present(*row)
+    if not filter_value:
+        return None
+    if not is_column:
+        # matching a value of an unused tag gives no topic, the other comparisons are not applied
+        if filter_type in ['c', 'eq']:
+            return _match_no_topics
+        return None
+
+    value = str(filter_value)
+    if filter_type in ['c', 'nc']:
+        value = value.upper()
+
+        def match(v):
+            return value in v.upper()
+    elif filter_type in ['eq', 'neq']:
+        value = value.upper()
+
+        def match(v):
+            return v.upper() == value
+    elif filter_type == 'matches':
+        # like the Crate regex operators the whole value must match
+        regex = re.compile(value, re.IGNORECASE)
+
+        def match(v):
+            return regex.fullmatch(v) is not None
+    elif filter_type in TOPIC_FILTER_COMPARISONS:
+        compare = TOPIC_FILTER_COMPARISONS[filter_type]
+
+        def match(v):
+            return compare(v, value)
+    else:
+        return None
+
+    def predicate(topic, m_tags, kv_tags):
+        v = get_value(topic, m_tags, kv_tags)
+        return v is not None and match(str(v))
+
+    if filter_type in ['nc', 'neq']:
+        # a topic without the tag is not excluded
+        return lambda *row: not predicate(*row)
+    return predicate
+
+
+def compile_topic_filters(filters, valid_tags=None):
+    # in memory version of apply_filters_to_queryset for the given filters (as given to tag_topics),
+    # returns a predicate of the (topic, m_tags, kv_tags) of a topic row
+    if valid_tags is None:
+        valid_tags = get_crate_tag_columns()
+    groups = []
+    for (filter_field, filter_type, filter_value, filter_op) in _topic_filters(filters or []):
+        predicate = _compile_topic_filter(filter_field, filter_type, filter_value, valid_tags) or _match_all_topics
+        # the ORs are resolved first then ANDed
+        if groups and filter_op and filter_op.lower() == 'or':
+            groups[-1].append(predicate)
+        else:
+            groups.append([predicate])
+
+    def matches(topic, m_tags, kv_tags):
+        for group in groups:
+            if not any(p(topic, m_tags, kv_tags) for p in group):
+                return False
+        return True
+
+    return matches
+
+
+def _topic_point_id(topic, new_ids):
+    # the id of the data point of the topic, or the one given to it when created by _bulk_tag_topics
+    entity_id = new_ids.get(topic)
+    if entity_id is None:
+        e = Entity.objects.filter(topic=topic).values_list('entity_id', 'kv_tags').first()
+        if e:
+            entity_id = (e[1] or {}).get('id') or e[0]
+        else:
+            entity_id = make_random_id(topic)
+        new_ids[topic] = entity_id
+    return entity_id
+
+
+def _apply_tags_changes(topic, m_tags, kv_tags, changes, equipment_sites, new_ids=None):
+    # the tags of a topic row once tagged by _bulk_tag_topics and synced to Crate,
+    # the id tag is only set when new_ids is given, see _topic_point_id
+    kv_set, kv_del, m_add, m_del = changes
+    m_tags = m_tags or []
+    kv_tags = dict(kv_tags or {})
+    for tag in kv_del:
+        kv_tags.pop(tag, None)
+    kv_tags.update(kv_set)
+    if new_ids is not None and not kv_tags.get('id'):
+        kv_tags['id'] = _topic_point_id(topic, new_ids)
+    if not kv_tags.get('dis'):
+        kv_tags['dis'] = topic
+    equip_ref = kv_tags.get('equipRef')
+    if equip_ref:
+        if equip_ref not in equipment_sites:
+            equipment_sites[equip_ref] = EquipmentView.objects.filter(
+                object_id=equip_ref).values_list('site_id', flat=True).first()
+        if equipment_sites[equip_ref]:
+            kv_tags['siteRef'] = equipment_sites[equip_ref]
+    m_tags = [t for t in m_tags if t not in m_del] + [t for t in m_add if t not in m_tags]
+    return m_tags, kv_tags
+
+
+def evaluate_topic_rules(rules, evolving=False, since=None, new_ids=None):
+    # single pass version of tag_topics for each of the (filters, tags) rules in order: the topic table
+    # is scanned once and returns a dict of topic -> tuple of the indexes of the rules matching it.
+    # When evolving the next rules see the tags set by the previous ones, as when running them one after
+    # the other with the tags synced to Crate, else they all see the current tags as when previewing.
+    # When since is given only the topics first seen after it are evaluated.
+    # new_ids is filled with the ids of the data points to create, to give to apply_topic_rules, those
+    # are only needed when evolving and a rule filters on the id tag.
+    valid_tags = set(get_crate_tag_columns())
+    compiled = []
+    uses_id = False
+    for filters, tags in rules:
+        changes = _tags_changes(tags)
+        compiled.append((compile_topic_filters(filters, valid_tags=valid_tags), changes))
+        uses_id = uses_id or any(f[0] == 'id' for f in _topic_filters(filters or []))
+        if evolving:
+            # the tags set by this rule have a Crate column for the next ones once synced
+            valid_tags = valid_tags | set(changes[0].keys()) | set(['id', 'dis', 'siteRef'])
+    if not evolving or not uses_id or new_ids is None:
+        new_ids = None
+    equipment_sites = {}
+    matches = {}
+    count = 0
+    for topic, m_tags, kv_tags in iter_topic_rows(since=since):
+        count += 1
+        topic = str(topic)
+        matched = []
+        for i, (predicate, changes) in enumerate(compiled):
+            if predicate(topic, m_tags, kv_tags):
+                matched.append(i)
+                if evolving:
+                    m_tags, kv_tags = _apply_tags_changes(topic, m_tags, kv_tags, changes, equipment_sites,
+                                                          new_ids=new_ids)
+        if matched:
+            matches[topic] = tuple(matched)
+    logger.info('evaluate_topic_rules: %s rules matched %s of %s topics', len(rules), len(matches), count)
+    return matches
+
+
+def apply_topic_rules(rules, matches, new_ids=None):
+    # tag in bulk the topics matched by evaluate_topic_rules, grouped by the rules they matched
+    # so the tags of each group are applied at once in the order of the rules
+    groups = {}
+    for topic, indexes in matches.items():
+        groups.setdefault(indexes, []).append(topic)
+    updated = []
+    for indexes, topics in groups.items():
+        tags = [tag for i in indexes for tag in rules[i][1]]
+        updated.extend(_bulk_tag_topics(topics, tags, new_ids=new_ids))
+    return updated
+
+
+def preview_topic_rules(rules, matches, updated_entities, updated_tags, removed_tags):
+    # pretend to tag the topics matched by evaluate_topic_rules as tag_topics does for each rule
+    # and merge the changes, updated_entities is a dict of topic -> {topic, kv_tags, m_tags}
+    topics = list(matches.keys())
+    for i in range(0, len(topics), TAG_TOPICS_BATCH_SIZE):
+        batch = topics[i:i + TAG_TOPICS_BATCH_SIZE]
+        entities = {e.topic: e for e in Entity.objects.filter(topic__in=batch)}
+        for topic in batch:
+            updated_entity = updated_entities.setdefault(topic, {'topic': topic, 'kv_tags': {}, 'm_tags': []})
+            for index in matches[topic]:
+                # each rule sees the current tags
+                current = entities.get(topic)
+                if current:
+                    e = Entity(entity_id=current.entity_id, topic=topic, m_tags=list(current.m_tags or []),
+                               kv_tags=dict(current.kv_tags or {}))
+                else:
+                    entity_id = make_random_id(topic)
+                    e = Entity(entity_id=entity_id, topic=topic, m_tags=[])
+                    e.add_tag('id', entity_id, commit=False)
+                _tag_entity(e, topic, rules[index][1], True, updated_tags, removed_tags)
+                updated_entity['kv_tags'].update(e.kv_tags)
+                for tag in e.m_tags:
+                    if tag not in updated_entity['m_tags']:
+                        updated_entity['m_tags'].append(tag)
+    return topics
+
+
 def get_bacnet_trending_data(rows):
     header = []
     bacnet_data = []
@@ -1079,7 +2180,8 @@ def get_bacnet_trending_data(rows):
     return header, bacnet_data
 
 
-def create_equipment_action(filters, action_fields):
+def create_equipment_action(filters, action_fields, topics=None):
+    # when topics is given the action is restricted to those
     qs = Topic.objects.all()
 
     logging.info('create_equipment_action: using filters %s', filters)
@@ -1104,6 +2206,8 @@ def create_equipment_action(filters, action_fields):
             new_equipments_topics = {}
             for etopic in qs:
                 stopic = str(etopic.topic)
+                if topics is not None and stopic not in topics:
+                    continue
                 equipment_name = action_fields.get('equipment_name')
                 if action_regexp_value:
                     m = re.match(action_regexp_value, stopic)
@@ -23,6 +23,7 @@ from .common import WithPointBreadcrumbsMixin
 from .point import PointTable
 from .. import utils
 from ..forms.equipment import EquipmentCreateForm
+from ..hierarchy import get_entity_hierarchy
 from ..models import Entity
 from ..models import EquipmentView
 from ..models import PointView
@@ -173,14 +174,13 @@ class EquipmentDetailView(LoginRequiredMixin, WithFilesAndNotesAndTagsMixin, Wit
         b = []
         b.append({'url': reverse('core:site_list'), 'label': 'Sites'})
         if context.get('object') and context['object'].site_id:
-            try:
-                site = SiteView.objects.get(kv_tags__id=context['object'].site_id)
-                if site:
-                    site_desc = site.description or context['object'].site_id
-                    b.append({'url': reverse('core:site_detail', kwargs={'site': site.entity_id}),
-                              'label': 'Site {}'.format(site_desc)})
-            except Exception as e:
-                logging.error(e)
+            site = get_entity_hierarchy().get_site(context['object'].site_id)
+            if site:
+                site_desc = site.description or context['object'].site_id
+                b.append({'url': reverse('core:site_detail', kwargs={'site': site.entity_id}),
+                          'label': 'Site {}'.format(site_desc)})
+            else:
+                logging.error('Site not found: %s', context['object'].site_id)
 
         b.append({'label': 'Equipment {}'.format(context['object'].description)})
         return b
@@ -189,13 +189,13 @@ class EquipmentDetailView(LoginRequiredMixin, WithFilesAndNotesAndTagsMixin, Wit
         context = super(EquipmentDetailView, self).get_context_data(**kwargs)
         context['grafana_url'] = settings.GRAFANA_BASE_URL + "/d/"
         context['grafana_snapshot_url'] = settings.GRAFANA_BASE_URL + "/dashboard/snapshot/"
+        h = get_entity_hierarchy()
         # add the parent Site (optional)
-        try:
-            context['site'] = SiteView.objects.get(object_id=context['object'].site_id)
-        except SiteView.DoesNotExist:
-            pass
+        site = h.get_site(context['object'].site_id)
+        if site:
+            context['site'] = site
 
-        context['data_points'] = PointView.objects.filter(equipment_id=context['object'].object_id).count()
+        context['data_points'] = len(h.equipment_points(context['object'].object_id))
         is_ahu = 0
         if 'ahu' in context['object'].m_tags:
             is_ahu = 1
@@ -229,6 +229,21 @@ def equipment_data_points_table(request, equip):
     return HttpResponse(table.as_html(request))
 
 
+def equipment_points_matrix_json(request, equip):
+    if not request.user.is_authenticated:
+        return JsonResponse({'error': 'Authentication required'}, status=401)
+    resolution = request.GET.get('res')
+    trange = request.GET.get('range')
+    equipment = get_object_or_404(EquipmentView, entity_id=equip)
+    points = PointView.objects.filter(equipment_id=equipment.object_id)
+    # optionally restrict to the given points
+    point_ids = request.GET.getlist('point')
+    if point_ids:
+        points = points.filter(entity_id__in=point_ids)
+    matrix = utils.get_points_matrix(points.order_by('description'), date_trunc=resolution, trange=trange)
+    return JsonResponse(matrix)
+
+
 class EquipmentPointDetailView(LoginRequiredMixin, WithFilesAndNotesAndTagsMixin,
                                WithPointBreadcrumbsMixin, DetailView):
     model = PointView
@@ -22,8 +22,8 @@ from datetime import datetime
 from .common import WithFilesAndNotesAndTagsMixin
 from .common import WithPointBreadcrumbsMixin
 from .. import utils
+from ..hierarchy import get_entity_hierarchy
 from ..models import datetime_to_string
-from ..models import EquipmentView
 from ..models import PointView
 from ..models import SiteView
 
@@ -65,17 +65,16 @@ class PointDetailView(LoginRequiredMixin, WithFilesAndNotesAndTagsMixin, WithPoi
     def get_context_data(self, **kwargs):
         context = super(PointDetailView, self).get_context_data(**kwargs)
         context['grafana_url'] = settings.GRAFANA_BASE_URL + "/d/"
+        h = get_entity_hierarchy()
         # add the parent Site (optional)
-        try:
-            context['site'] = SiteView.objects.get(object_id=context['object'].site_id)
-        except SiteView.DoesNotExist:
-            pass
+        site = h.get_site(context['object'].site_id)
+        if site:
+            context['site'] = site
 
         # add the parent Equipment (optional)
-        try:
-            context['equipment'] = EquipmentView.objects.get(object_id=context['object'].equipment_id)
-        except EquipmentView.DoesNotExist:
-            pass
+        equipment = h.get_equipment(context['object'].equipment_id)
+        if equipment:
+            context['equipment'] = equipment
 
         if context['object']:
             charts = []
@@ -101,9 +100,14 @@ def point_data_json(request, point, site=None, equip=None):
         return JsonResponse({'error': 'Authentication required'}, status=401)
     resolution = request.GET.get('res')
     trange = request.GET.get('range')
+    max_points = utils.parse_max_points(request.GET.get('max_points'))
+    downsample = request.GET.get('downsample')
     p = PointView.objects.get(entity_id=point)
     if p:
-        return JsonResponse({'values': utils.get_point_values(p, date_trunc=resolution, trange=trange)})
+        # dashboards poll the same range, so only the newest buckets are queried each time
+        return JsonResponse({'values': utils.get_point_values(p, date_trunc=resolution, trange=trange,
+                                                              max_points=max_points, downsample=downsample,
+                                                              use_cache=True)})
     else:
         logger.warning('No point found with entity_id = %s', point)
         return JsonResponse({'error': 'Point data not found {} : {}'.format(equip, point)}, status=404)
@@ -126,14 +130,10 @@ def point_data_csv(request, point, site=None, equip=None):
     p = get_object_or_404(PointView, entity_id=point)
     site = p.kv_tags['siteRef']
     equip = p.kv_tags['equipRef']
-    rows = utils.get_point_values(p, date_trunc=resolution, trange=trange)
-    # limit output
-    if len(rows) > 65535:
-        del rows[:65535]
-
-    last_timestamp = "0"
-    if len(rows) > 0:
-        last_timestamp = rows[:-1][0][0]
+    # stream the rows as they are read from Crate, the series is never fully loaded in memory
+    rows = utils.iter_point_values(p, date_trunc=resolution, trange=trange)
+    # name the file after the end of the range since the last row is not known before streaming
+    last_timestamp = utils.to_epoch_ms(utils.get_start_date_from_range(trange)[1])
 
     value_title = 'value'
     if p.unit:
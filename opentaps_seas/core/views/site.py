@@ -22,6 +22,7 @@ from .common import WithBreadcrumbsMixin
 from .common import WithFilesAndNotesAndTagsMixin
 from .. import utils
 from ..forms.site import SiteCreateForm
+from ..hierarchy import get_entity_hierarchy
 from ..models import Entity
 from ..models import EquipmentView
 from ..models import Geo
@@ -183,11 +184,11 @@ class SiteDetailView(LoginRequiredMixin, SingleTableMixin, WithFilesAndNotesAndT
     def get_context_data(self, **kwargs):
         context = super(SiteDetailView, self).get_context_data(**kwargs)
         results = []
-        site = get_object_or_404(SiteView, entity_id=self.kwargs['site'])
-        equipments = EquipmentView.objects.filter(site_id=site.object_id).exclude(m_tags__contains=['point'])
-        for e in equipments:
-            data_points = PointView.objects.filter(equipment_id=e.object_id).count()
-            results.append({'site': site, 'equipment': e, 'data_points': data_points})
+        site = context['object']
+        # the equipments and their point counts come from the hierarchy index instead of a query per equipment
+        h = get_entity_hierarchy()
+        for e in h.site_equipments(site.object_id):
+            results.append({'site': site, 'equipment': e, 'data_points': len(h.equipment_points(e.object_id))})
         context['equipments'] = results
         context['link_add_url'] = reverse("core:equipment_create", kwargs={"site": self.kwargs['site']})
 
@@ -234,8 +235,11 @@ def site_ahu_summary_json(request, site):
     epoch_0 = None
     epoch_1 = None
     try:
-        for e in ahus:
-            ahu_data_points = utils.get_ahu_current_values(e.object_id)
+        ahus = list(ahus)
+        ahus_points = [utils.get_ahu_points(e.object_id) for e in ahus]
+        # query the current values of all the AHU points at once
+        utils.add_current_values([p for ahu_points in ahus_points for p in ahu_points.values()], raw=True)
+        for e, ahu_data_points in zip(ahus, ahus_points):
             logger.info('site_ahu_summary_json ==> %s', e.object_id)
             points = []
             for k, point in ahu_data_points.items():
@@ -287,41 +291,41 @@ def site_pie_chart_data_json(request, site):
         hot_threshold = float(request.GET.get('hot_threshold'))
     else:
         hot_threshold = 75
-    for e in equipments:
-        data_points = PointView.objects.filter(equipment_id=e.object_id)
-        data_points = data_points.filter(m_tags__contains=['air', 'his', 'point', 'sensor', 'temp'])
-        data_points = data_points.exclude(m_tags__contains=['equip'])
-        try:
-            for d in utils.add_current_values(data_points, raw=True):
-                cv = d.current_value.get('value', 'N/A')
-                logger.info('site_pie_chart_data_json got value %s -> %s', d.entity_id, cv)
-                if isinstance(cv, str):
-                    try:
-                        cv = float(cv)
-                    except ValueError:
-                        cv = 'N/A'
-                if 'N/A' == cv or cv > 200 or cv < -50:
-                    if 'No Data' not in pie:
-                        pie['No Data'] = 1
-                    else:
-                        pie['No Data'] += 1
-                elif cv < cold_threshold:
-                    if 'Cold' not in pie:
-                        pie['Cold'] = 1
-                    else:
-                        pie['Cold'] += 1
-                elif cv > hot_threshold:
-                    if 'Hot' not in pie:
-                        pie['Hot'] = 1
-                    else:
-                        pie['Hot'] += 1
+    # get the data points of all the equipments at once
+    data_points = PointView.objects.filter(equipment_id__in=equipments.values('object_id'))
+    data_points = data_points.filter(m_tags__contains=['air', 'his', 'point', 'sensor', 'temp'])
+    data_points = data_points.exclude(m_tags__contains=['equip'])
+    try:
+        for d in utils.add_current_values(data_points, raw=True):
+            cv = d.current_value.get('value', 'N/A')
+            logger.info('site_pie_chart_data_json got value %s -> %s', d.entity_id, cv)
+            if isinstance(cv, str):
+                try:
+                    cv = float(cv)
+                except ValueError:
+                    cv = 'N/A'
+            if 'N/A' == cv or cv > 200 or cv < -50:
+                if 'No Data' not in pie:
+                    pie['No Data'] = 1
+                else:
+                    pie['No Data'] += 1
+            elif cv < cold_threshold:
+                if 'Cold' not in pie:
+                    pie['Cold'] = 1
+                else:
+                    pie['Cold'] += 1
+            elif cv > hot_threshold:
+                if 'Hot' not in pie:
+                    pie['Hot'] = 1
                 else:
-                    if 'Comfortable' not in pie:
-                        pie['Comfortable'] = 1
-                    else:
-                        pie['Comfortable'] += 1
-        except OperationalError:
-            logging.warning('Crate database unavailable')
+                    pie['Hot'] += 1
+            else:
+                if 'Comfortable' not in pie:
+                    pie['Comfortable'] = 1
+                else:
+                    pie['Comfortable'] += 1
+    except OperationalError:
+        logging.warning('Crate database unavailable')
 
     labels = []
     values = []
@@ -18,11 +18,9 @@
 import csv
 import logging
 import json
-import tempfile
-import os
 from io import BytesIO
 from io import StringIO
-from io import TextIOWrapper
+from urllib.parse import urlencode
 from urllib.parse import urlparse
 from zipfile import ZipFile
 
@@ -517,7 +515,7 @@ def tag_topics(request):
 
     # store a dict of topic -> data_point.entity_id
     updated, _, _, _ = utils.tag_topics(filters, tags, select_all=select_all,
-                                        topics=topics, select_not_mapped_topics=snmt)
+                                        topics=topics, select_not_mapped_topics=snmt, bulk=True)
     if not updated:
         return JsonResponse({'errors': 'No Topic matched the given filters.'})
     return JsonResponse({'success': 1, 'updated': len(updated), 'tags': tags})
@@ -835,111 +833,42 @@ class TopicTagRuleSetRunView(LoginRequiredMixin, TopicTagRuleSetBCMixin, FormVie
 
     def post(self, request, *args, **kwargs):
         form = self.get_form()
-        if form.is_valid():
-            updated_set, updated_entities, preview_type, updated_tags, removed_tags, diff_format, new_eqm = form.save()
-            if preview_type:
-                if diff_format:
-                    report_rows, report_header = utils.tag_rulesets_run_report_diff(
-                                                       updated_entities, updated_tags, removed_tags)
-                    if not report_rows:
-                        messages.error(self.request, "Preview diff is empty")
-                        context = self.get_context_data(**kwargs)
-                        return self.render_to_response(context)
-                    else:
-                        if preview_type == 'preview_csv':
-                            response = HttpResponse(content_type='text/csv')
-                            response['Content-Disposition'] = 'attachment; filename="TagRulesetsPreviewDiffReport.csv"'
-
-                            writer = csv.writer(response)
-                            if report_header:
-                                writer.writerow(report_header)
-                                if report_rows:
-                                    for row in report_rows:
-                                        writer.writerow(row)
-                            else:
-                                writer.writerow([''])
-
-                        else:
-                            temp = tempfile.NamedTemporaryFile(delete=False)
-                            temp.close()
-                            with open(temp.name, 'w') as file_csv:
-                                writer = csv.writer(file_csv)
-                                if report_header:
-                                    writer.writerow(report_header)
-                                    if report_rows:
-                                        for row in report_rows:
-                                            writer.writerow(row)
-
-                                    response = HttpResponseRedirect(
-                                        reverse("core:report_preview_csv") + '?file=' + temp.name
-                                        + '&name=Tag Rulesets Preview Diff Report')
-                                else:
-                                    writer.writerow([''])
-
-                        return response
-                else:
-                    report_rows, report_header = utils.tag_rulesets_run_report(updated_entities)
-                    if preview_type == 'preview_csv':
-                        response = HttpResponse(content_type='text/csv')
-                        response['Content-Disposition'] = 'attachment; filename="TagRulesetsPreviewReport.csv"'
-
-                        writer = csv.writer(response)
-                        if report_header:
-                            writer.writerow(report_header)
-                            if report_rows:
-                                for row in report_rows:
-                                    writer.writerow(row)
-                        else:
-                            writer.writerow([''])
-
-                    else:
-                        temp = tempfile.NamedTemporaryFile(delete=False)
-                        temp.close()
-                        with open(temp.name, 'w') as file_csv:
-                            writer = csv.writer(file_csv)
-                            if report_header:
-                                writer.writerow(report_header)
-                                if report_rows:
-                                    for row in report_rows:
-                                        updated_tag = updated_tags.get(row[0])
-                                        removed_tag = removed_tags.get(row[0])
-                                        if updated_tag or removed_tag:
-                                            if not updated_tag:
-                                                updated_tag = {}
-                                            if not removed_tag:
-                                                removed_tag = {}
-                                            row_new = []
-                                            for i, value in enumerate(row):
-                                                header = report_header[i]
-                                                value_updated = updated_tag.get(header)
-                                                value_removed = removed_tag.get(header)
-                                                if value_updated:
-                                                    value += "::$$updated$$"
-                                                elif value_removed:
-                                                    value = value_removed + "::$$removed$$"
-                                                row_new.append(value)
-
-                                            writer.writerow(row_new)
-                                        else:
-                                            writer.writerow(row)
-                            else:
-                                writer.writerow([''])
-
-                        response = HttpResponseRedirect(
-                            reverse("core:report_preview_csv") + '?file=' + temp.name
-                            + '&name=Tag Rulesets Preview Report')
-
-                    return response
-            else:
-                if len(updated_set) > 0 or len(new_eqm) > 0:
-                    response = JsonResponse({'success': 1, 'updated': len(updated_set),
-                                             'new_equipments': len(new_eqm)})
-                else:
-                    response = JsonResponse({'errors': 'Nothing applied'})
-                return response
+        if not form.is_valid():
+            return self.form_invalid(form, **kwargs)
 
+        if form.cleaned_data['use_async']:
+            # run in a celery task, the previews are then viewed or downloaded from the progress page
+            task = form.run_async()
+            progress_url = reverse("core:get_task_progress", kwargs={'task_id': task.task_id})
+            if form.cleaned_data['preview_type']:
+                return HttpResponseRedirect(progress_url)
+            return JsonResponse({'success': 1, 'task_id': task.task_id, 'progress_url': progress_url})
+
+        updated_set, updated_entities, preview_type, updated_tags, removed_tags, diff_format, new_eqm = form.save()
+        if not preview_type:
+            if len(updated_set) > 0 or len(new_eqm) > 0:
+                return JsonResponse({'success': 1, 'updated': len(updated_set), 'new_equipments': len(new_eqm)})
+            return JsonResponse({'errors': 'Nothing applied'})
+
+        name = 'Tag Rulesets Preview Diff Report' if diff_format else 'Tag Rulesets Preview Report'
+        if preview_type == 'preview_csv':
+            response = HttpResponse(content_type='text/csv')
+            response['Content-Disposition'] = 'attachment; filename="{}.csv"'.format(name.replace(' ', ''))
+            has_rows = utils.write_tag_rulesets_report(response, updated_entities, updated_tags, removed_tags,
+                                                       diff_format=diff_format)
         else:
-            return self.form_invalid(form, **kwargs)
+            f = StringIO()
+            has_rows = utils.write_tag_rulesets_report(f, updated_entities, updated_tags, removed_tags,
+                                                       diff_format=diff_format, mark_changes=True)
+            if has_rows:
+                token = utils.store_report(f.getvalue())
+                response = HttpResponseRedirect(reverse("core:report_preview_csv") + '?'
+                                                + urlencode({'report': token, 'name': name}))
+        if not has_rows:
+            messages.error(self.request, "Preview diff is empty")
+            context = self.get_context_data(**kwargs)
+            return self.render_to_response(context)
+        return response
 
 
 topictagruleset_run_view = TopicTagRuleSetRunView.as_view()
@@ -1015,21 +944,20 @@ class TopicTagRuleRunView(LoginRequiredMixin, TopicTagRuleBCMixin, FormView):
                                 writer.writerow([''])
 
                         else:
-                            temp = tempfile.NamedTemporaryFile(delete=False)
-                            temp.close()
-                            with open(temp.name, 'w') as file_csv:
-                                writer = csv.writer(file_csv)
-                                if report_header:
-                                    writer.writerow(report_header)
-                                    if report_rows:
-                                        for row in report_rows:
-                                            writer.writerow(row)
-
-                                    response = HttpResponseRedirect(
-                                        reverse("core:report_preview_csv") + '?file=' + temp.name
-                                        + '&name=Tag Rule Preview Diff Report')
-                                else:
-                                    writer.writerow([''])
+                            file_csv = StringIO()
+                            writer = csv.writer(file_csv)
+                            if report_header:
+                                writer.writerow(report_header)
+                                if report_rows:
+                                    for row in report_rows:
+                                        writer.writerow(row)
+
+                                response = HttpResponseRedirect(
+                                    reverse("core:report_preview_csv") + '?' + urlencode({
+                                        'report': utils.store_report(file_csv.getvalue()),
+                                        'name': 'Tag Rule Preview Diff Report'}))
+                            else:
+                                writer.writerow([''])
 
                         return response
                 else:
@@ -1048,41 +976,40 @@ class TopicTagRuleRunView(LoginRequiredMixin, TopicTagRuleBCMixin, FormView):
                             writer.writerow([''])
 
                     else:
-                        temp = tempfile.NamedTemporaryFile(delete=False)
-                        temp.close()
-                        with open(temp.name, 'w') as file_csv:
-                            writer = csv.writer(file_csv)
-                            if report_header:
-                                writer.writerow(report_header)
-                                if report_rows:
-                                    for row in report_rows:
-                                        updated_tag = updated_tags.get(row[0])
-                                        removed_tag = removed_tags.get(row[0])
-                                        if updated_tag or removed_tag:
-                                            if not updated_tag:
-                                                updated_tag = {}
-                                            if not removed_tag:
-                                                removed_tag = {}
-                                            row_new = []
-                                            for i, value in enumerate(row):
-                                                header = report_header[i]
-                                                value_updated = updated_tag.get(header)
-                                                value_removed = removed_tag.get(header)
-                                                if value_updated:
-                                                    value += "::$$updated$$"
-                                                elif value_removed:
-                                                    value = value_removed + "::$$removed$$"
-                                                row_new.append(value)
-
-                                            writer.writerow(row_new)
-                                        else:
-                                            writer.writerow(row)
-                            else:
-                                writer.writerow([''])
+                        file_csv = StringIO()
+                        writer = csv.writer(file_csv)
+                        if report_header:
+                            writer.writerow(report_header)
+                            if report_rows:
+                                for row in report_rows:
+                                    updated_tag = updated_tags.get(row[0])
+                                    removed_tag = removed_tags.get(row[0])
+                                    if updated_tag or removed_tag:
+                                        if not updated_tag:
+                                            updated_tag = {}
+                                        if not removed_tag:
+                                            removed_tag = {}
+                                        row_new = []
+                                        for i, value in enumerate(row):
+                                            header = report_header[i]
+                                            value_updated = updated_tag.get(header)
+                                            value_removed = removed_tag.get(header)
+                                            if value_updated:
+                                                value += "::$$updated$$"
+                                            elif value_removed:
+                                                value = value_removed + "::$$removed$$"
+                                            row_new.append(value)
+
+                                        writer.writerow(row_new)
+                                    else:
+                                        writer.writerow(row)
+                        else:
+                            writer.writerow([''])
 
                         response = HttpResponseRedirect(
-                            reverse("core:report_preview_csv") + '?file=' + temp.name
-                            + '&name=Tag Rule Preview Report')
+                            reverse("core:report_preview_csv") + '?' + urlencode({
+                                'report': utils.store_report(file_csv.getvalue()),
+                                'name': 'Tag Rule Preview Report'}))
 
                     return response
             else:
@@ -1483,40 +1410,38 @@ class ReportPreviewCsvView(LoginRequiredMixin, WithBreadcrumbsMixin, TemplateVie
 
     def get_context_data(self, **kwargs):
         context = super(ReportPreviewCsvView, self).get_context_data(**kwargs)
-        file_name = self.request.GET.get('file')
+        token = self.request.GET.get('report')
         report_name = self.request.GET.get('name')
-        if file_name:
+        if token:
             report_rows = []
             report_header = []
-            try:
-                with open(file_name, 'rb') as csv_file:
-                    f = TextIOWrapper(csv_file, encoding='utf-8')
-                    reader = csv.reader(f)
-                    first_row = True
-                    for row in reader:
-                        if first_row:
-                            report_header.append(row)
-                            first_row = False
-                        else:
-                            row_new = []
-                            for value in row:
-                                item = {'value': value}
-                                if '::$$updated$$' in value:
-                                    item['op'] = 'updated'
-                                    item['value'] = value.replace('::$$updated$$', '')
-                                elif '::$$removed$$' in value:
-                                    item['op'] = 'removed'
-                                    item['value'] = value.replace('::$$removed$$', '')
-
-                                if 'type:MARKER' in value:
-                                    item['value'] = 'X'
-
-                                row_new.append(item)
-                            report_rows.append(row_new)
-            except OSError:
-                messages.error(self.request, 'Cannot open repot file')
+            # the report is removed once viewed
+            content = utils.pop_report(token)
+            if content is None:
+                messages.error(self.request, 'Cannot open report')
             else:
-                os.remove(file_name)
+                reader = csv.reader(StringIO(content))
+                first_row = True
+                for row in reader:
+                    if first_row:
+                        report_header.append(row)
+                        first_row = False
+                    else:
+                        row_new = []
+                        for value in row:
+                            item = {'value': value}
+                            if '::$$updated$$' in value:
+                                item['op'] = 'updated'
+                                item['value'] = value.replace('::$$updated$$', '')
+                            elif '::$$removed$$' in value:
+                                item['op'] = 'removed'
+                                item['value'] = value.replace('::$$removed$$', '')
+
+                            if 'type:MARKER' in value:
+                                item['value'] = 'X'
+
+                            row_new.append(item)
+                        report_rows.append(row_new)
 
             context['report_name'] = report_name
             context['report_header'] = report_header
@@ -1526,3 +1451,15 @@ class ReportPreviewCsvView(LoginRequiredMixin, WithBreadcrumbsMixin, TemplateVie
 
 
 report_preview_csv_view = ReportPreviewCsvView.as_view()
+
+
+@login_required()
+def report_download_csv(request):
+    # download a report stored by a background job, like the preview it is then removed
+    report_name = request.GET.get('name') or 'Report'
+    content = utils.pop_report(request.GET.get('report'))
+    if content is None:
+        return JsonResponse({'errors': 'Report not found'}, status=404)
+    response = HttpResponse(content, content_type='text/csv')
+    response['Content-Disposition'] = 'attachment; filename="{}.csv"'.format(report_name.replace(' ', ''))
+    return response
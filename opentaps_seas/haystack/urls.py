@@ -23,7 +23,10 @@ from .views import (
     ops_view,
     nav_view,
     hisread_view,
-    read_view
+    read_view,
+    watch_poll_view,
+    watch_sub_view,
+    watch_unsub_view
 )
 
 app_name = "haystack"
@@ -34,4 +37,7 @@ urlpatterns = [
     path("nav", view=nav_view, name="nav"),
     path("hisRead", view=hisread_view, name="hisRead"),
     path("read", view=read_view, name="read"),
+    path("watchSub", view=watch_sub_view, name="watchSub"),
+    path("watchUnsub", view=watch_unsub_view, name="watchUnsub"),
+    path("watchPoll", view=watch_poll_view, name="watchPoll"),
 ]
@@ -0,0 +1,237 @@
+# This file is part of opentaps Smart Energy Applications Suite (SEAS).
+
+# opentaps Smart Energy Applications Suite (SEAS) is free software:
+# you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# opentaps Smart Energy Applications Suite (SEAS) is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public License
+# along with opentaps Smart Energy Applications Suite (SEAS).
+# If not, see <https://www.gnu.org/licenses/>.
+
+import csv
+import io
+import json
+from datetime import datetime
+from math import isinf
+from math import isnan
+from hszinc import Grid
+from hszinc import MARKER
+from hszinc import Quantity
+from hszinc import Ref
+from hszinc import jsondumper
+from hszinc import zincdumper
+from hszinc.version import LATEST_VER
+from hszinc.zoneinfo import timezone_name
+
+MIME_ZINC = 'text/zinc'
+MIME_JSON = 'application/json'
+MIME_CSV = 'text/csv'
+
+# number of rows encoded into each chunk of the output
+ENCODE_CHUNK_SIZE = 500
+
+CSV_MARKER = '✓'
+
+_encode_str = json.encoder.encode_basestring
+# the Haystack timezone names, by tzinfo
+_tz_names = {}
+
+
+def negotiate_format(accept):
+    # returns the supported mime type with the highest quality from an Accept header, defaults to Zinc
+    best, best_q = MIME_ZINC, 0
+    if not accept:
+        return best
+    for part in accept.split(','):
+        fields = part.split(';')
+        mime = fields[0].strip().lower()
+        q = 1.0
+        for param in fields[1:]:
+            k, _, v = param.partition('=')
+            if k.strip() == 'q':
+                try:
+                    q = float(v)
+                except ValueError:
+                    q = 0
+        if mime in ENCODERS and q > best_q:
+            best, best_q = mime, q
+    return best
+
+
+def _tz_name(dt):
+    tz_name = _tz_names.get(dt.tzinfo)
+    if tz_name is None:
+        tz_name = timezone_name(dt)
+        _tz_names[dt.tzinfo] = tz_name
+    return tz_name
+
+
+def _special_number(v):
+    # Haystack writes the special numbers as NaN, INF and -INF, without unit
+    if isnan(v):
+        return 'NaN'
+    if isinf(v):
+        return 'INF' if v > 0 else '-INF'
+    return None
+
+
+def _json_float(v):
+    return '"n:{}"'.format(_special_number(v) or v)
+
+
+def _json_quantity(v):
+    special = _special_number(v.value)
+    if special:
+        return '"n:{}"'.format(special)
+    return json.dumps(jsondumper.dump_scalar(v))
+
+
+def _json_datetime(v):
+    return _encode_str('t:{} {}'.format(v.isoformat(), _tz_name(v)))
+
+
+def _json_ref(v):
+    if v.has_value:
+        return _encode_str('r:{} {}'.format(v.name, v.value))
+    return _encode_str('r:' + v.name)
+
+
+# encode a scalar to its JSON text by its exact type, other types go through the hszinc dumper
+_JSON_SCALARS = {
+    str: lambda v: _encode_str('s:' + v),
+    float: _json_float,
+    int: lambda v: '"n:{}"'.format(v),
+    bool: lambda v: 'true' if v else 'false',
+    datetime: _json_datetime,
+    Ref: _json_ref,
+}
+
+
+def json_scalar(v):
+    if v is None:
+        return 'null'
+    if v is MARKER:
+        return '"m:"'
+    f = _JSON_SCALARS.get(type(v))
+    if f:
+        return f(v)
+    if isinstance(v, Quantity):
+        return _json_quantity(v)
+    return json.dumps(jsondumper.dump_scalar(v))
+
+
+def _json_meta(meta, **raw):
+    # raw items are given as plain strings, like the grid version and the column names
+    items = [_encode_str(k) + ':' + json_scalar(v) for k, v in meta.items()]
+    items.extend(_encode_str(k) + ':' + _encode_str(v) for k, v in raw.items())
+    return '{' + ','.join(items) + '}'
+
+
+def iter_json(grid, rows):
+    # yield the Haystack JSON of the grid where rows is an iterable of dicts,
+    # null cells are omitted from the rows
+    meta = _json_meta(grid.metadata, ver=str(grid.version))
+    cols = [_json_meta(col_meta, name=name) for name, col_meta in grid.column.items()]
+    yield '{"meta":' + meta + ',"cols":[' + ','.join(cols) + '],"rows":['
+
+    keys = [(c, _encode_str(c) + ':') for c in grid.column.keys()]
+    chunk = []
+    sep = ''
+    for row in rows:
+        cells = []
+        for c, key in keys:
+            v = row.get(c)
+            if v is not None:
+                cells.append(key + json_scalar(v))
+        chunk.append(sep + '{' + ','.join(cells) + '}')
+        sep = ','
+        if len(chunk) >= ENCODE_CHUNK_SIZE:
+            yield ''.join(chunk)
+            chunk = []
+    chunk.append(']}')
+    yield ''.join(chunk)
+
+
+def _csv_ref(v):
+    if v.has_value:
+        return '@{} {}'.format(v.name, v.value)
+    return '@' + v.name
+
+
+def zinc_scalar(v, version=LATEST_VER):
+    # same as the hszinc dumper except for the special numbers
+    if type(v) is float:
+        special = _special_number(v)
+        if special:
+            return special
+    elif isinstance(v, Quantity):
+        special = _special_number(v.value)
+        if special:
+            return special
+    return zincdumper.dump_scalar(v, version=version)
+
+
+_CSV_SCALARS = {
+    str: lambda v: v,
+    float: lambda v: _special_number(v) or str(v),
+    int: str,
+    bool: lambda v: 'true' if v else 'false',
+    datetime: lambda v: '{} {}'.format(v.isoformat(), _tz_name(v)),
+    Ref: _csv_ref,
+}
+
+
+def csv_scalar(v):
+    if v is None:
+        return ''
+    if v is MARKER:
+        return CSV_MARKER
+    f = _CSV_SCALARS.get(type(v))
+    if f:
+        return f(v)
+    return zinc_scalar(v)
+
+
+def iter_csv(grid, rows):
+    # yield the Haystack CSV of the grid: a header with the column names then one line per row
+    columns = list(grid.column.keys())
+    buf = io.StringIO()
+    writer = csv.writer(buf, lineterminator='\n')
+    writer.writerow(columns)
+    n = 0
+    for row in rows:
+        writer.writerow([csv_scalar(row.get(c)) for c in columns])
+        n += 1
+        if n >= ENCODE_CHUNK_SIZE:
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+            n = 0
+    yield buf.getvalue()
+
+
+def iter_zinc(grid, rows):
+    # the dumper would also write the rows of the grid, so only give it the header
+    yield zincdumper.dump_grid(Grid(version=grid.version, metadata=grid.metadata, columns=grid.column))
+    columns = list(grid.column.keys())
+    for row in rows:
+        yield ','.join([zinc_scalar(row.get(c), version=grid.version) for c in columns]) + '\n'
+
+
+ENCODERS = {
+    MIME_ZINC: iter_zinc,
+    MIME_JSON: iter_json,
+    MIME_CSV: iter_csv,
+}
+
+
+def encode_grid(grid, rows, mime=MIME_ZINC):
+    # yield the text chunks of the grid metadata and columns and the given rows in the given format
+    return ENCODERS[mime](grid, rows)
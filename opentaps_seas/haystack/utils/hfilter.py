@@ -15,18 +15,26 @@
 # along with opentaps Smart Energy Applications Suite (SEAS).
 # If not, see <https://www.gnu.org/licenses/>.
 
+from functools import lru_cache
+from django.db.models import Q
+from hszinc import MARKER
 from .common import ParseException
 from .hbool import HBool
+from .hnum import HNum
 from .href import HRef
 from .htoken import HaystackToken
 from .htokenizer import HaystackTokenizer
 
+# number of parsed filter strings kept in memory
+FILTER_CACHE_SIZE = 256
+
 
 # HFilter models a parsed tag query string.
 class HFilter(object):
 
     def __init__(self):
         self.string = None
+        self.compiled = None
 
     # //////////////////////////////////////////////////////////////////////////
     # // Encoding
@@ -34,10 +42,11 @@ class HFilter(object):
 
     # Decode a string into a HFilter; return null or throw
     # ParseException if not formatted correctly
+    # The parsed filters are cached by string so they must not be modified.
     @classmethod
     def make(cls, s, checked=True):
         try:
-            return FilterParser(s).parse()
+            return parse_filter(s)
         except Exception as e:
             if not checked:
                 return None
@@ -112,6 +121,26 @@ class HFilter(object):
     def include(self, _dict, pather):
         raise NotImplementedError()
 
+    # Return a function (_dict, pather) -> bool equivalent to include
+    # but made of closures instead of walking the filter tree.
+    def compile(self):
+        if self.compiled is None:
+            self.compiled = self.doCompile()
+        return self.compiled
+
+    def doCompile(self):
+        raise NotImplementedError()
+
+    # Return the list of paths that need a Pather to be resolved.
+    def refPaths(self):
+        return []
+
+    # Return a tuple (Q, exact) to filter the Entity model where the Q matches
+    # the same entities as include when exact is True, else a superset of them
+    # that must still be checked with include.
+    def toQuery(self):
+        return Q(), False
+
     # String encoding
     def toString(self):
         if self.string is None:
@@ -147,6 +176,16 @@ class Pather(object):
     def find(self, ref):
         raise NotImplementedError()
 
+
+# Return the string identifier of a ref value, which are stored as
+# plain strings in the entities tags, or None if it cannot be a ref.
+def ref_id(val):
+    if isinstance(val, HRef):
+        return val.val
+    if isinstance(val, str):
+        return val
+    return None
+
 # //////////////////////////////////////////////////////////////////////////
 # // HFilter.Path
 # //////////////////////////////////////////////////////////////////////////
@@ -246,6 +285,27 @@ class PathN(Path):
     def toString(self):
         return self.string
 
+# //////////////////////////////////////////////////////////////////////////
+# // Query helpers
+# //////////////////////////////////////////////////////////////////////////
+
+# Those match the dict built from an Entity in the read view: the kv_tags values,
+# then the m_tags as MARKER, and the entity_id as id when there is no id tag.
+
+
+def has_tag_query(name):
+    if name == 'id':
+        return Q()
+    return Q(kv_tags__has_key=name) | Q(m_tags__contains=[name])
+
+
+def tag_value_query(name, s):
+    # the name is given as a key of the hstore containment so it is never parsed as a transform or lookup
+    q = Q(kv_tags__contains={name: s})
+    if name == 'id':
+        q = q | (~Q(kv_tags__has_key='id') & Q(entity_id=s))
+    return q & ~Q(m_tags__contains=[name])
+
 # //////////////////////////////////////////////////////////////////////////
 # // PathFilter
 # //////////////////////////////////////////////////////////////////////////
@@ -260,27 +320,65 @@ class PathFilter(HFilter):
         # default implementation
         if not pather:
             pather = Pather()
-        print('PathFilter::include', _dict)
-        print('PathFilter::include get from path', self.path, self.path.size())
-        print('PathFilter::include get', self.path.get(0))
         val = _dict.get(self.path.get(0), None)
-        print('PathFilter::include got val', val)
         if self.path.size() != 1:
-            nt = _dict
-            for i in range(self.path.size()):
-                if not isinstance(val, HRef):
+            for i in range(1, self.path.size()):
+                ref = ref_id(val)
+                if ref is None:
                     val = None
                     break
-                nt = pather.find(val.val)
+                nt = pather.find(ref)
                 if (nt is None):
                     val = None
                     break
-                val = nt.get(self.path.get(i), False)
+                val = nt.get(self.path.get(i), None)
         return self.doInclude(val)
 
+    def refPaths(self):
+        if self.path.size() != 1:
+            return [self.path]
+        return []
+
     def doInclude(self, val):
         raise NotImplementedError()
 
+    def doCompile(self):
+        check = self.compileCheck()
+        first = self.path.get(0)
+        if self.path.size() == 1:
+            return lambda _dict, pather: check(_dict.get(first))
+
+        names = [self.path.get(i) for i in range(1, self.path.size())]
+
+        def include(_dict, pather):
+            if not pather:
+                pather = Pather()
+            val = _dict.get(first)
+            for name in names:
+                ref = ref_id(val)
+                if ref is None:
+                    return check(None)
+                nt = pather.find(ref)
+                if nt is None:
+                    return check(None)
+                val = nt.get(name)
+            return check(val)
+        return include
+
+    # Return a function val -> bool equivalent to doInclude
+    def compileCheck(self):
+        raise NotImplementedError()
+
+    def toQuery(self):
+        # only single name paths can be pushed down, others need a Pather
+        # but at least the first tag of the path must be a ref
+        if self.path.size() != 1:
+            return has_tag_query(self.path.get(0)), False
+        return self.doQuery(self.path.get(0))
+
+    def doQuery(self, name):
+        return Q(), False
+
 # //////////////////////////////////////////////////////////////////////////
 # // Has
 # //////////////////////////////////////////////////////////////////////////
@@ -294,6 +392,18 @@ class Has(PathFilter):
         print('Has::doInclude', v)
         return v is not None
 
+    def doCompile(self):
+        if self.path.size() == 1:
+            name = self.path.get(0)
+            return lambda _dict, pather: _dict.get(name) is not None
+        return super(Has, self).doCompile()
+
+    def compileCheck(self):
+        return lambda v: v is not None
+
+    def doQuery(self, name):
+        return has_tag_query(name), True
+
     def toStr(self):
         return self.path.toString()
 
@@ -310,6 +420,27 @@ class Missing(PathFilter):
         print('Missing::doInclude', v)
         return v is None
 
+    def doCompile(self):
+        if self.path.size() == 1:
+            name = self.path.get(0)
+            return lambda _dict, pather: _dict.get(name) is None
+        return super(Missing, self).doCompile()
+
+    def compileCheck(self):
+        return lambda v: v is None
+
+    def toQuery(self):
+        # a path is missing as soon as one of its refs is
+        if self.path.size() != 1:
+            return Q(), False
+        return super(Missing, self).toQuery()
+
+    def doQuery(self, name):
+        if name == 'id':
+            # always defined
+            return Q(pk__in=[]), True
+        return ~has_tag_query(name), True
+
     def toStr(self):
         return "not " + self.path.toString()
 
@@ -330,6 +461,21 @@ class CmpFilter(PathFilter):
     def sameType(self, v):
         return v is not None and isinstance(v, type(self.val))
 
+    # The string the tag values are compared to, or None if the comparison
+    # cannot be done on the string values (numbers are parsed from the values).
+    def stringVal(self, name):
+        if isinstance(self.val, HNum):
+            return None
+        s = str(self.val)
+        # markers are given as the MARKER value which could equal it
+        if s == str(MARKER):
+            return None
+        return s
+
+    # Default to the superset of the entities having the tag
+    def doQuery(self, name):
+        return has_tag_query(name), False
+
     def cmpStr(self):
         raise NotImplementedError()
 
@@ -349,6 +495,16 @@ class Eq(CmpFilter):
         print('Eq::doInclude', type(v), v, type(self.val), self.val, v == self.val)
         return v is not None and v == self.val
 
+    def compileCheck(self):
+        val = self.val
+        return lambda v: v is not None and v == val
+
+    def doQuery(self, name):
+        s = self.stringVal(name)
+        if s is None:
+            return super(Eq, self).doQuery(name)
+        return tag_value_query(name, s), True
+
 # //////////////////////////////////////////////////////////////////////////
 # // Ne
 # //////////////////////////////////////////////////////////////////////////
@@ -365,6 +521,16 @@ class Ne(CmpFilter):
         print('Ne::doInclude', v, self.val)
         return v is not None and not v == self.val
 
+    def compileCheck(self):
+        val = self.val
+        return lambda v: v is not None and not v == val
+
+    def doQuery(self, name):
+        s = self.stringVal(name)
+        if s is None:
+            return super(Ne, self).doQuery(name)
+        return has_tag_query(name) & ~tag_value_query(name, s), True
+
 # //////////////////////////////////////////////////////////////////////////
 # // Lt
 # //////////////////////////////////////////////////////////////////////////
@@ -379,7 +545,11 @@ class Lt(CmpFilter):
 
     def doInclude(self, v):
         print('Lt::doInclude', v, self.val)
-        return v < self.val
+        return v is not None and v < self.val
+
+    def compileCheck(self):
+        val = self.val
+        return lambda v: v is not None and v < val
 
 # //////////////////////////////////////////////////////////////////////////
 # // Le
@@ -395,7 +565,11 @@ class Le(CmpFilter):
 
     def doInclude(self, v):
         print('Le::doInclude', v, self.val)
-        return v <= self.val
+        return v is not None and v <= self.val
+
+    def compileCheck(self):
+        val = self.val
+        return lambda v: v is not None and v <= val
 
 # //////////////////////////////////////////////////////////////////////////
 # // Gt
@@ -411,7 +585,11 @@ class Gt(CmpFilter):
 
     def doInclude(self, v):
         print('Gt::doInclude', type(v), v, type(self.val), self.val, v > self.val)
-        return v > self.val
+        return v is not None and v > self.val
+
+    def compileCheck(self):
+        val = self.val
+        return lambda v: v is not None and v > val
 
 # //////////////////////////////////////////////////////////////////////////
 # // Ge
@@ -427,7 +605,11 @@ class Ge(CmpFilter):
 
     def doInclude(self, v):
         print('Ge::doInclude', v, self.val)
-        return v >= self.val
+        return v is not None and v >= self.val
+
+    def compileCheck(self):
+        val = self.val
+        return lambda v: v is not None and v >= val
 
 # //////////////////////////////////////////////////////////////////////////
 # // Compound
@@ -436,12 +618,16 @@ class Ge(CmpFilter):
 
 class CompoundFilter(HFilter):
     def __init__(self, a, b):
+        super(CompoundFilter, self).__init__()
         self.a = a
         self.b = b
 
     def keyword(self):
         raise NotImplementedError()
 
+    def refPaths(self):
+        return self.a.refPaths() + self.b.refPaths()
+
     def toStr(self):
         s = ''
         if isinstance(self.a, CompoundFilter):
@@ -474,6 +660,16 @@ class And(CompoundFilter):
         print('And::include', self.a, self.b)
         return self.a.include(_dict, pather) and self.b.include(_dict, pather)
 
+    def doCompile(self):
+        a = self.a.compile()
+        b = self.b.compile()
+        return lambda _dict, pather: a(_dict, pather) and b(_dict, pather)
+
+    def toQuery(self):
+        qa, ea = self.a.toQuery()
+        qb, eb = self.b.toQuery()
+        return qa & qb, ea and eb
+
 # //////////////////////////////////////////////////////////////////////////
 # // Or
 # //////////////////////////////////////////////////////////////////////////
@@ -490,6 +686,21 @@ class Or(CompoundFilter):
         print('Or::include', self.a, self.b)
         return self.a.include(_dict, pather) or self.b.include(_dict, pather)
 
+    def doCompile(self):
+        a = self.a.compile()
+        b = self.b.compile()
+        return lambda _dict, pather: a(_dict, pather) or b(_dict, pather)
+
+    def toQuery(self):
+        qa, ea = self.a.toQuery()
+        qb, eb = self.b.toQuery()
+        # an empty Q matches everything, exactly or because it could not be pushed down
+        if not qa:
+            return Q(), ea
+        if not qb:
+            return Q(), eb
+        return qa | qb, ea and eb
+
 # //////////////////////////////////////////////////////////////////////////
 # // FilterParser
 # //////////////////////////////////////////////////////////////////////////
@@ -616,3 +827,8 @@ class FilterParser:
         self.curVal = self.peekVal
         self.peek = self.tokenizer.next()
         self.peekVal = self.tokenizer.val
+
+
+@lru_cache(maxsize=FILTER_CACHE_SIZE)
+def parse_filter(s):
+    return FilterParser(s).parse()
@@ -15,6 +15,7 @@
 # along with opentaps Smart Energy Applications Suite (SEAS).
 # If not, see <https://www.gnu.org/licenses/>.
 
+import re
 from .hnum import HNum
 from .hstr import HStr
 from .href import HRef
@@ -24,13 +25,56 @@ from .htime import HTime
 from .huri import HUri
 from .htoken import HaystackToken
 
+# chars that would continue a number token, a literal followed by one is left to the char by char tokenizer
+_NUM_PART = r'[0-9a-zA-Z:+.%$/_\-\u0080-\U0010ffff]'
+# Regular expression for the common tokens, anything else goes through the char by char tokenizer
+_TOKEN_RE = re.compile(
+    r'[ \t]*(?:'
+    r'(?P<nl>\r\n|\r|\n)'
+    r'|(?P<id>[a-zA-Z][a-zA-Z0-9_]*)'
+    r'|"(?P<str>[^"\\]*)"'
+    r'|@(?P<ref>[a-zA-Z0-9_:\-.~@]+)'
+    r'|(?P<dateTime>\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}(?:\.\d+)?(?:Z|[+-]\d{2}:\d{2}))(?!' + _NUM_PART + ')'
+    r'|(?P<date>\d{4}-\d{2}-\d{2})(?!' + _NUM_PART + ')'
+    r'|(?P<time>\d{1,2}:\d{2}(?::\d{2}(?:\.\d+)?)?)(?!' + _NUM_PART + ')'
+    r'|(?P<num>-?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?)(?P<unit>[a-zA-Z%$/\u0080-\U0010ffff]+)?(?!' + _NUM_PART + ')'
+    r'|(?P<symbol>->|==|!=|<=|>=|<<|>>|[,:;\[\]{}()<>=!]|-(?![0-9]))'
+    r'|(?P<eof>\Z)'
+    r')')
+_SYMBOLS = {
+    ',': HaystackToken.comma,
+    ':': HaystackToken.colon,
+    ';': HaystackToken.semicolon,
+    '[': HaystackToken.lbracket,
+    ']': HaystackToken.rbracket,
+    '{': HaystackToken.lbrace,
+    '}': HaystackToken.rbrace,
+    '(': HaystackToken.lparen,
+    ')': HaystackToken.rparen,
+    '<': HaystackToken.lt,
+    '>': HaystackToken.gt,
+    '-': HaystackToken.minus,
+    '=': HaystackToken.assign,
+    '!': HaystackToken.bang,
+    '<<': HaystackToken.lt2,
+    '<=': HaystackToken.ltEq,
+    '>>': HaystackToken.gt2,
+    '>=': HaystackToken.gtEq,
+    '->': HaystackToken.arrow,
+    '==': HaystackToken.eq,
+    '!=': HaystackToken.notEq,
+}
+
 
 #  * Stream based tokenizer for Haystack formats such as Zinc and Filters
 class HaystackTokenizer(object):
     # ////////////////////////////////////////////////////////////////////////
     #  Construction
     # ////////////////////////////////////////////////////////////////////////
-    def __init__(self, in_):
+    # When fast is False only the char by char tokenizer is used
+    def __init__(self, in_, fast=True):
+        self.fast = fast
+        self.val = None
         self.cur = None
         self.peek = None
         self.char_index = 0
@@ -51,6 +95,52 @@ class HaystackTokenizer(object):
     #  Tokenizing
     # ////////////////////////////////////////////////////////////////////////
     def next(self):
+        if self.fast:
+            tok = self.nextFast()
+            if tok is not None:
+                self.tok = tok
+                return tok
+        return self.nextChar()
+
+    # Scan the next token with the regular expression on the input string,
+    # returns None when it must be read char by char instead.
+    def nextFast(self):
+        self.val = None
+        m = _TOKEN_RE.match(self.in_, self.pos())
+        if not m:
+            return None
+        kind = m.lastgroup
+        self.seek(m.end())
+        if kind == 'id':
+            self.val = m.group('id')
+            return HaystackToken.id
+        if kind == 'symbol':
+            return _SYMBOLS[m.group('symbol')]
+        if kind == 'str':
+            self.val = HStr.make(m.group('str'))
+            return HaystackToken.str_
+        if kind == 'ref':
+            self.val = HRef(m.group('ref'), None)
+            return HaystackToken.ref
+        if kind == 'num':
+            return self.number(m.group('num'), 0)
+        if kind == 'unit':
+            num = m.group('num')
+            return self.number(num + m.group('unit'), len(num))
+        if kind == 'nl':
+            self.line += 1
+            return HaystackToken.nl
+        if kind == 'eof':
+            return HaystackToken.eof
+        if kind == 'dateTime':
+            # reads the timezone
+            return self.dateTime(m.group('dateTime'))
+        if kind == 'date':
+            return self.date(m.group('date'))
+        s = m.group('time')
+        return self.time(s, s.count(':') == 1)
+
+    def nextChar(self):
         #  reset
         self.val = None
         #  skip non-meaningful whitespace and comments
@@ -480,6 +570,17 @@ class HaystackTokenizer(object):
     # ////////////////////////////////////////////////////////////////////////
     #  Char
     # ////////////////////////////////////////////////////////////////////////
+    # Index of the current char
+    def pos(self):
+        return self.char_index - 2 + (self.peek is None) + (self.cur is None)
+
+    # Move the current char to the given index
+    def seek(self, pos):
+        n = len(self.in_)
+        self.cur = self.in_[pos] if pos < n else self.eof
+        self.peek = self.in_[pos + 1] if pos + 1 < n else self.eof
+        self.char_index = min(pos + 2, n)
+
     def consume(self, expected=None):
         if expected:
             if self.cur != expected:
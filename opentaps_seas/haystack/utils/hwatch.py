@@ -0,0 +1,116 @@
+# This file is part of opentaps Smart Energy Applications Suite (SEAS).
+
+# opentaps Smart Energy Applications Suite (SEAS) is free software:
+# you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# opentaps Smart Energy Applications Suite (SEAS) is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public License
+# along with opentaps Smart Energy Applications Suite (SEAS).
+# If not, see <https://www.gnu.org/licenses/>.
+
+import logging
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+from ...core import utils
+
+logger = logging.getLogger(__name__)
+
+WATCH_CACHE_KEY_PREFIX = 'haystack_watch:'
+
+# lease units given to watchSub, in seconds
+LEASE_UNITS = {'ms': 0.001, 's': 1, 'sec': 1, 'min': 60, 'h': 3600, 'hr': 3600}
+
+
+def parse_lease(lease):
+    # the lease is a Number with an optional duration unit, eg: 30s or 5min, seconds by default
+    # returns None when not given or invalid
+    if not lease:
+        return None
+    lease = lease.strip()
+    unit = lease.lstrip('0123456789.')
+    try:
+        value = float(lease[:len(lease) - len(unit)])
+    except ValueError:
+        return None
+    factor = LEASE_UNITS.get(unit.strip() or 's')
+    if not factor or value <= 0:
+        return None
+    return min(int(value * factor) or 1, settings.HAYSTACK_WATCH_MAX_LEASE)
+
+
+class Watch(object):
+    # the server side state of a Haystack watch, kept in the cache until its lease expires
+    # points: entity_id -> [topic, kind] of the subscribed points
+    # last: entity_id -> [epoch, string_value] of the latest value returned to the client
+
+    def __init__(self, watch_id, dis=None, lease=None, points=None, last=None):
+        self.watch_id = watch_id
+        self.dis = dis
+        self.lease = lease or settings.HAYSTACK_WATCH_LEASE
+        self.points = points or {}
+        self.last = last or {}
+
+    @staticmethod
+    def _cache_key(watch_id):
+        return WATCH_CACHE_KEY_PREFIX + watch_id
+
+    @classmethod
+    def create(cls, dis=None, lease=None):
+        return cls(uuid.uuid4().hex, dis=dis, lease=lease)
+
+    @classmethod
+    def get(cls, watch_id):
+        if not watch_id:
+            return None
+        d = cache.get(cls._cache_key(watch_id))
+        if not d:
+            return None
+        return cls(watch_id, **d)
+
+    def save(self):
+        # also renews the lease
+        cache.set(self._cache_key(self.watch_id), {
+            'dis': self.dis,
+            'lease': self.lease,
+            'points': self.points,
+            'last': self.last
+        }, self.lease)
+
+    def delete(self):
+        cache.delete(self._cache_key(self.watch_id))
+
+    def subscribe(self, points):
+        for p in points:
+            self.points[p.entity_id] = [p.topic, p.kind]
+
+    def unsubscribe(self, entity_ids):
+        for entity_id in entity_ids:
+            self.points.pop(entity_id, None)
+            self.last.pop(entity_id, None)
+
+    def poll(self, entity_ids=None, refresh=False):
+        # returns a dict of entity_id -> (ts, string_value) of the points whose latest value
+        # changed since the last poll, or all of them on refresh (with (None, None) when there is no data)
+        if entity_ids is None:
+            entity_ids = list(self.points.keys())
+        latest = utils.get_latest_topics_values([self.points[e][0] for e in entity_ids])
+        changed = {}
+        for entity_id in entity_ids:
+            v = latest.get(self.points[entity_id][0])
+            if v:
+                current = [utils.to_epoch_ms(v[0]), v[1]]
+                if refresh or self.last.get(entity_id) != current:
+                    self.last[entity_id] = current
+                    changed[entity_id] = (v[0], v[1])
+            elif refresh:
+                changed[entity_id] = (None, None)
+        return changed
@@ -15,28 +15,115 @@
 # along with opentaps Smart Energy Applications Suite (SEAS).
 # If not, see <https://www.gnu.org/licenses/>.
 
+import base64
 import hszinc
 import logging
+from datetime import datetime
+from itertools import islice
 
 from django.contrib.sites.models import Site
+from django.db.models import Q
 from django.http import HttpResponse
+from django.http import StreamingHttpResponse
 from django.utils import timezone
 
+from ..core.hierarchy import get_entity_hierarchy
 from ..core.models import Entity
 from ..core.models import PointView
 from ..core import utils
+from .utils.hencoder import MIME_CSV
+from .utils.hencoder import MIME_JSON
+from .utils.hencoder import MIME_ZINC
+from .utils.hencoder import encode_grid
+from .utils.hencoder import negotiate_format
 from .utils.hfilter import HFilter
 from .utils.hfilter import Pather
+from .utils.hfilter import ref_id
+from .utils.hwatch import Watch
+from .utils.hwatch import parse_lease
 
 
 logger = logging.getLogger(__name__)
 
+# number of entities checked at once against filters that need to resolve refs
+READ_CHUNK_SIZE = 1000
 
-def _hzinc_response(data, **kwargs):
-    if len(data.column) == 0:
+
+def _entity_to_dict(e):
+    # the dict of an entity as matched by the filters: the kv_tags values,
+    # the m_tags as MARKER and by default uses the id tag, but fallback to entity_id
+    e_data = {}
+    if e.kv_tags:
+        for f in e.kv_tags.keys():
+            e_data[f] = e.kv_tags[f]
+    for f in e.m_tags:
+        e_data[f] = hszinc.MARKER
+    if 'id' not in e_data:
+        e_data['id'] = e.entity_id
+    return e_data
+
+
+class EntityPather(Pather):
+    # resolves the refs of a request from a dict of id -> entity dict
+    # which are loaded in batches: one query per hop of the paths for a list of entities
+
+    def __init__(self):
+        self.entities = {}
+
+    def find(self, ref):
+        if ref not in self.entities:
+            self.load([ref])
+        return self.entities[ref]
+
+    def load(self, refs):
+        refs = set([r for r in refs if r is not None and r not in self.entities])
+        if not refs:
+            return
+        for e in Entity.objects.filter(Q(kv_tags__id__in=refs) | (Q(entity_id__in=refs) & ~Q(kv_tags__has_key='id'))):
+            e_data = _entity_to_dict(e)
+            self.entities[e_data['id']] = e_data
+        # remember the refs not found too
+        for r in refs:
+            self.entities.setdefault(r, None)
+
+    def prefetch(self, dicts, paths):
+        # resolve all the refs needed to follow the given paths from the given entity dicts
+        for path in paths:
+            current = dicts
+            for i in range(path.size() - 1):
+                refs = [ref_id(d.get(path.get(i))) for d in current]
+                self.load(refs)
+                current = [self.entities[r] for r in refs if r is not None and self.entities[r]]
+                if not current:
+                    break
+
+
+def _grid_response(request, grid, **kwargs):
+    # encode the grid in the format given by the Accept header, Zinc by default
+    if len(grid.column) == 0:
         # trick to get an empty grid without crashing the dumper
-        data.column['empty'] = {}
-    return HttpResponse(hszinc.dump(data), content_type="text/zinc;charset=utf-8", **kwargs)
+        grid.column['empty'] = {}
+    mime = negotiate_format(request.META.get('HTTP_ACCEPT'))
+    if MIME_ZINC == mime:
+        content = hszinc.dump(grid)
+    else:
+        content = ''.join(encode_grid(grid, grid, mime))
+    return HttpResponse(content, content_type=mime + ";charset=utf-8", **kwargs)
+
+
+def _grid_streaming_response(request, grid, rows, **kwargs):
+    # the grid only holds the metadata and the columns, which are written first
+    # then the rows are encoded by chunks from the given iterable of dicts
+    if len(grid.column) == 0:
+        grid.column['empty'] = {}
+    mime = negotiate_format(request.META.get('HTTP_ACCEPT'))
+    return StreamingHttpResponse(encode_grid(grid, rows, mime), content_type=mime + ";charset=utf-8", **kwargs)
+
+
+def _add_columns(grid, names):
+    for f in names:
+        if f not in grid.column:
+            grid.column[f] = {}
 
 
 def about_view(request):
@@ -62,7 +149,7 @@ def about_view(request):
         'serverTime': timezone.now(),
         'vendorName': 'Opentaps-SEAS Haystack'
     }])
-    return _hzinc_response(g)
+    return _grid_response(request, g)
 
 
 def ops_view(request):
@@ -87,8 +174,17 @@ def ops_view(request):
     }, {
         'name': 'nav',
         'summary': 'Navigate record tree'
+    }, {
+        'name': 'watchSub',
+        'summary': 'Watch subscription'
+    }, {
+        'name': 'watchUnsub',
+        'summary': 'Watch unsubscription'
+    }, {
+        'name': 'watchPoll',
+        'summary': 'Watch poll cov or refresh'
     }])
-    return _hzinc_response(g)
+    return _grid_response(request, g)
 
 
 def formats_view(request):
@@ -96,92 +192,167 @@ def formats_view(request):
     g.column['mime'] = {}
     g.column['read'] = {}
     g.column['write'] = {}
+    # requests are only given as query parameters, so only Zinc is read
     g.extend([{
-        'mime': 'text/zinc',
+        'mime': MIME_ZINC,
         'read': hszinc.MARKER,
         'write': hszinc.MARKER
+    }, {
+        'mime': MIME_JSON,
+        'write': hszinc.MARKER
+    }, {
+        'mime': MIME_CSV,
+        'write': hszinc.MARKER
     }])
-    return HttpResponse(hszinc.dump(g), content_type="text/zinc;charset=utf-8")
+    return _grid_response(request, g)
 
 
 def nav_view(request):
     g = hszinc.Grid()
     navId = request.GET.get('navId')
-    root = None
+    # walk the tree from the in memory hierarchy, only the listed entities are loaded
+    h = get_entity_hierarchy()
     if navId:
-        try:
-            root = Entity.objects.get(entity_id=navId)
-        except Entity.DoesNotExist:
-            return _hzinc_response(g, status=404)
-
-    entities = None
-    if root:
-        eid = root.entity_id
-        if 'id' in root.kv_tags:
-            eid = root.kv_tags['id']
+        root = h.get_by_entity_id(navId)
+        if not root:
+            return _grid_response(request, g, status=404)
         # list the entities linked to root
-        if 'site' in root.m_tags:
-            entities = Entity.objects.filter(kv_tags__contains={'siteRef': eid}).exclude(kv_tags__has_key='equipRef')
-        elif 'equip' in root.m_tags:
-            entities = Entity.objects.filter(kv_tags__contains={'equipRef': eid})
+        nodes = h.children(root)
     else:
         # list the sites
-        entities = Entity.objects.filter(m_tags__contains=['site'])
+        nodes = h.sites
 
-    if not entities or len(entities) == 0:
-        return _hzinc_response(g, status=404)
+    if not nodes:
+        return _grid_response(request, g, status=404)
 
-    # stores the entity_id
-    added_fields = []
-    data = []
+    entities = Entity.objects.filter(entity_id__in=[n.entity_id for n in nodes]).order_by('entity_id')
+    # first only read the tag names for the columns, then stream the entities
     g.column['navId'] = {}
-    # read which fields to include
-    for e in entities:
-        e_data = {'navId': e.entity_id}
-        if e.kv_tags:
-            for f in e.kv_tags.keys():
-                e_data[f] = e.kv_tags[f]
-                if f not in added_fields:
-                    added_fields.append(f)
-                    g.column[f] = {}
+    for kv_keys, m_tags in entities.values_list('kv_tags__keys', 'm_tags').iterator():
+        _add_columns(g, kv_keys or [])
+        _add_columns(g, m_tags or [])
+
+    def rows():
+        for e in entities.iterator():
+            e_data = {'navId': e.entity_id}
+            if e.kv_tags:
+                for f in e.kv_tags.keys():
+                    e_data[f] = e.kv_tags[f]
+            for f in e.m_tags:
+                e_data[f] = hszinc.MARKER
+            yield e_data
+
+    return _grid_streaming_response(request, g, rows())
+
+
+def _his_ts(ts):
+    # the timestamps from Crate are epoch ms
+    if isinstance(ts, datetime):
+        return ts
+    return datetime.utcfromtimestamp(utils.to_epoch_ms(ts) // 1000).replace(tzinfo=timezone.utc)
+
+
+def _request_ids(request):
+    # the batch form of hisRead and the watches give the points as id0, id1, ...
+    e_ids = []
+    while True:
+        e_id = request.GET.get('id{}'.format(len(e_ids)))
+        if not e_id:
+            return e_ids
+        e_ids.append(e_id)
+
+
+def _hisread_batch_response(request, g, e_ids, e_range, max_points, downsample=None):
+    # all the points are read with a single query grouped by topic and time bucket
+    # the response has the ts column and one vN column per requested id
+    points = {p.entity_id: p for p in PointView.objects.filter(entity_id__in=e_ids)}
+    if any(e_id not in points for e_id in e_ids):
+        return _grid_response(request, g, status=404)
+
+    date_trunc = utils.DEFAULT_RES
+    if max_points:
+        start, end = utils.get_start_date_from_range(e_range)
+        date_trunc = utils.get_resolution_for_max_points(start, end, max_points)
+
+    # points without a topic have no data, but still get their column
+    matrix_points = []
+    value_columns = []
+    g.column['ts'] = {}
+    for i, e_id in enumerate(e_ids):
+        p = points[e_id]
+        column = 'v{}'.format(i)
+        g.column[column] = {'id': hszinc.Ref(e_id)}
+        if p.topic:
+            value_columns.append(column)
+            matrix_points.append(p)
 
-        for f in e.m_tags:
-            e_data[f] = hszinc.MARKER
-            if f not in added_fields:
-                added_fields.append(f)
-                g.column[f] = {}
+    matrix = utils.get_points_matrix(matrix_points, trange=e_range, date_trunc=date_trunc)
+    if max_points:
+        matrix = utils.downsample_points_matrix(matrix, max_points, method=downsample)
 
-        logger.info("nav_view: add data %s", e_data)
-        data.append(e_data)
+    def rows():
+        for row in matrix['rows']:
+            e_data = {'ts': _his_ts(row[0])}
+            for column, value in zip(value_columns, row[1:]):
+                e_data[column] = value
+            yield e_data
 
-    # set the data
-    g.extend(data)
-    return _hzinc_response(g)
+    return _grid_streaming_response(request, g, rows())
 
 
 def hisread_view(request):
     g = hszinc.Grid()
     e_id = request.GET.get('id')
+    e_ids = _request_ids(request)
     e_range = request.GET.get('range')
-    if not e_id or not e_range:
-        return _hzinc_response(g, status=404)
+    if not (e_id or e_ids) or not e_range:
+        return _grid_response(request, g, status=404)
+
+    max_points = utils.parse_max_points(request.GET.get('maxPoints'))
+    downsample = request.GET.get('downsample')
+    if e_ids:
+        return _hisread_batch_response(request, g, e_ids, e_range, max_points, downsample=downsample)
 
     try:
         e = PointView.objects.get(entity_id=e_id)
     except PointView.DoesNotExist:
-        return _hzinc_response(g, status=404)
+        return _grid_response(request, g, status=404)
 
-    values = utils.get_point_values(e, trange=e_range, ts_as_datetime=True)
+    if max_points:
+        values = utils.get_point_values(e, trange=e_range, ts_as_datetime=True,
+                                        max_points=max_points, downsample=downsample)
+    else:
+        # stream the values as they are read
+        values = utils.iter_point_values(e, trange=e_range)
 
     g.metadata['id'] = e.entity_id
     g.column['ts'] = {}
     g.column['val'] = {}
-    data = []
-    for v in values:
-        data.append({'ts': v[0], 'val': v[1]})
 
-    g.extend(data)
-    return _hzinc_response(g)
+    def rows():
+        for v in values:
+            yield {'ts': _his_ts(v[0]), 'val': v[1]}
+
+    return _grid_streaming_response(request, g, rows())
+
+
+def _iter_entities_by_ids(entity_ids):
+    # yield the given entities in order, loading them by chunks
+    for i in range(0, len(entity_ids), READ_CHUNK_SIZE):
+        for e in Entity.objects.filter(entity_id__in=entity_ids[i:i + READ_CHUNK_SIZE]).order_by('entity_id'):
+            yield e
+
+
+def _encode_cursor(entity_id):
+    # the opaque token of a read page, which is the last entity_id of the page
+    return base64.urlsafe_b64encode(entity_id.encode('utf-8')).decode('ascii')
+
+
+def _decode_cursor(cursor):
+    try:
+        return base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8')
+    except (ValueError, UnicodeError):
+        return None
 
 
 def read_view(request):
@@ -190,7 +361,7 @@ def read_view(request):
     if not e_id:
         r_filter = request.GET.get('filter')
         if not r_filter:
-            return _hzinc_response(g, status=404)
+            return _grid_response(request, g, status=404)
 
         r_limit = request.GET.get('limit')
         if r_limit:
@@ -202,6 +373,13 @@ def read_view(request):
         else:
             r_limit = 10000
 
+        # continue after the last entity of the previous page, as given in its next metadata
+        r_cursor = request.GET.get('cursor')
+        if r_cursor:
+            r_cursor = _decode_cursor(r_cursor)
+            if not r_cursor:
+                return _grid_response(request, g, status=400)
+
         # currently the filter is based on theJava implementation which
         # parses the filter string and checks each record as Dict of all values
         # eg: {'id': 'AB', 'dis': 'Site A Equip B', 'equip': 'M', 'siteRef': 'A'}
@@ -212,49 +390,67 @@ def read_view(request):
         #  eg: siteRef=="@A"
         try:
             h_filter = HFilter.make(r_filter)
-            h_pather = Pather()
-
-            added_fields = []
-            data = []
-            n = 0
-            for e in Entity.objects.all():
-                # transform into a dict first
-                e_data = {}
-                if e.kv_tags:
-                    for f in e.kv_tags.keys():
-                        e_data[f] = e.kv_tags[f]
-
-                for f in e.m_tags:
-                    e_data[f] = hszinc.MARKER
-
-                # by default uses the id tag, but fallback to entity_id
-                if 'id' not in e_data:
-                    e_data['id'] = e.entity_id
-
-                if h_filter.include(e_data, h_pather):
-                    print('++++', e_data)
-                    for f in e_data.keys():
-                        if f not in added_fields:
-                            added_fields.append(f)
-                            g.column[f] = {}
-                    data.append(e_data)
-                    n += 1
-                    if (n >= r_limit):
+            h_pather = EntityPather()
+            h_paths = h_filter.refPaths()
+            h_include = h_filter.compile()
+            # push down the filter to the DB, when it is not exact the
+            # matched entities must still be checked with the filter
+            h_query, h_exact = h_filter.toQuery()
+            entities = Entity.objects.filter(h_query).order_by('entity_id')
+            if r_cursor:
+                entities = entities.filter(entity_id__gt=r_cursor)
+            # one more entity is matched to know if there is a next page
+            if h_exact:
+                # only read the ids and tag names for the columns, the entities are then streamed
+                matched_ids = []
+                for entity_id, kv_keys, m_tags in entities.values_list(
+                        'entity_id', 'kv_tags__keys', 'm_tags')[:r_limit + 1].iterator():
+                    matched_ids.append(entity_id)
+                    if len(matched_ids) <= r_limit:
+                        _add_columns(g, kv_keys or [])
+                        _add_columns(g, m_tags or [])
+                _add_columns(g, ['id'])
+            else:
+                # check the filter a first time to get the matched entities and their columns
+                matched_ids = []
+                entities_iterator = entities.iterator()
+                while len(matched_ids) <= r_limit:
+                    chunk = list(islice(entities_iterator, READ_CHUNK_SIZE))
+                    if not chunk:
                         break
-
-                else:
-                    print('0000', e_data)
-
-            g.extend(data)
-            return _hzinc_response(g)
+                    dicts = [_entity_to_dict(e) for e in chunk]
+                    if h_paths:
+                        h_pather.prefetch(dicts, h_paths)
+                    for e, e_data in zip(chunk, dicts):
+                        if h_include(e_data, h_pather):
+                            matched_ids.append(e.entity_id)
+                            if len(matched_ids) > r_limit:
+                                break
+                            _add_columns(g, e_data.keys())
+
+            if len(matched_ids) > r_limit:
+                matched_ids = matched_ids[:r_limit]
+                if matched_ids:
+                    g.metadata['next'] = _encode_cursor(matched_ids[-1])
+            if h_exact:
+                # stream the same entities as the ids that were read
+                entities = entities.filter(entity_id__lte=matched_ids[-1]) if matched_ids else entities.none()
+            else:
+                entities = _iter_entities_by_ids(matched_ids)
+
+            def rows():
+                for e in (entities.iterator() if h_exact else entities):
+                    yield _entity_to_dict(e)
+
+            return _grid_streaming_response(request, g, rows())
         except Exception:
             logger.exception('read_view: Error filtering')
-            return _hzinc_response(g, status=500)
+            return _grid_response(request, g, status=500)
 
     try:
         e = Entity.objects.get(entity_id=e_id)
     except Entity.DoesNotExist:
-        return _hzinc_response(g, status=404)
+        return _grid_response(request, g, status=404)
 
     e_data = {}
     added_fields = []
@@ -274,4 +470,92 @@ def read_view(request):
         logger.info("read_view: read data %s", e_data)
 
     g.extend([e_data])
-    return _hzinc_response(g)
+    return _grid_response(request, g)
+
+
+def _cur_val(kind, string_value):
+    # the curVal of a point from its latest value in Crate
+    if kind == 'Bool':
+        # same as the current values shown in the UI
+        return string_value == 't' or string_value != '0'
+    if kind == 'Number':
+        try:
+            return float(string_value)
+        except (TypeError, ValueError):
+            pass
+    return string_value
+
+
+def _watch_response(request, watch, values, entity_ids=None):
+    # the records of the given points with their curVal and curTs, values is a dict
+    # of entity_id -> (ts, string_value) as returned by Watch.poll
+    # with entity_ids the rows are in that order and the ids that are not watched points get an empty row
+    g = hszinc.Grid()
+    g.metadata['watchId'] = watch.watch_id
+    g.metadata['lease'] = hszinc.Quantity(watch.lease, 's')
+    g.column['id'] = {}
+    rows = {}
+    for e in _iter_entities_by_ids(sorted(values.keys())):
+        e_data = _entity_to_dict(e)
+        ts, string_value = values[e.entity_id]
+        if ts is not None:
+            e_data['curVal'] = _cur_val(watch.points[e.entity_id][1], string_value)
+            e_data['curTs'] = _his_ts(ts)
+        _add_columns(g, e_data.keys())
+        rows[e.entity_id] = e_data
+    if entity_ids is None:
+        return _grid_streaming_response(request, g, rows.values())
+    return _grid_streaming_response(request, g, [rows.get(e_id, {}) for e_id in entity_ids])
+
+
+def watch_sub_view(request):
+    # open a watch with watchDis or add points to the watch watchId, the points are given as id0, id1, ...
+    g = hszinc.Grid()
+    watch_id = request.GET.get('watchId')
+    if watch_id:
+        watch = Watch.get(watch_id)
+        if not watch:
+            return _grid_response(request, g, status=404)
+    else:
+        watch_dis = request.GET.get('watchDis')
+        if not watch_dis:
+            return _grid_response(request, g, status=404)
+        watch = Watch.create(dis=watch_dis)
+
+    lease = parse_lease(request.GET.get('lease'))
+    if lease:
+        watch.lease = lease
+
+    # only points have a current value, other ids are not subscribed and get an empty row
+    entity_ids = _request_ids(request)
+    points = list(PointView.objects.filter(entity_id__in=entity_ids))
+    watch.subscribe(points)
+    values = watch.poll([p.entity_id for p in points], refresh=True)
+    watch.save()
+    return _watch_response(request, watch, values, entity_ids=entity_ids)
+
+
+def watch_unsub_view(request):
+    # remove the points id0, id1, ... from the watch, or close it with the close parameter
+    g = hszinc.Grid()
+    watch = Watch.get(request.GET.get('watchId'))
+    if not watch:
+        return _grid_response(request, g, status=404)
+    if 'close' in request.GET:
+        watch.delete()
+    else:
+        watch.unsubscribe(_request_ids(request))
+        watch.save()
+    return _grid_response(request, g)
+
+
+def watch_poll_view(request):
+    # only returns the points with a new value since the last poll, or all the points with refresh
+    g = hszinc.Grid()
+    watch = Watch.get(request.GET.get('watchId'))
+    if not watch:
+        return _grid_response(request, g, status=404)
+    values = watch.poll(refresh='refresh' in request.GET)
+    # this also renews the lease
+    watch.save()
+    return _watch_response(request, watch, values)
@@ -0,0 +1,124 @@
+# This file is part of opentaps Smart Energy Applications Suite (SEAS).
+
+# opentaps Smart Energy Applications Suite (SEAS) is free software:
+# you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# opentaps Smart Energy Applications Suite (SEAS) is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public License
+# along with opentaps Smart Energy Applications Suite (SEAS).
+# If not, see <https://www.gnu.org/licenses/>.
+
+import time
+
+from cratedb.connector import pool as pool_module
+from cratedb.connector.pool import ConnectionPool
+from cratedb.connector.pool import PoolTimeout
+from django.test import SimpleTestCase
+
+
+class FakeConnection(object):
+
+    def __init__(self):
+        self.closed = 0
+
+    def close(self):
+        self.closed = 1
+
+
+class ConnectionPoolTests(SimpleTestCase):
+
+    def test_reuse_connections(self):
+        pool = ConnectionPool(FakeConnection, min_size=2, max_size=3)
+        c1 = pool.getconn()
+        self.assertEqual(pool.size, 2)
+        self.assertEqual(pool.idle, 1)
+        pool.putconn(c1)
+        self.assertIs(pool.getconn(), c1)
+        self.assertEqual(pool.size, 2)
+
+    def test_max_size(self):
+        pool = ConnectionPool(FakeConnection, min_size=0, max_size=2, timeout=0.1)
+        c1 = pool.getconn()
+        pool.getconn()
+        with self.assertRaises(PoolTimeout):
+            pool.getconn()
+        pool.putconn(c1)
+        self.assertIs(pool.getconn(), c1)
+
+    def test_max_lifetime(self):
+        pool = ConnectionPool(FakeConnection, min_size=0, max_size=2, max_lifetime=0.05)
+        c1 = pool.getconn()
+        time.sleep(0.1)
+        pool.putconn(c1)
+        self.assertEqual(c1.closed, 1)
+        self.assertEqual(pool.size, 0)
+        self.assertIsNot(pool.getconn(), c1)
+
+    def test_discard_unusable(self):
+        pool = ConnectionPool(FakeConnection, is_usable=lambda c: False, min_size=0, check_interval=0)
+        c1 = pool.getconn()
+        pool.putconn(c1)
+        self.assertIsNot(pool.getconn(), c1)
+        self.assertEqual(c1.closed, 1)
+        self.assertEqual(pool.size, 1)
+
+    def test_put_twice(self):
+        pool = ConnectionPool(FakeConnection, min_size=0, max_size=2)
+        c1 = pool.getconn()
+        pool.putconn(c1)
+        pool.putconn(c1)
+        self.assertEqual(pool.idle, 1)
+        self.assertIs(pool.getconn(), c1)
+        self.assertIsNot(pool.getconn(), c1)
+        self.assertEqual(pool.size, 2)
+
+    def test_put_discarded(self):
+        pool = ConnectionPool(FakeConnection, min_size=0, max_size=2, timeout=0.1)
+        c1 = pool.getconn()
+        c2 = pool.getconn()
+        pool.putconn(c1, discard=True)
+        self.assertEqual(pool.size, 1)
+        # a discarded connection given back again does not change the size
+        pool.putconn(c1)
+        pool.putconn(c1, discard=True)
+        self.assertEqual(pool.size, 1)
+        self.assertEqual(pool.idle, 0)
+        pool.getconn()
+        with self.assertRaises(PoolTimeout):
+            pool.getconn()
+        pool.putconn(c2)
+        self.assertIs(pool.getconn(), c2)
+
+    def test_put_foreign(self):
+        # the pool of the parent process, as seen by a forked child
+        parent_pool = ConnectionPool(FakeConnection, min_size=0)
+        inherited = parent_pool.getconn()
+        pool = ConnectionPool(FakeConnection, min_size=0, max_size=1, timeout=0.1)
+        key = ('_test_parent', -1)
+        pool_module._pools[key] = parent_pool
+        try:
+            c1 = pool.getconn()
+            pool.putconn(inherited)
+            # the socket of the parent is not closed and the child pool size is unchanged
+            self.assertEqual(inherited.closed, 0)
+            self.assertEqual(pool.size, 1)
+            self.assertEqual(pool.idle, 0)
+            with self.assertRaises(PoolTimeout):
+                pool.getconn()
+        finally:
+            del pool_module._pools[key]
+
+        # a connection no pool knows is closed, still without changing the size
+        unknown = FakeConnection()
+        pool.putconn(unknown)
+        self.assertEqual(unknown.closed, 1)
+        self.assertEqual(pool.size, 1)
+        pool.putconn(c1)
+        self.assertIs(pool.getconn(), c1)
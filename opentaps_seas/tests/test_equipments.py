@@ -17,10 +17,17 @@
 
 import json
 import os
+from datetime import datetime
+from datetime import timedelta
 
 from .base import OpentapsSeasTestCase
 from django.urls import reverse
 from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db import connections
+from opentaps_seas.core import utils
+from opentaps_seas.core.hierarchy import HIERARCHY_VERSION_CACHE_KEY
+from opentaps_seas.core.hierarchy import get_entity_hierarchy
 from opentaps_seas.core.models import Entity
 from opentaps_seas.core.models import Tag
 from django.core.files.uploadedfile import SimpleUploadedFile
@@ -305,3 +312,93 @@ class EquipmentAPITests(OpentapsSeasTestCase):
         self.assertNotContains(response, 'A Model test note 1')
         self.assertNotContains(response, 'A Model test note 2')
         self.assertContains(response, 'The Equipment test note 1')
+
+    def test_hierarchy(self):
+        site_id = '_test_mysite'
+        Entity.objects.create(entity_id=site_id, m_tags=['site'], kv_tags={'id': site_id, 'dis': 'Test Site'})
+        Entity.objects.create(entity_id=self.equipment_id, m_tags=['equip'], kv_tags={
+            'id': self.equipment_id, 'dis': 'Test Equipment', 'siteRef': site_id})
+        for i in range(3):
+            Entity.objects.create(entity_id='_test_mypoint_{}'.format(i), m_tags=['point', 'his'], kv_tags={
+                'id': '_test_mypoint_{}'.format(i), 'siteRef': site_id, 'equipRef': self.equipment_id})
+
+        h = get_entity_hierarchy()
+        site = h.get_site(site_id)
+        self.assertIsNotNone(site)
+        self.assertEquals(site.description, 'Test Site')
+        self.assertEquals([e.entity_id for e in h.site_equipments(site_id)], [self.equipment_id])
+        self.assertEquals([e.entity_id for e in h.children(site)], [self.equipment_id])
+        equipment = h.get_equipment(self.equipment_id)
+        self.assertEquals(len(h.equipment_points(self.equipment_id)), 3)
+        self.assertEquals([p.entity_id for p in h.children(equipment)],
+                          ['_test_mypoint_0', '_test_mypoint_1', '_test_mypoint_2'])
+        # the same index is returned until an Entity changes
+        self.assertIs(get_entity_hierarchy(), h)
+        # when the version is evicted from the cache a new one is seeded and the index is rebuilt
+        cache.delete(HIERARCHY_VERSION_CACHE_KEY)
+        rebuilt = get_entity_hierarchy()
+        self.assertIsNot(rebuilt, h)
+        self.assertNotEqual(rebuilt.version, h.version)
+        self.assertIs(get_entity_hierarchy(), rebuilt)
+
+        Entity.objects.filter(entity_id='_test_mypoint_2').delete()
+        h = get_entity_hierarchy()
+        self.assertEquals(len(h.equipment_points(self.equipment_id)), 2)
+
+        e = Entity.objects.get(entity_id=self.equipment_id)
+        e.kv_tags['dis'] = 'Renamed Equipment'
+        e.save()
+        self.assertEquals(get_entity_hierarchy().get_equipment(self.equipment_id).description, 'Renamed Equipment')
+
+        # the detail page counts the points from the index
+        self._login()
+        url = reverse('core:site_equipment_detail', kwargs={'site': site_id, 'equip': self.equipment_id})
+        response = self.client.get(url)
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(response.context['data_points'], 2)
+
+    def test_points_matrix_json(self):
+        url = reverse('core:equipment_points_matrix_json', kwargs={'equip': self.equipment_id})
+        response = self.client.get(url)
+        self.assertEquals(response.status_code, 401)
+
+        self._create_equipment(self.equipment_id, 'A test equipment')
+        points = [('_test_matrix_a', 'A Power', 'Number'), ('_test_matrix_b', 'B Status', 'Bool'),
+                  ('_test_matrix_c', 'C No Data', 'Number')]
+        for entity_id, description, kind in points:
+            Entity.objects.create(entity_id=entity_id, topic='_test/matrix/' + entity_id[-1], m_tags=['point', 'his'],
+                                  kv_tags={'id': entity_id, 'dis': description, 'kind': kind,
+                                           'equipRef': self.equipment_id})
+
+        base = datetime.utcnow().replace(second=0, microsecond=0) - timedelta(minutes=10)
+        sql = """INSERT INTO {0} (double_value, source, string_value, topic, ts)
+            VALUES (%s, %s, %s, %s, %s)""".format("data")
+        try:
+            with connections['crate'].cursor() as c:
+                for topic, offset, value in [('_test/matrix/a', 10, 1), ('_test/matrix/a', 20, 3),
+                                             ('_test/matrix/a', 120, 5), ('_test/matrix/b', 130, 1)]:
+                    c.execute(sql, [value, 'scrape', str(value), topic, base + timedelta(seconds=offset)])
+                c.execute("""REFRESH TABLE {0}""".format("data"))
+
+            self._login()
+            response = self.client.get(url, {'res': 'minute', 'range': '1 day'})
+            self.assertEquals(response.status_code, 200)
+            data = response.json()
+            # one column per point, the point without data included
+            self.assertEqual([col['entity_id'] for col in data['columns']],
+                             ['_test_matrix_a', '_test_matrix_b', '_test_matrix_c'])
+            self.assertEqual([col['kind'] for col in data['columns']], ['Number', 'Bool', 'Number'])
+            # the values of all the points are aligned on the same minutes
+            self.assertEqual([utils.to_epoch_ms(row[0]) for row in data['rows']],
+                             [utils.to_epoch_ms(base), utils.to_epoch_ms(base + timedelta(minutes=2))])
+            self.assertEqual([row[1:] for row in data['rows']], [[2, None, None], [5, 1, None]])
+
+            # restricted to the given points
+            response = self.client.get(url, {'res': 'minute', 'range': '1 day', 'point': ['_test_matrix_b']})
+            self.assertEquals(response.status_code, 200)
+            data = response.json()
+            self.assertEqual([col['entity_id'] for col in data['columns']], ['_test_matrix_b'])
+            self.assertEqual([row[1:] for row in data['rows']], [[1]])
+        finally:
+            with connections['crate'].cursor() as c:
+                c.execute("""DELETE FROM {0} WHERE topic like %s""".format("data"), ['_test/matrix/%'])
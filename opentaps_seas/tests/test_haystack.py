@@ -15,9 +15,24 @@
 # along with opentaps Smart Energy Applications Suite (SEAS).
 # If not, see <https://www.gnu.org/licenses/>.
 
+import csv
+import hszinc
+import io
+import json
+from datetime import datetime
+from datetime import timedelta
+
 from .base import OpentapsSeasTestCase
+from django.db import connections
 from django.urls import reverse
 from opentaps_seas.core.models import Entity
+from opentaps_seas.haystack.utils.hencoder import encode_grid
+from opentaps_seas.haystack.utils.hencoder import negotiate_format
+from opentaps_seas.haystack.utils.hfilter import HFilter
+from opentaps_seas.haystack.utils.htoken import HaystackToken
+from opentaps_seas.haystack.utils.htokenizer import HaystackTokenizer
+from opentaps_seas.haystack.views import EntityPather
+from opentaps_seas.haystack.views import _entity_to_dict
 
 
 class HaystackTests(OpentapsSeasTestCase):
@@ -155,6 +170,8 @@ class HaystackTests(OpentapsSeasTestCase):
         self.assertContains(response, '"Read time series from historian"')
         self.assertContains(response, '"nav"')
         self.assertContains(response, '"Navigate record tree"')
+        self.assertContains(response, '"watchSub"')
+        self.assertContains(response, '"watchPoll"')
 
     def test_formats(self):
         url = reverse('haystack:formats')
@@ -162,6 +179,66 @@ class HaystackTests(OpentapsSeasTestCase):
         self.assertEquals(response.status_code, 200)
         self.assertEquals(response['Content-Type'], 'text/zinc;charset=utf-8')
         self.assertContains(response, '"text/zinc",M,M')
+        self.assertContains(response, '"application/json",,M')
+        self.assertContains(response, '"text/csv",,M')
+
+    def test_negotiate_format(self):
+        self.assertEqual(negotiate_format(None), 'text/zinc')
+        self.assertEqual(negotiate_format('*/*'), 'text/zinc')
+        self.assertEqual(negotiate_format('text/html, text/csv'), 'text/csv')
+        self.assertEqual(negotiate_format('text/csv;q=0.5, application/json;q=0.9'), 'application/json')
+        self.assertEqual(negotiate_format('application/json;q=0'), 'text/zinc')
+
+    def test_encode_special_numbers(self):
+        grid = hszinc.Grid(version=hszinc.VER_3_0)
+        grid.column['id'] = {}
+        grid.column['val'] = {}
+        rows = [
+            {'id': hszinc.Ref('a'), 'val': float('nan')},
+            {'id': hszinc.Ref('b'), 'val': float('inf')},
+            {'id': hszinc.Ref('c'), 'val': hszinc.Quantity(float('-inf'), 'kW')},
+        ]
+
+        zinc = ''.join(encode_grid(grid, rows, 'text/zinc'))
+        self.assertIn('@a,NaN\n', zinc)
+        self.assertIn('@b,INF\n', zinc)
+        self.assertIn('@c,-INF\n', zinc)
+
+        data = json.loads(''.join(encode_grid(grid, rows, 'application/json')))
+        self.assertEqual([row['val'] for row in data['rows']], ['n:NaN', 'n:INF', 'n:-INF'])
+
+        lines = list(csv.reader(io.StringIO(''.join(encode_grid(grid, rows, 'text/csv')))))
+        self.assertEqual([line[1] for line in lines[1:]], ['NaN', 'INF', '-INF'])
+
+    def test_read_formats(self):
+        url = reverse('haystack:read')
+        r_filter = 'point and siteRef=="site/A"'
+
+        response = self.client.get(url, {'filter': r_filter}, HTTP_ACCEPT='application/json')
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(response['Content-Type'], 'application/json;charset=utf-8')
+        content = b''.join(response.streaming_content).decode('utf-8')
+        data = json.loads(content)
+        self.assertEqual(sorted([row['id'] for row in data['rows']]), ['s:point/A/E1/KW', 's:point/A/E1/KWH'])
+        self.assertEqual(data['rows'][0]['point'], 'm:')
+        # the same grid as the Zinc one
+        grid = hszinc.parse(content, mode=hszinc.MODE_JSON, single=True)
+        response = self.client.get(url, {'filter': r_filter})
+        zinc_grid = hszinc.parse(b''.join(response.streaming_content).decode('utf-8'), single=True)
+        self.assertEqual(list(grid.column.keys()), list(zinc_grid.column.keys()))
+        self.assertEqual(list(grid), list(zinc_grid))
+
+        response = self.client.get(url, {'filter': r_filter}, HTTP_ACCEPT='text/csv')
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(response['Content-Type'], 'text/csv;charset=utf-8')
+        rows = list(csv.DictReader(io.StringIO(b''.join(response.streaming_content).decode('utf-8'))))
+        self.assertEqual(sorted([row['id'] for row in rows]), ['point/A/E1/KW', 'point/A/E1/KWH'])
+        self.assertEqual(rows[0]['point'], '✓')
+        self.assertIn(rows[0]['unit'], ['kW', 'kWh'])
+
+        response = self.client.get(reverse('haystack:about'), HTTP_ACCEPT='application/json')
+        self.assertEquals(response['Content-Type'], 'application/json;charset=utf-8')
+        self.assertEqual(json.loads(response.content)['rows'][0]['vendorUri'], 's:https://www.opensourcestrategies.com')
 
     def test_nav(self):
         url = reverse('haystack:nav')
@@ -441,3 +518,266 @@ class HaystackTests(OpentapsSeasTestCase):
         self.assertNotContains(response, '"@B"')
         self.assertNotContains(response, '"site/B"')
         self.assertNotContains(response, '"@C"')
+
+    def test_filter_to_query(self):
+        # those filters can be evaluated by the DB alone
+        for f in ['site', 'not site', 'point and siteRef=="site/A"', 'id=="site/C"', 'site or equip', 'dis!="A"']:
+            q, exact = HFilter.make(f).toQuery()
+            self.assertTrue(exact, f)
+        # number comparisons and paths need to be checked in python
+        for f in ['site and area>=2000', 'equipRef->siteRef', 'site or equipRef->siteRef']:
+            q, exact = HFilter.make(f).toQuery()
+            self.assertFalse(exact, f)
+
+        def matches(f):
+            q, exact = HFilter.make(f).toQuery()
+            entities = Entity.objects.filter(q).filter(entity_id__startswith='@')
+            return sorted(entities.values_list('entity_id', flat=True))
+
+        self.assertEqual(matches('site'), ['@A', '@B', '@C'])
+        self.assertEqual(matches('point and siteRef=="site/A"'), ['@A-E1-KW', '@A-E1-KWH'])
+        self.assertEqual(matches('equip and not elecMeter and siteRef=="site/B"'), ['@B-E1'])
+        self.assertEqual(matches('id=="site/C" or id=="equip/C/E1"'), ['@C', '@C-E1'])
+        self.assertEqual(matches('site and dis!="A"'), ['@B', '@C'])
+        self.assertEqual(matches('site and geoState=="DC"'), ['@C'])
+
+        # tag names that are also hstore transforms or lookups are compared as plain tags
+        Entity.objects.create(entity_id='@K', m_tags=['point'],
+                              kv_tags={'keys': 'k', 'values': 'v', 'contains': 'c', 'exact': 'e', 'a__b': 'ab'})
+        for f in ['keys=="k"', 'values=="v"', 'contains=="c"', 'has_key=="h"', 'exact=="e"', 'a__b=="ab"']:
+            q, exact = HFilter.make(f).toQuery()
+            self.assertTrue(exact, f)
+        self.assertEqual(matches('point and keys=="k" and values=="v" and contains=="c" and exact=="e"'), ['@K'])
+        self.assertEqual(matches('a__b=="ab"'), ['@K'])
+        self.assertEqual(matches('has_key=="h"'), [])
+        self.assertEqual(matches('keys!="x"'), ['@K'])
+
+    def test_filter_compile(self):
+        dicts = [_entity_to_dict(e) for e in Entity.objects.filter(entity_id__startswith='@')]
+        pather = EntityPather()
+        for r_filter in ['site', 'not site', 'equip or point', 'point and siteRef=="site/A"', 'site and dis!="A"',
+                         'equip and not elecMeter', 'point and equipRef->siteRef->geoCity=="Richmond"',
+                         'not equipRef->siteRef', 'kind=="Number" or (site and geoState!="DC")', 'dis>="Point"']:
+            h_filter = HFilter.make(r_filter)
+            # the parsed filter is cached
+            self.assertIs(HFilter.make(r_filter), h_filter)
+            include = h_filter.compile()
+            self.assertEqual([d['id'] for d in dicts if include(d, pather)],
+                             [d['id'] for d in dicts if h_filter.include(d, pather)], r_filter)
+
+    def _tokens(self, s, fast):
+        tokenizer = HaystackTokenizer(s, fast=fast)
+        tokens = []
+        while True:
+            tok = tokenizer.next()
+            val = tokenizer.val
+            if hasattr(val, '__dict__'):
+                val = (type(val).__name__, vars(val))
+            tokens.append((str(tok), val, tokenizer.line))
+            if tok == HaystackToken.eof:
+                return tokens
+
+    def test_tokenizer(self):
+        # the regex tokenizer gives the same tokens as the char by char tokenizer
+        # note: the char by char tokenizer fails on numbers that are not at the end
+        for s in ['site', 'point and siteRef->geoCity=="Richmond"', '(a or b) and not c', 'site and area>=2000',
+                  'x!="A B"', 'r==@site/A', 'r==@a-b.c:d~e', 'x<=3.5', 'x==-3.5e2', 'x==5kW', 'x==5%',
+                  'x<<@a', 'a // comment\nb', 'a /* comment */ b', 'a\r\nb', 's=="a\\"b"', 'u==`http://x`', 'a-b', '',
+                  'ver:"3.0"\nid,dis,point\n@a,"A",M\n@b,"B",M\n']:
+            self.assertEqual(self._tokens(s, True), self._tokens(s, False), s)
+
+        tokens = [t[0] for t in self._tokens('area>=2000 and site', True)]
+        self.assertEqual(tokens, ['identifier', '>=', 'Number', 'identifier', 'identifier', 'eof'])
+
+    def test_read_by_filter_ref(self):
+        url = reverse('haystack:read')
+
+        response = self.client.get(url, {'filter': 'point and siteRef=="site/A"'})
+        self.assertEquals(response.status_code, 200)
+        self.assertContains(response, '"point/A/E1/KWH"')
+        self.assertContains(response, '"point/A/E1/KW"')
+        self.assertNotContains(response, '"point/B/E2/Fan"')
+
+        response = self.client.get(url, {'filter': 'point and siteRef=="site/A"', 'limit': 1})
+        self.assertEquals(response.status_code, 200)
+        self.assertContains(response, '"point/A/E1/KW"')
+        self.assertNotContains(response, '"point/A/E1/KWH"')
+
+    def test_read_by_filter_path(self):
+        url = reverse('haystack:read')
+
+        response = self.client.get(url, {'filter': 'equip and siteRef->geoState=="DC"'})
+        self.assertEquals(response.status_code, 200)
+        self.assertContains(response, '"equip/C/E1"')
+        self.assertNotContains(response, '"equip/A/E1"')
+        self.assertNotContains(response, '"equip/B/E1"')
+
+        response = self.client.get(url, {'filter': 'point and equipRef->elecMeter'})
+        self.assertEquals(response.status_code, 200)
+        self.assertContains(response, '"point/B/E2/Fan"')
+        self.assertNotContains(response, '"point/A/E1/KWH"')
+
+        response = self.client.get(url, {'filter': 'point and equipRef->siteRef->geoCity=="Richmond"'})
+        self.assertEquals(response.status_code, 200)
+        self.assertContains(response, '"point/A/E1/KWH"')
+        self.assertContains(response, '"point/A/E1/KW"')
+        self.assertContains(response, '"point/B/E2/Fan"')
+
+        response = self.client.get(url, {'filter': 'point and equipRef->siteRef->geoCity=="Washington"'})
+        self.assertEquals(response.status_code, 200)
+        self.assertNotContains(response, 'point/')
+
+    def test_entity_pather(self):
+        points = [_entity_to_dict(e) for e in Entity.objects.filter(m_tags__contains=['point'])]
+        pather = EntityPather()
+        # one query per hop for all the points
+        with self.assertNumQueries(2):
+            pather.prefetch(points, [HFilter.make('equipRef->siteRef->geoCity').path])
+        with self.assertNumQueries(0):
+            self.assertEqual(pather.find('equip/A/E1')['dis'], 'Equipment AE1')
+            self.assertEqual(pather.find('site/B')['geoCity'], 'Richmond')
+        self.assertIsNone(pather.find('site/X'))
+
+    def test_read_streaming(self):
+        url = reverse('haystack:read')
+
+        # both the exact and the filters checked in python are streamed
+        for r_filter in ['point and siteRef=="site/A"', 'point and equipRef->siteRef->geoCity=="Richmond"']:
+            response = self.client.get(url, {'filter': r_filter})
+            self.assertEquals(response.status_code, 200)
+            self.assertTrue(response.streaming)
+            self.assertEquals(response['Content-Type'], 'text/zinc;charset=utf-8')
+            grid = hszinc.parse(b''.join(response.streaming_content).decode('utf-8'), single=True)
+            self.assertIn('id', grid.column)
+            self.assertIn('point', grid.column)
+            self.assertIn('equipRef', grid.column)
+            ids = sorted([row['id'] for row in grid])
+            self.assertIn('point/A/E1/KW', ids)
+            self.assertIn('point/A/E1/KWH', ids)
+            for row in grid:
+                self.assertEqual(row['point'], hszinc.MARKER)
+
+        response = self.client.get(reverse('haystack:nav'), {'navId': '@A-E1'})
+        self.assertTrue(response.streaming)
+        grid = hszinc.parse(b''.join(response.streaming_content).decode('utf-8'), single=True)
+        self.assertEqual(sorted([row['navId'] for row in grid]), ['@A-E1-KW', '@A-E1-KWH'])
+
+    def test_read_paging(self):
+        url = reverse('haystack:read')
+
+        def read(params):
+            response = self.client.get(url, params)
+            self.assertEquals(response.status_code, 200)
+            return hszinc.parse(b''.join(response.streaming_content).decode('utf-8'), single=True)
+
+        # both the exact and the filters checked in python are paged
+        for r_filter in ['point', 'point and equipRef->siteRef->geoCity=="Richmond"']:
+            grid = read({'filter': r_filter})
+            self.assertNotIn('next', grid.metadata)
+            all_ids = [row['id'] for row in grid]
+            self.assertTrue(len(all_ids) > 2)
+
+            ids = []
+            params = {'filter': r_filter, 'limit': 2}
+            while True:
+                grid = read(params)
+                self.assertTrue(len(grid) <= 2)
+                ids.extend([row['id'] for row in grid])
+                if 'next' not in grid.metadata:
+                    break
+                params['cursor'] = grid.metadata['next']
+            self.assertEqual(ids, all_ids)
+
+        response = self.client.get(url, {'filter': 'point', 'cursor': '!!!'})
+        self.assertEquals(response.status_code, 400)
+
+    def test_hisread_batch(self):
+        Entity.objects.create(entity_id='_test_his_a', topic='_test/his/a', m_tags=['point', 'his'],
+                              kv_tags={'id': '_test_his_a', 'kind': 'Number'})
+        Entity.objects.create(entity_id='_test_his_b', topic='_test/his/b', m_tags=['point', 'his'],
+                              kv_tags={'id': '_test_his_b', 'kind': 'Number'})
+        ts = datetime.utcnow().replace(second=0, microsecond=0) - timedelta(hours=1)
+        with connections['crate'].cursor() as c:
+            sql = """INSERT INTO {0} (double_value, source, string_value, topic, ts)
+            VALUES (%s, %s, %s, %s, %s)""".format("data")
+            c.execute(sql, [1, 'scrape', '1', '_test/his/a', ts])
+            c.execute(sql, [2, 'scrape', '2', '_test/his/b', ts])
+            c.execute(sql, [3, 'scrape', '3', '_test/his/a', ts + timedelta(minutes=1)])
+            c.execute("""REFRESH TABLE {0}""".format("data"))
+
+        try:
+            url = reverse('haystack:hisRead')
+            response = self.client.get(url, {'id0': '_test_his_a', 'id1': '_test_his_b', 'range': '1 day'})
+            self.assertEquals(response.status_code, 200)
+            grid = hszinc.parse(b''.join(response.streaming_content).decode('utf-8'), single=True)
+            self.assertEqual(list(grid.column.keys()), ['ts', 'v0', 'v1'])
+            self.assertEqual(grid.column['v0']['id'], hszinc.Ref('_test_his_a'))
+            self.assertEqual(grid.column['v1']['id'], hszinc.Ref('_test_his_b'))
+            self.assertEqual([(row.get('v0'), row.get('v1')) for row in grid], [(1, 2), (3, None)])
+
+            # with maxPoints the resolution is selected and each column downsampled like a single point
+            response = self.client.get(url, {'id0': '_test_his_a', 'id1': '_test_his_b', 'range': '1 day',
+                                             'maxPoints': 1})
+            self.assertEquals(response.status_code, 200)
+            grid = hszinc.parse(b''.join(response.streaming_content).decode('utf-8'), single=True)
+            self.assertEqual([(row.get('v0'), row.get('v1')) for row in grid], [(2, 2)])
+
+            # all the ids must be known points
+            response = self.client.get(url, {'id0': '_test_his_a', 'id1': '_test_his_x', 'range': '1 day'})
+            self.assertEquals(response.status_code, 404)
+        finally:
+            with connections['crate'].cursor() as c:
+                c.execute("""DELETE FROM {0} WHERE topic like %s""".format("data"), ['_test/his/%'])
+
+    def test_watch(self):
+        Entity.objects.create(entity_id='_test_his_a', topic='_test/his/a', m_tags=['point', 'his'],
+                              kv_tags={'id': '_test_his_a', 'kind': 'Number'})
+        Entity.objects.create(entity_id='_test_his_b', topic='_test/his/b', m_tags=['point', 'his'],
+                              kv_tags={'id': '_test_his_b', 'kind': 'Number'})
+        ts = datetime.utcnow().replace(second=0, microsecond=0) - timedelta(hours=1)
+        sql = """INSERT INTO {0} (double_value, source, string_value, topic, ts)
+        VALUES (%s, %s, %s, %s, %s)""".format("data")
+        with connections['crate'].cursor() as c:
+            c.execute(sql, [1, 'scrape', '1', '_test/his/a', ts])
+            c.execute(sql, [2, 'scrape', '2', '_test/his/b', ts])
+            c.execute("""REFRESH TABLE {0}""".format("data"))
+
+        def parse(response):
+            self.assertEquals(response.status_code, 200)
+            return hszinc.parse(b''.join(response.streaming_content).decode('utf-8'), single=True)
+
+        try:
+            # one row per requested id in the same order, empty for the unknown ids
+            response = self.client.get(reverse('haystack:watchSub'), {
+                'watchDis': 'Test', 'lease': '1min', 'id0': '_test_his_b', 'id1': '_test_his_x', 'id2': '_test_his_a'})
+            grid = parse(response)
+            watch_id = grid.metadata['watchId']
+            self.assertEqual(grid.metadata['lease'].value, 60)
+            self.assertEqual([(row.get('id'), row.get('curVal')) for row in grid],
+                             [('_test_his_b', 2), (None, None), ('_test_his_a', 1)])
+
+            # nothing changed since the subscription
+            url = reverse('haystack:watchPoll')
+            grid = parse(self.client.get(url, {'watchId': watch_id}))
+            self.assertEqual(len(grid), 0)
+
+            with connections['crate'].cursor() as c:
+                c.execute(sql, [3, 'scrape', '3', '_test/his/a', ts + timedelta(minutes=1)])
+                c.execute("""REFRESH TABLE {0}""".format("data"))
+            grid = parse(self.client.get(url, {'watchId': watch_id}))
+            self.assertEqual([(row['id'], row['curVal']) for row in grid], [('_test_his_a', 3)])
+            grid = parse(self.client.get(url, {'watchId': watch_id, 'refresh': 'M'}))
+            self.assertEqual(len(grid), 2)
+
+            response = self.client.get(reverse('haystack:watchUnsub'), {'watchId': watch_id, 'id0': '_test_his_a'})
+            self.assertEquals(response.status_code, 200)
+            grid = parse(self.client.get(url, {'watchId': watch_id, 'refresh': 'M'}))
+            self.assertEqual([row['id'] for row in grid], ['_test_his_b'])
+
+            response = self.client.get(reverse('haystack:watchUnsub'), {'watchId': watch_id, 'close': 'M'})
+            self.assertEquals(response.status_code, 200)
+            response = self.client.get(url, {'watchId': watch_id})
+            self.assertEquals(response.status_code, 404)
+        finally:
+            with connections['crate'].cursor() as c:
+                c.execute("""DELETE FROM {0} WHERE topic like %s""".format("data"), ['_test/his/%'])
@@ -16,10 +16,13 @@
 # If not, see <https://www.gnu.org/licenses/>.
 
 import json
+from datetime import datetime
+from datetime import timedelta
 
 from .base import OpentapsSeasTestCase
 from django.urls import reverse
 from django.contrib.auth import get_user_model
+from django.db import connections
 from opentaps_seas.core.models import Entity
 
 
@@ -112,3 +115,36 @@ class SitesAPITests(OpentapsSeasTestCase):
         self.assertTrue('items' in data, msg='Expected the JSON response to include data.items')
         self.assertTrue(len(data['items']) >= 4,
                         msg='Expected at least 4 tags to be listed, got {0}'.format(len(data['items'])))
+
+    def test_ahu_summary_json(self):
+        site_id = '_test_ahu_site'
+        Entity.objects.create(entity_id=site_id, m_tags=['site'], kv_tags={'id': site_id, 'dis': 'AHU Site'})
+        for i in [1, 2]:
+            equipment_id = '_test_ahu_{}'.format(i)
+            Entity.objects.create(entity_id=equipment_id, m_tags=['equip', 'ahu'], kv_tags={
+                'id': equipment_id, 'dis': 'AHU {}'.format(i), 'siteRef': site_id})
+            point_id = '_test_ahu_{}_cooling'.format(i)
+            Entity.objects.create(entity_id=point_id, topic='_test/ahu/{}/cooling'.format(i),
+                                  m_tags=['his', 'point', 'sensor', 'cooling'], kv_tags={
+                                      'id': point_id, 'kind': 'Number', 'siteRef': site_id,
+                                      'equipRef': equipment_id})
+
+        ts = datetime.utcnow().replace(microsecond=0) - timedelta(minutes=5)
+        try:
+            # only the first AHU has data
+            with connections['crate'].cursor() as c:
+                c.execute("""INSERT INTO {0} (double_value, source, string_value, topic, ts)
+                VALUES (%s, %s, %s, %s, %s)""".format("data"), [12.5, 'scrape', '12.5', '_test/ahu/1/cooling', ts])
+                c.execute("""REFRESH TABLE {0}""".format("data"))
+
+            self._login()
+            response = self.client.get(reverse('core:site_ahu_summary_json', kwargs={'site': site_id}))
+            self.assertEquals(response.status_code, 200)
+            ahus = sorted(response.json()['ahus'], key=lambda a: a['equipment']['entity_id'])
+            self.assertEqual([a['equipment']['entity_id'] for a in ahus], ['_test_ahu_1', '_test_ahu_2'])
+            self.assertEqual([[p['name'] for p in a['data_points']] for a in ahus], [['Cooling'], ['Cooling']])
+            self.assertEqual(ahus[0]['data_points'][0]['value']['value'], '12.5')
+            self.assertEqual(ahus[1]['data_points'][0]['value'], {})
+        finally:
+            with connections['crate'].cursor() as c:
+                c.execute("""DELETE FROM {0} WHERE topic like %s""".format("data"), ['_test/ahu/%'])
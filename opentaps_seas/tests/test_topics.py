@@ -17,12 +17,16 @@
 
 import logging
 import json
+import os
 import time
 
 from .base import OpentapsSeasTestCase
 from django.urls import reverse
 from django.contrib.auth import get_user_model
 from django.db import connections
+from opentaps_seas.core import tasks
+from opentaps_seas.core import utils
+from opentaps_seas.core.tag_columns import get_crate_tag_columns
 from opentaps_seas.core.models import (
     Entity, Tag, Topic, TopicTagRuleSet, TopicTagRule
 )
@@ -1025,3 +1029,228 @@ class TopicAPITests(OpentapsSeasTestCase):
         for equipment in equipments:
             self.assertEqual(equipment.kv_tags['siteRef'], 'test_filters_site')
             self.assertEqual(equipment.kv_tags['modelRef'], '_test_model')
+
+    def test_tag_topics_bulk(self):
+        # the bulk mode must give the same tags as tagging each topic
+        tags = [
+            {'tag': 'appName', 'value': 'bulk'},
+            {'tag': 'his'},
+            {'tag': 'ac', 'remove': True},
+            {'tag': 'unit', 'remove': 'True'},
+            {'tag': 'unit', 'value': 'W'},
+        ]
+        updated, _, _, _ = utils.tag_topics([{'type': 'c', 'value': '_test_filters/foo/an_ac'}], tags,
+                                            select_all=True, bulk=True)
+        self.assertEqual([u['topic'] for u in updated], ['_test_filters/foo/an_ac'])
+        updated, _, _, _ = utils.tag_topics([{'type': 'c', 'value': '_test_filters/bar'}], tags,
+                                            topics=['_test_filters/bar/another_topic'])
+        self.assertEqual([u['topic'] for u in updated], ['_test_filters/bar/another_topic'])
+
+        bulk = Entity.objects.get(topic='_test_filters/foo/an_ac')
+        one = Entity.objects.get(topic='_test_filters/bar/another_topic')
+        self.assertEqual(bulk.m_tags, ['his', 'point'])
+        self.assertEqual(bulk.m_tags, one.m_tags)
+        self.assertEqual(bulk.kv_tags, {'siteRef': 'test_filters_site', 'dis': '_test_filters/foo/an_ac',
+                                        'appName': 'bulk', 'unit': 'W'})
+        self.assertEqual(set(bulk.kv_tags.keys()), set(one.kv_tags.keys()))
+
+        # the missing data points are created
+        updated, _, _, _ = utils.tag_topics([{'type': 'c', 'value': '_test_unmapped/um1'}], tags,
+                                            select_all=True, bulk=True)
+        self.assertEqual(sorted([u['topic'] for u in updated]),
+                         ['_test_unmapped/um1/another_topic', '_test_unmapped/um1/some_topic'])
+        created = Entity.objects.get(topic='_test_unmapped/um1/some_topic')
+        self.assertEqual(created.kv_tags['id'], created.entity_id)
+        self.assertEqual(created.kv_tags['dis'], '_test_unmapped/um1/some_topic')
+        self.assertEqual(created.kv_tags['appName'], 'bulk')
+        self.assertEqual(created.m_tags, ['his'])
+        Entity.objects.filter(topic__startswith='_test_unmapped').delete()
+
+    def test_crate_tag_columns(self):
+        # a tag synced to Crate for the first time must be usable in the filters right away,
+        # Crate never drops the sub columns so the tag is new on each run
+        tag = 'testColumnTag{}'.format(int(time.time() * 1000))
+        with self.settings(CRATE_TAG_COLUMNS_TTL=60):
+            valid_tags = get_crate_tag_columns()
+            self.assertNotIn(tag, valid_tags)
+            self.assertIs(get_crate_tag_columns(), valid_tags)
+            utils.tag_topics([{'type': 'c', 'value': '_test_filters/foo'}], [{'tag': tag, 'value': 'x'}],
+                             select_all=True, bulk=True)
+            self.assertIn(tag, get_crate_tag_columns())
+        topics = utils.apply_filters_to_queryset(Topic.objects.all(), [(tag, 'eq', 'x', None)])
+        self.assertEqual(sorted([t.topic for t in topics]),
+                         ['_test_filters/foo/an_ac', '_test_filters/foo/some_topic'])
+
+    def test_evaluate_topic_rules(self):
+        # the in memory filters must match the same topics as the Crate queries
+        rules_filters = [
+            [{'type': 'c', 'value': '_test_filters/FOO'}],
+            [{'field': 'Topic', 'type': 'matches', 'value': '.*vav-(.*)'}],
+            [{'type': 'c', 'value': '_test_filters'}, {'field': 'ac', 'type': 'present'}],
+            [{'type': 'c', 'value': '_test_'}, {'field': 'appName', 'type': 'absent'}],
+            [{'field': 'appName', 'type': 'eq', 'value': 'TEST_BAR_1'}],
+            [{'type': 'c', 'value': '_test_filters'}, {'field': 'appName', 'type': 'nc', 'value': 'foo'}],
+            [{'type': 'c', 'value': '/foo/'}, {'type': 'c', 'value': '/bar/', 'op': 'or'},
+             {'type': 'c', 'value': 'a'}],
+        ]
+        matches = utils.evaluate_topic_rules([(filters, []) for filters in rules_filters])
+        for i, filters in enumerate(rules_filters):
+            qs = utils.apply_filters_to_queryset(Topic.objects.all(), utils._topic_filters(filters))
+            expected = sorted([t.topic for t in qs if t.topic.startswith('_test')])
+            found = sorted([t for t, indexes in matches.items() if i in indexes and t.startswith('_test')])
+            self.assertEqual(expected, found, filters)
+            self.assertTrue(found, filters)
+
+        # a tag without a Crate column: its values never match and the other comparisons are not applied
+        tag = 'testNoColumn{}'.format(int(time.time() * 1000))
+        rules_filters = [
+            [{'field': tag, 'type': 'eq', 'value': 'x'}],
+            [{'field': tag, 'type': 'c', 'value': 'x'}],
+            [{'field': tag, 'type': 'present'}],
+            [{'type': 'c', 'value': '_test_filters'}, {'field': tag, 'type': 'matches', 'value': 'x.*'}],
+            [{'type': 'c', 'value': '_test_filters'}, {'field': tag, 'type': 'gt', 'value': '5'}],
+            [{'type': 'c', 'value': '_test_filters'}, {'field': tag, 'type': 'lte', 'value': '5'}],
+            [{'type': 'c', 'value': '_test_filters'}, {'field': tag, 'type': 'nc', 'value': 'x'}],
+            [{'type': 'c', 'value': '_test_filters'}, {'field': tag, 'type': 'absent'}],
+            [{'type': 'c', 'value': '_test_filters/foo'}, {'field': tag, 'type': 'eq', 'value': 'x', 'op': 'or'}],
+        ]
+        self.assertNotIn(tag, get_crate_tag_columns())
+        matches = utils.evaluate_topic_rules([(filters, []) for filters in rules_filters])
+        for i, filters in enumerate(rules_filters):
+            qs = utils.apply_filters_to_queryset(Topic.objects.all(), utils._topic_filters(filters))
+            expected = sorted([t.topic for t in qs if t.topic.startswith('_test')])
+            found = sorted([t for t, indexes in matches.items() if i in indexes and t.startswith('_test')])
+            self.assertEqual(expected, found, filters)
+            self.assertEqual(bool(found), i > 2, filters)
+
+    def test_evaluate_topic_rules_new_point_id(self):
+        # a rule filtering on the id sees the id of the data point created by a previous rule
+        topic = '_test_unmapped/um2/ahu'
+        rules = [
+            ([{'type': 'eq', 'value': topic}], [{'tag': 'appName', 'value': 'id test'}]),
+            ([{'field': 'id', 'type': 'c', 'value': '_test_unmappedum2ahu-'}], [{'tag': 'his'}]),
+        ]
+        new_ids = {}
+        matches = utils.evaluate_topic_rules(rules, evolving=True, new_ids=new_ids)
+        self.assertEqual(matches.get(topic), (0, 1))
+        self.assertTrue(new_ids[topic].startswith('_test_unmappedum2ahu-'))
+
+        utils.apply_topic_rules(rules, matches, new_ids=new_ids)
+        e = Entity.objects.get(topic=topic)
+        self.assertEqual(e.entity_id, new_ids[topic])
+        self.assertEqual(e.kv_tags['id'], new_ids[topic])
+        self.assertEqual(e.kv_tags['appName'], 'id test')
+        self.assertIn('his', e.m_tags)
+
+    def test_topic_ruleset_single_pass(self):
+        # a rule matches the topics tagged by the previous ones
+        rule_set = TopicTagRuleSet.objects.create(name='test single pass rule set')
+        TopicTagRule.objects.create(rule_set=rule_set, name='first', tags=[{'tag': 'ruleOne', 'value': 'one'}],
+                                    filters=[{'type': 'c', 'value': '_test_filters/foo'}])
+        TopicTagRule.objects.create(rule_set=rule_set, name='second', tags=[{'tag': 'ruleTwo'}],
+                                    filters=[{'field': 'ruleOne', 'type': 'eq', 'value': 'one'}])
+        TopicTagRule.objects.create(rule_set=rule_set, name='third', tags=[{'tag': 'ruleOne', 'remove': True}],
+                                    filters=[{'type': 'c', 'value': '_test_filters/foo/an_ac'}])
+        updated_set, _, _, _, _, _, _ = tasks.run_topic_tag_ruleset({'ruleset_id': rule_set.id})
+        self.assertEqual(sorted(updated_set), ['_test_filters/foo/an_ac', '_test_filters/foo/some_topic'])
+
+        e = Entity.objects.get(topic='_test_filters/foo/some_topic')
+        self.assertEqual(e.kv_tags['ruleOne'], 'one')
+        self.assertIn('ruleTwo', e.m_tags)
+        e = Entity.objects.get(topic='_test_filters/foo/an_ac')
+        self.assertNotIn('ruleOne', e.kv_tags)
+        self.assertIn('ruleTwo', e.m_tags)
+
+    def test_topic_ruleset_new_topics_only(self):
+        rule_set = TopicTagRuleSet.objects.create(name='test new topics rule set')
+        rule = TopicTagRule.objects.create(rule_set=rule_set, name='first', tags=[{'tag': 'appName', 'value': 'v1'}],
+                                           filters=[{'type': 'c', 'value': '_test_filters/foo'}])
+        # the first run sees all the topics
+        updated_set = tasks.run_topic_tag_ruleset({'ruleset_id': rule_set.id, 'new_topics_only': True})[0]
+        self.assertEqual(sorted(updated_set), ['_test_filters/foo/an_ac', '_test_filters/foo/some_topic'])
+        rule_set.refresh_from_db()
+        self.assertIsNotNone(rule_set.last_run)
+
+        # the next ones only the topics added since
+        new_topic = '_test_filters/foo/new_{}'.format(int(time.time() * 1000))
+        Topic.ensure_topic_exists(new_topic)
+        rule.tags = [{'tag': 'appName', 'value': 'v2'}]
+        rule.save()
+        updated_set = tasks.run_topic_tag_ruleset({'ruleset_id': rule_set.id, 'new_topics_only': True})[0]
+        self.assertEqual(list(updated_set), [new_topic])
+        self.assertEqual(Entity.objects.get(topic=new_topic).kv_tags['appName'], 'v2')
+        self.assertEqual(Entity.objects.get(topic='_test_filters/foo/some_topic').kv_tags['appName'], 'v1')
+        updated_set = tasks.run_topic_tag_ruleset({'ruleset_id': rule_set.id, 'new_topics_only': True})[0]
+        self.assertEqual(len(updated_set), 0)
+
+        # the scheduled runs skip the rule sets never run and go on after a failing one
+        draft = TopicTagRuleSet.objects.create(name='test draft rule set')
+        TopicTagRule.objects.create(rule_set=draft, name='draft', tags=[{'tag': 'appName', 'value': 'draft'}],
+                                    filters=[{'type': 'c', 'value': '_test_filters/foo'}])
+        failing = TopicTagRuleSet.objects.create(name='test failing rule set', last_run=rule_set.last_run)
+        TopicTagRule.objects.create(rule_set=failing, name='failing',
+                                    tags=[{'tag': 'equipRef', 'value': '_test_no_such_equipment'}],
+                                    filters=[{'type': 'c', 'value': '_test_filters/foo'}])
+        new_topic = '_test_filters/foo/new_{}'.format(int(time.time() * 1000))
+        Topic.ensure_topic_exists(new_topic)
+        self.assertEqual(tasks.run_new_topics_tag_rulesets_task(), 1)
+        self.assertEqual(Entity.objects.get(topic=new_topic).kv_tags['appName'], 'v2')
+        self.assertIsNone(TopicTagRuleSet.objects.get(id=draft.id).last_run)
+
+    def test_topic_rules_preview(self):
+        self._login()
+        data = {
+            "name": "test preview rule",
+            "tags": [{"tag": "appName", "value": "preview_foo"}],
+            "filters": [{"field": "Topic", "type": "c", "value": "_test_filters/foo"}],
+            "rule_set_id": "new",
+            "rule_set_name": "test preview rule set"
+        }
+        response = self.client.post(reverse('core:topic_rules'), json.dumps(data), content_type='application/json')
+        rule_set_id = json.loads(response.content).get('rule_set').get('id')
+        rule_set_run_url = reverse('core:topictagruleset_run', kwargs={'id': rule_set_id})
+
+        # the CSV preview is downloaded
+        response = self.client.post(rule_set_run_url, {'preview_type': 'preview_csv'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        content = response.content.decode('utf-8')
+        self.assertTrue(content.startswith('__topic,'))
+        self.assertIn('_test_filters/foo/some_topic', content)
+        self.assertIn('preview_foo', content)
+
+        # the screen preview is stored for the report page
+        response = self.client.post(rule_set_run_url, {'preview_type': 'preview_screen'})
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(response.url.startswith(reverse('core:report_preview_csv') + '?report='))
+        token = response.url.split('?report=')[1].split('&')[0]
+        self.assertIn('preview_foo::$$updated$$', utils.pop_report(token))
+        self.assertIsNone(utils.pop_report(token))
+
+        # the previews did not change the topics
+        self.assertEqual(Entity.objects.get(topic='_test_filters/foo/some_topic').kv_tags['appName'], 'test_foo_1')
+
+        # in a background job the reports are stored under the task id
+        response = self.client.post(rule_set_run_url, {'preview_type': 'preview_csv', 'use_async': 'on'})
+        self.assertEqual(response.status_code, 302)
+        task_id = response.url.rstrip('/').split('/')[-1]
+        self.assertEqual(response.url, reverse('core:get_task_progress', kwargs={'task_id': task_id}))
+        # which can be downloaded once
+        url = reverse('core:report_download_csv')
+        response = self.client.get(url, {'report': task_id, 'name': 'Test Report'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename="TestReport.csv"')
+        self.assertIn('preview_foo', response.content.decode('utf-8'))
+        response = self.client.get(url, {'report': task_id, 'name': 'Test Report'})
+        self.assertEqual(response.status_code, 404)
+        # files are not served
+        response = self.client.get(url, {'file': os.path.abspath(__file__)})
+        self.assertEqual(response.status_code, 404)
+
+        # runs return the progress page of the job
+        response = self.client.post(rule_set_run_url, {'use_async': 'on'})
+        json_resp = json.loads(response.content)
+        self.assertEqual(json_resp['success'], 1)
+        self.assertEqual(json_resp['progress_url'],
+                         reverse('core:get_task_progress', kwargs={'task_id': json_resp['task_id']}))
+        self.assertEqual(Entity.objects.get(topic='_test_filters/foo/some_topic').kv_tags['appName'], 'preview_foo')
@@ -15,12 +15,16 @@
 # along with opentaps Smart Energy Applications Suite (SEAS).
 # If not, see <https://www.gnu.org/licenses/>.
 
+import numpy
 import time
 
 from .base import OpentapsSeasTestCase
 from datetime import datetime
+from datetime import timedelta
+from django.core.cache import cache
 from django.db import connections
 from opentaps_seas.core.models import Entity
+from opentaps_seas.core.models import ensure_crate_rollup_tables
 from opentaps_seas.core import utils
 
 
@@ -66,6 +70,13 @@ class UtilsTests(OpentapsSeasTestCase):
             c.execute(sql, ['_test%'])
             sql = """DELETE FROM {0} WHERE topic like %s""".format("data")
             c.execute(sql, ['_test%'])
+            for table in utils.ROLLUP_TABLES.values():
+                try:
+                    sql = """DELETE FROM {0} WHERE topic like %s""".format(table)
+                    c.execute(sql, ['_test%'])
+                except Exception:
+                    # the rollup tables may not exist yet
+                    pass
 
     def test_get_current_value(self):
         point = Entity()
@@ -99,6 +110,97 @@ class UtilsTests(OpentapsSeasTestCase):
         current_value = utils.get_current_value(point)
         self.assertTrue('<b>34.74</b>' in current_value)
 
+    def test_get_current_values(self):
+        point = Entity()
+        point.entity_id = self.entity_id
+        point.topic = self.topic
+        point.kind = 'Number'
+        point.unit = '°C'
+
+        point1 = Entity()
+        point1.entity_id = self.entity_id
+        point1.topic = self.topic1
+        point1.kind = 'Bool'
+
+        point2 = Entity()
+        point2.entity_id = self.entity_id
+        point2.topic = 'empty'
+        point2.kind = 'Number'
+
+        current_values = utils.get_current_values([point, point1, point2])
+        self.assertEqual(len(current_values), 3)
+        self.assertEqual(current_values[0]['value'], '34.7')
+        self.assertEqual(current_values[0]['unit'], '°C')
+        self.assertTrue(current_values[1]['value'])
+        self.assertIsNone(current_values[2])
+
+        self.assertEqual(utils.get_current_values([]), [])
+
+    def test_get_current_values_lookback(self):
+        point = Entity()
+        point.entity_id = self.entity_id
+        point.topic = '_test/topicold'
+        point.kind = 'Number'
+
+        with connections['crate'].cursor() as c:
+            sql = """INSERT INTO {0} (double_value, source, string_value, topic, ts)
+            VALUES (%s, %s, %s, %s, %s)""".format("data")
+            c.execute(sql, [12, 'scrape', '12', point.topic, datetime.utcnow() - timedelta(days=2)])
+            c.execute("""REFRESH TABLE {0}""".format("data"))
+
+        # the topics without data in the lookback window still get their latest value
+        # whether they are looked up concurrently or in sequence
+        for lookback, concurrency in [(3600, 4), (3600, 1), (0, 4)]:
+            with self.settings(CURRENT_VALUE_LOOKBACK=lookback, CRATE_QUERY_CONCURRENCY=concurrency):
+                latest = utils.get_latest_topics_values([self.topic, point.topic, 'empty'])
+                self.assertEqual(sorted(latest.keys()), sorted([self.topic, point.topic]))
+                self.assertEqual(latest[point.topic][1], '12')
+                self.assertEqual(latest[self.topic][1], '34.74')
+
+    def test_map_concurrently(self):
+        def query(topic):
+            with connections['crate'].cursor() as c:
+                c.execute("""SELECT COUNT(*) FROM {0} WHERE topic = %s""".format("data"), [topic])
+                return c.fetchone()[0]
+
+        topics = [self.topic, 'empty', self.topic1]
+        self.assertEqual(utils.map_concurrently(query, topics, max_workers=2), [1, 0, 1])
+        self.assertEqual(utils.map_concurrently(query, topics, max_workers=1), [1, 0, 1])
+        self.assertEqual(utils.map_concurrently(query, []), [])
+
+    def test_get_current_values_cached(self):
+        point = Entity()
+        point.entity_id = self.entity_id
+        point.topic = self.topic
+        point.kind = 'Number'
+        point.unit = ''
+
+        with self.settings(CURRENT_VALUE_CACHE_TTL=60):
+            cache.clear()
+            current_value = utils.get_current_value_dict(point)
+            self.assertEqual(current_value['value'], '34.74')
+            self.assertIn('fetched_epoch', current_value)
+
+            # change the value in Crate, the cached value is still returned
+            with connections['crate'].cursor() as c:
+                sql = """UPDATE {0} SET string_value = %s WHERE topic = %s""".format("data")
+                c.execute(sql, ['35.5', self.topic])
+                c.execute("""REFRESH TABLE {0}""".format("data"))
+            cached_value = utils.get_current_value_dict(point)
+            self.assertEqual(cached_value['value'], '34.74')
+            self.assertEqual(cached_value['fetched_epoch'], current_value['fetched_epoch'])
+
+            # refreshing the cache writes through the new value
+            utils.refresh_current_values_cache([self.topic])
+            current_value = utils.get_current_value_dict(point)
+            self.assertEqual(current_value['value'], '35.5')
+
+            with connections['crate'].cursor() as c:
+                sql = """UPDATE {0} SET string_value = %s WHERE topic = %s""".format("data")
+                c.execute(sql, ['34.74', self.topic])
+                c.execute("""REFRESH TABLE {0}""".format("data"))
+            cache.clear()
+
     def test_get_point_values(self):
         point = Entity()
         point.entity_id = self.entity_id
@@ -137,6 +239,262 @@ class UtilsTests(OpentapsSeasTestCase):
         self.assertIsNotNone(point_value)
         self.assertIn('34.74', point_value)
 
+    def test_get_point_values_max_points(self):
+        point = Entity()
+        point.entity_id = self.entity_id
+        point.topic = self.topic
+        point.kind = 'Number'
+        point.unit = '°C'
+
+        point_values = utils.get_point_values(point, 'minute', 'avg', '1 year', max_points=100, downsample='lttb')
+        self.assertIsNotNone(point_values)
+        self.assertEqual(len(point_values), 1)
+        self.assertIn(34.74, point_values[0])
+
+    def test_iter_point_values(self):
+        point = Entity()
+        point.entity_id = self.entity_id
+        point.topic = self.topic
+        point.unit = '°C'
+
+        for kind in ['Number', 'Str']:
+            point.kind = kind
+            point_values = utils.get_point_values(point, 'minute', 'avg', '1 year')
+            # use a small chunk to go through the paging
+            streamed_values = list(utils.iter_point_values(point, 'minute', 'avg', '1 year', chunk_size=1))
+            self.assertEqual(len(streamed_values), 1)
+            self.assertEqual(streamed_values, point_values)
+
+        point.topic = self.topic1
+        point.kind = 'Bool'
+        streamed_values = list(utils.iter_point_values(point, 'minute', 'avg', '1 year', chunk_size=1))
+        self.assertEqual(len(streamed_values), 1)
+        self.assertEqual(streamed_values[0][1], 1)
+
+    def test_iter_point_values_windows(self):
+        point = Entity()
+        point.entity_id = self.entity_id
+        point.topic = '_test/topicwindows'
+        point.kind = 'Number'
+        point.unit = '°C'
+
+        # two samples in the same minute, then samples after some empty minutes
+        base = datetime.utcnow().replace(second=0, microsecond=0) - timedelta(minutes=10)
+        with connections['crate'].cursor() as c:
+            sql = """INSERT INTO {0} (double_value, source, string_value, topic, ts)
+            VALUES (%s, %s, %s, %s, %s)""".format("data")
+            for offset, value in [(10, 1), (20, 3), (120, 5), (301, 7)]:
+                c.execute(sql, [value, 'scrape', str(value), point.topic, base + timedelta(seconds=offset)])
+            c.execute("""REFRESH TABLE {0}""".format("data"))
+
+        # each window aggregates chunk_size minutes, no bucket is split across windows
+        for chunk_size in [1, 2, 3, 10]:
+            streamed_values = list(utils.iter_point_values(point, 'minute', 'avg', '1 day', chunk_size=chunk_size))
+            self.assertEqual([v[1] for v in streamed_values], [2, 5, 7])
+            self.assertEqual([utils.to_epoch_ms(v[0]) for v in streamed_values],
+                             [utils.to_epoch_ms(base + timedelta(minutes=m)) for m in [0, 2, 5]])
+
+    def test_iter_point_values_same_ts(self):
+        point = Entity()
+        point.entity_id = self.entity_id
+        point.topic = '_test/topicsamets'
+        point.kind = 'Str'
+
+        # several sources writing at the same ts, on both sides of the page boundaries
+        base = datetime.utcnow().replace(microsecond=0) - timedelta(minutes=10)
+        samples = [(0, 'a', '1'), (1, 'a', '2'), (1, 'b', '3'), (1, 'c', '4'), (2, 'a', '5')]
+        with connections['crate'].cursor() as c:
+            sql = """INSERT INTO {0} (double_value, source, string_value, topic, ts)
+            VALUES (%s, %s, %s, %s, %s)""".format("data")
+            for offset, source, value in samples:
+                c.execute(sql, [float(value), source, value, point.topic, base + timedelta(seconds=offset)])
+            c.execute("""REFRESH TABLE {0}""".format("data"))
+
+        for chunk_size in [1, 2, 3, 10]:
+            streamed_values = list(utils.iter_point_values(point, trange='1 day', chunk_size=chunk_size))
+            self.assertEqual([v[1] for v in streamed_values], ['1', '2', '3', '4', '5'], chunk_size)
+
+    def test_update_rollups(self):
+        ensure_crate_rollup_tables()
+        now = datetime.utcnow()
+        hours, days = utils.update_rollups(since=now - timedelta(days=1))
+        self.assertGreaterEqual(hours, 2)
+        self.assertGreaterEqual(days, 2)
+
+        for table in utils.ROLLUP_TABLES.values():
+            with connections['crate'].cursor() as c:
+                sql = """SELECT min_value, max_value, avg_value, value_count, last_value
+                FROM {0} WHERE topic = %s""".format(table)
+                c.execute(sql, [self.topic])
+                self.assertEqual(c.fetchall(), [(34.74, 34.74, 34.74, 1, 34.74)])
+
+        point = Entity()
+        point.entity_id = self.entity_id
+        point.topic = self.topic
+        point.kind = 'Number'
+        with self.settings(CRATE_ROLLUPS=True):
+            self.assertEqual(utils.get_rollup_for_resolution(point, 'minute', 'avg'), None)
+            self.assertEqual(utils.get_rollup_for_resolution(point, 'hour', 'avg'), 'hour')
+            self.assertEqual(utils.get_rollup_for_resolution(point, 'month', 'max'), 'day')
+            self.assertEqual(utils.get_rollup_for_resolution(point, 'day', 'stddev'), None)
+            point_values = utils.get_point_values(point, 'hour', 'avg', '1 year')
+            self.assertEqual(len(point_values), 1)
+            self.assertIn(34.74, point_values[0])
+        with self.settings(CRATE_ROLLUPS=False):
+            self.assertEqual(utils.get_rollup_for_resolution(point, 'hour', 'avg'), None)
+
+    def test_get_point_values_arrays(self):
+        point = Entity()
+        point.entity_id = self.entity_id
+        point.topic = self.topic
+        point.kind = 'Number'
+
+        ts, values = utils.get_point_values_arrays(point, 'minute', 'avg', '1 year')
+        point_values = utils.get_point_values(point, 'minute', 'avg', '1 year')
+        self.assertEqual(ts.dtype, numpy.int64)
+        self.assertEqual(values.dtype, numpy.float64)
+        self.assertEqual(ts.tolist(), [v[0] for v in point_values])
+        self.assertEqual(values.tolist(), [34.74])
+
+        point.topic = self.topic1
+        point.kind = 'Bool'
+        ts, values = utils.get_point_values_arrays(point, 'minute', 'avg', '1 year')
+        self.assertEqual(values.tolist(), [1.0])
+
+    def test_point_rows_to_arrays(self):
+        rows = [(1000, 't', None), (2000, '0', 0.2), (3000, None, 0.0), (4000, None, None)]
+        ts, values = utils.point_rows_to_arrays(rows, is_bool=True)
+        self.assertEqual(ts.tolist(), [1000, 2000, 3000, 4000])
+        self.assertEqual(values[:3].tolist(), [1.0, 0.0, 0.0])
+        self.assertTrue(numpy.isnan(values[3]))
+
+        ts, values = utils.point_rows_to_arrays([])
+        self.assertEqual(len(ts), 0)
+        self.assertEqual(len(values), 0)
+
+    def test_get_points_matrix(self):
+        point = Entity()
+        point.entity_id = self.entity_id
+        point.description = 'Test Number'
+        point.topic = self.topic
+        point.kind = 'Number'
+        point.unit = '°C'
+        point1 = Entity()
+        point1.entity_id = self.entity_id + '1'
+        point1.description = 'Test Bool'
+        point1.topic = self.topic1
+        point1.kind = 'Bool'
+        point1.unit = None
+
+        matrix = utils.get_points_matrix([point, point1], '1 year', 'day')
+        self.assertEqual([c['entity_id'] for c in matrix['columns']], [point.entity_id, point1.entity_id])
+        self.assertEqual(len(matrix['rows']), 1)
+        self.assertEqual(matrix['rows'][0][1:], [34.74, 1])
+
+        matrix = utils.get_points_matrix([], '1 year', 'day')
+        self.assertEqual(matrix, {'columns': [], 'rows': []})
+
+    def test_get_point_values_cached(self):
+        point = Entity()
+        point.entity_id = self.entity_id
+        point.topic = '_test/topiccache'
+        point.kind = 'Number'
+        now = datetime.utcnow()
+        with connections['crate'].cursor() as c:
+            sql = """INSERT INTO {0} (double_value, source, string_value, topic, ts)
+            VALUES (%s, %s, %s, %s, %s)""".format("data")
+            c.execute(sql, [10, 'scrape', '10', point.topic, now - timedelta(hours=2)])
+            c.execute("""REFRESH TABLE {0}""".format("data"))
+
+        cache.clear()
+        with self.settings(POINT_VALUES_CACHE_TTL=60):
+            point_values = utils.get_point_values(point, 'hour', 'avg', '1 days', use_cache=True)
+            self.assertEqual([v[1] for v in point_values], [10])
+
+            with connections['crate'].cursor() as c:
+                c.execute(sql, [20, 'scrape', '20', point.topic, now])
+                # the old bucket is not queried again once cached
+                c.execute("""DELETE FROM {0} WHERE topic = %s AND double_value = %s""".format("data"),
+                          [point.topic, 10])
+                c.execute("""REFRESH TABLE {0}""".format("data"))
+
+            point_values = utils.get_point_values(point, 'hour', 'avg', '1 days', use_cache=True)
+            self.assertEqual([v[1] for v in point_values], [10, 20])
+
+            # polling does not renew the entry, once expired the whole range is queried again
+            key = utils._point_values_cache_key(point, 'hour', 'avg', '1 days')
+            created, rows = cache.get(key)
+            cache.set(key, (created - 60, rows))
+            point_values = utils.get_point_values(point, 'hour', 'avg', '1 days', use_cache=True)
+            self.assertEqual([v[1] for v in point_values], [20])
+
+        point_values = utils.get_point_values(point, 'hour', 'avg', '1 days')
+        self.assertEqual([v[1] for v in point_values], [20])
+
+    def test_get_resolution_for_max_points(self):
+        end = datetime.utcnow()
+        start = end - timedelta(hours=24)
+        self.assertEqual(utils.get_resolution_for_max_points(start, end, 2000), 'minute')
+        self.assertEqual(utils.get_resolution_for_max_points(start, end, 1000), 'hour')
+        self.assertEqual(utils.get_resolution_for_max_points(start, end, 1000, date_trunc='day'), 'day')
+        self.assertEqual(utils.get_resolution_for_max_points(start, end, None, date_trunc='second'), 'second')
+        start = end - timedelta(days=365)
+        self.assertEqual(utils.get_resolution_for_max_points(start, end, 1000), 'day')
+        self.assertEqual(utils.get_resolution_for_max_points(start, end, 10), 'month')
+
+    def test_downsample_values(self):
+        data = [[i * 1000, (i % 7) * 1.5] for i in range(1000)]
+        self.assertEqual(utils.downsample_values(data, 2000), data)
+        for method in [None, 'minmax', 'lttb']:
+            values = utils.downsample_values(data, 100, method=method)
+            self.assertLessEqual(len(values), 100)
+            # values are a subset of the original series and stay in order
+            for v in values:
+                self.assertIn(v, data)
+            self.assertEqual(values, sorted(values))
+        # keep the extremes of each bucket
+        values = utils.downsample_values(data, 100, method='minmax')
+        self.assertIn(0.0, [v[1] for v in values])
+        self.assertIn(9.0, [v[1] for v in values])
+        # non numeric values fallback to a simple stride
+        data = [[i * 1000, str(i)] for i in range(1000)]
+        values = utils.downsample_values(data, 100, method='lttb')
+        self.assertEqual(len(values), 100)
+        self.assertEqual(values[-1], data[-1])
+
+    def test_downsample_arrays(self):
+        data = [[i * 1000, (i % 7) * 1.5] for i in range(1000)]
+        ts = numpy.array([v[0] for v in data], dtype=numpy.int64)
+        values = numpy.array([v[1] for v in data], dtype=numpy.float64)
+        # same selection as the list based downsampling
+        for method in [None, 'minmax', 'lttb']:
+            d_ts, d_values = utils.downsample_arrays(ts, values, 100, method=method)
+            self.assertEqual(utils.point_arrays_to_values(d_ts, d_values),
+                             utils.downsample_values(data, 100, method=method))
+        # series with missing values fallback to a simple stride
+        values[10] = numpy.nan
+        d_ts, d_values = utils.downsample_arrays(ts, values, 100, method='lttb')
+        self.assertEqual(len(d_ts), 100)
+        self.assertEqual(d_ts[-1], ts[-1])
+        self.assertEqual(utils.point_arrays_to_values(ts[9:11], values[9:11], is_bool=True), [[9000, 3], [10000, None]])
+
+    def test_downsample_points_matrix(self):
+        # the second column only has a value every other bucket
+        rows = [[i * 1000, i * 1.5, i if i % 2 else None] for i in range(1000)]
+        matrix = {'columns': [{'entity_id': 'a'}, {'entity_id': 'b'}], 'rows': [list(row) for row in rows]}
+        self.assertEqual(utils.downsample_points_matrix(matrix, 2000)['rows'], rows)
+        for method in [None, 'minmax', 'lttb']:
+            matrix = {'columns': [{'entity_id': 'a'}, {'entity_id': 'b'}], 'rows': [list(row) for row in rows]}
+            downsampled = utils.downsample_points_matrix(matrix, 100, method=method)['rows']
+            # each column keeps at most max_points values taken from the original buckets
+            for i in [1, 2]:
+                values = [[row[0], row[i]] for row in downsampled if row[i] is not None]
+                self.assertLessEqual(len(values), 100)
+                self.assertTrue(values)
+                for v in values:
+                    self.assertEqual(rows[v[0] // 1000][i], v[1])
+            self.assertEqual(downsampled, sorted(downsampled))
+
     def test_charts_for_points(self):
         point = Entity()
         point.entity_id = self.entity_id
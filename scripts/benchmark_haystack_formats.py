@@ -0,0 +1,73 @@
+# This file is part of opentaps Smart Energy Applications Suite (SEAS).
+
+# opentaps Smart Energy Applications Suite (SEAS) is free software:
+# you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# opentaps Smart Energy Applications Suite (SEAS) is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public License
+# along with opentaps Smart Energy Applications Suite (SEAS).
+# If not, see <https://www.gnu.org/licenses/>.
+
+import hszinc
+import time
+from datetime import datetime
+from datetime import timedelta
+from django.utils import timezone
+from opentaps_seas.haystack.utils.hencoder import ENCODERS
+from opentaps_seas.haystack.utils.hencoder import encode_grid
+
+
+def his_grid(n):
+    # like a hisRead response
+    g = hszinc.Grid()
+    g.metadata['id'] = 'benchmark'
+    g.column['ts'] = {}
+    g.column['val'] = {}
+    start = datetime(2019, 1, 1, tzinfo=timezone.utc)
+    g.extend([{'ts': start + timedelta(minutes=i), 'val': i * 0.5} for i in range(n)])
+    return g
+
+
+def read_grid(n):
+    # like a read response of points
+    g = hszinc.Grid()
+    for c in ['id', 'dis', 'siteRef', 'equipRef', 'kind', 'unit', 'point', 'his']:
+        g.column[c] = {}
+    g.extend([{
+        'id': 'point/{}'.format(i),
+        'dis': 'Point {}'.format(i),
+        'siteRef': 'site/{}'.format(i // 1000),
+        'equipRef': 'equip/{}'.format(i // 10),
+        'kind': 'Number',
+        'unit': 'kW',
+        'point': hszinc.MARKER,
+        'his': hszinc.MARKER,
+    } for i in range(n)])
+    return g
+
+
+def timed(f):
+    start = time.perf_counter()
+    size = len(f())
+    return time.perf_counter() - start, size
+
+
+def run(*args):
+    # compare the hszinc dump with the streaming encoders, eg: --script-args 100000
+    n = int(args[0]) if args else 50000
+    for name, g in [('hisRead', his_grid(n)), ('read', read_grid(n))]:
+        print("{} grid of {} rows:".format(name, n))
+        elapsed, size = timed(lambda: hszinc.dump(g))
+        print("  {:<20} {:8.3f}s {:>12} chars".format('hszinc.dump zinc', elapsed, size))
+        elapsed, size = timed(lambda: hszinc.dump(g, mode=hszinc.MODE_JSON))
+        print("  {:<20} {:8.3f}s {:>12} chars".format('hszinc.dump json', elapsed, size))
+        for mime in ENCODERS.keys():
+            elapsed, size = timed(lambda: ''.join(encode_grid(g, g, mime)))
+            print("  {:<20} {:8.3f}s {:>12} chars".format(mime, elapsed, size))
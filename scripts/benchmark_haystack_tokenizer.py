@@ -0,0 +1,52 @@
+# This file is part of opentaps Smart Energy Applications Suite (SEAS).
+
+# opentaps Smart Energy Applications Suite (SEAS) is free software:
+# you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# opentaps Smart Energy Applications Suite (SEAS) is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public License
+# along with opentaps Smart Energy Applications Suite (SEAS).
+# If not, see <https://www.gnu.org/licenses/>.
+
+import time
+from opentaps_seas.haystack.utils.htoken import HaystackToken
+from opentaps_seas.haystack.utils.htokenizer import HaystackTokenizer
+
+
+def long_filter(n):
+    # a filter with n terms, numbers are only valid at the end for the char by char tokenizer
+    terms = ['(point and siteRef->geoCity=="City {}" or equipRef==@equip_{}.a)'.format(i, i) for i in range(n)]
+    return ' and '.join(terms) + ' and area>=2000'
+
+
+def zinc_literals(n):
+    # a Zinc grid of refs, strings, markers and uris, and a number at the end for the same reason
+    rows = ['@point_{},"Point {}",M,`http://example.com/{}`,"kW"'.format(i, i, i) for i in range(n)]
+    return 'ver:"3.0"\nid,dis,point,uri,unit\n' + '\n'.join(rows) + '\n@last,"Last",M,`http://example.com`,72.5kW'
+
+
+def tokenize(s, fast):
+    t = HaystackTokenizer(s, fast=fast)
+    n = 0
+    while t.next() != HaystackToken.eof:
+        n += 1
+    return n
+
+
+def run(*args):
+    # compare the regex tokenizer with the char by char one, eg: --script-args 1000
+    n = int(args[0]) if args else 500
+    for name, s in [('filter', long_filter(n)), ('zinc', zinc_literals(n))]:
+        print("{} of {} chars:".format(name, len(s)))
+        for fast in [False, True]:
+            start = time.perf_counter()
+            tokens = tokenize(s, fast)
+            elapsed = time.perf_counter() - start
+            print("  {:<12} {:8.3f}s {:>8} tokens".format('regex' if fast else 'char', elapsed, tokens))
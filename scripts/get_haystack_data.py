@@ -19,6 +19,7 @@ from datetime import datetime
 from datetime import timezone
 from opentaps_seas.core.models import Entity
 from opentaps_seas.core.utils import cleanup_id
+from opentaps_seas.core.utils import refresh_current_values_cache
 from hsclient.client import HSClient
 from crate.client.exceptions import ProgrammingError
 from django.db import connections
@@ -225,6 +226,9 @@ def import_data(base_url, range_from):
 
         crate_cursor.close()
 
+    # update the cached latest values of the topics that got new data
+    refresh_current_values_cache([t for item in topics_list for t, counter in item.items() if counter])
+
     print("Processed {0} topics.".format(topics_counter))
 
 
@@ -0,0 +1,30 @@
+# This file is part of opentaps Smart Energy Applications Suite (SEAS).
+
+# opentaps Smart Energy Applications Suite (SEAS) is free software:
+# you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# opentaps Smart Energy Applications Suite (SEAS) is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public License
+# along with opentaps Smart Energy Applications Suite (SEAS).
+# If not, see <https://www.gnu.org/licenses/>.
+
+from dateutil.parser import parse as parse_datetime
+from opentaps_seas.core.models import ensure_crate_rollup_tables
+from opentaps_seas.core.utils import update_rollups
+
+
+def run(*args):
+    # optionally give the date to recompute the rollups from, eg: --script-args 2019-01-01
+    since = None
+    if args:
+        since = parse_datetime(args[0])
+    ensure_crate_rollup_tables()
+    hours, days = update_rollups(since=since)
+    print(hours, "hourly and", days, "daily rollups have been updated")